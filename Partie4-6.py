@@ -1,15 +1,31 @@
 
 from dotenv import load_dotenv
-from groq import Groq
 from langfuse import observe, get_client, propagate_attributes
+import asyncio
+import contextvars
 import json
-from typing import List, Dict, Any, Callable
-from smolagents import CodeAgent, LiteLLMModel, tool, Tool
-from Partie5 import MenuDatabaseTool, calculate
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Any, Callable, Optional
+from smolagents import CodeAgent, tool, Tool
+from Partie5 import MenuDatabaseTool, MenuSolverTool, calculate
+from gateway import lazy_groq_client
+from llm import chat_completion
+from llm_cache import SAMPLING_SEED
+from agent_models import MeteredLiteLLMModel
+from agent_pool import checkout_agent, get_pool_stats
+from metering import metered
+from recipe_store import get_recipe_store
+from nutrition_table import get_nutrition_table
+from context_budget import ContextBudget
+import tool_memo
+import trace_export
 
 load_dotenv()
 
-groq_client = Groq()
+groq_client = lazy_groq_client()   # pool HTTP commun (gateway.py)
 langfuse_client = get_client()
 modele = "openai/gpt-oss-120b"
 
@@ -35,147 +51,96 @@ def check_fridge() -> List[str]:
         "épinards frais (300g)"
     ]
 
+# Recettes intégrées, utilisées quand CHEFBOT_RECIPES_PATH ne pointe pas vers un corpus
+BUILTIN_RECIPES = {
+    "omelette": """
+    Omelette aux champignons et fromage
+    
+    Ingrédients:
+    - 3 œufs
+    - 100g de champignons
+    - 50g de fromage râpé
+    - 20g de beurre
+    - Sel, poivre
+    
+    Instructions:
+    1. Émincer les champignons et les faire revenir dans du beurre
+    2. Battre les œufs avec sel et poivre
+    3. Verser les œufs dans la poêle avec les champignons
+    4. Parsemer de fromage râpé
+    5. Cuire 3-4 minutes, plier et servir
+    """,
+    "poulet": """
+    Poulet à la crème et champignons
+    
+    Ingrédients:
+    - 600g de poulet
+    - 200g de champignons
+    - 200ml de crème fraîche
+    - 1 oignon
+    - 2 gousses d'ail
+    - 30g de beurre
+    - Sel, poivre, herbes de Provence
+    
+    Instructions:
+    1. Couper le poulet en morceaux
+    2. Faire revenir l'oignon et l'ail dans le beurre
+    3. Ajouter le poulet et faire dorer
+    4. Ajouter les champignons émincés
+    5. Verser la crème, assaisonner
+    6. Mijoter 20 minutes
+    """,
+    "gratin": """
+    Gratin de courgettes
+    
+    Ingrédients:
+    - 2 courgettes
+    - 200ml de crème fraîche
+    - 100g de fromage râpé
+    - 2 gousses d'ail
+    - Sel, poivre, muscade
+    
+    Instructions:
+    1. Couper les courgettes en rondelles
+    2. Disposer dans un plat à gratin
+    3. Mélanger crème, ail haché, sel, poivre, muscade
+    4. Verser sur les courgettes
+    5. Parsemer de fromage
+    6. Cuire 30 min à 180°C
+    """
+}
+
+RECIPE_MIN_SCORE = float(os.getenv("CHEFBOT_RECIPE_MIN_SCORE", "0.35"))
+
+
+def _builtin_recipe_records() -> List[Dict[str, Any]]:
+    records = []
+    for key, text in BUILTIN_RECIPES.items():
+        title = text.strip().splitlines()[0].strip()
+        records.append({"name": title, "aliases": [key], "text": text})
+    return records
+
+
 def get_recipe(dish_name: str) -> str:
     """Retourne une recette détaillée pour un plat donné"""
-    recipes = {
-        "omelette": """
-        Omelette aux champignons et fromage
-        
-        Ingrédients:
-        - 3 œufs
-        - 100g de champignons
-        - 50g de fromage râpé
-        - 20g de beurre
-        - Sel, poivre
-        
-        Instructions:
-        1. Émincer les champignons et les faire revenir dans du beurre
-        2. Battre les œufs avec sel et poivre
-        3. Verser les œufs dans la poêle avec les champignons
-        4. Parsemer de fromage râpé
-        5. Cuire 3-4 minutes, plier et servir
-        """,
-        "poulet": """
-        Poulet à la crème et champignons
-        
-        Ingrédients:
-        - 600g de poulet
-        - 200g de champignons
-        - 200ml de crème fraîche
-        - 1 oignon
-        - 2 gousses d'ail
-        - 30g de beurre
-        - Sel, poivre, herbes de Provence
-        
-        Instructions:
-        1. Couper le poulet en morceaux
-        2. Faire revenir l'oignon et l'ail dans le beurre
-        3. Ajouter le poulet et faire dorer
-        4. Ajouter les champignons émincés
-        5. Verser la crème, assaisonner
-        6. Mijoter 20 minutes
-        """,
-        "gratin": """
-        Gratin de courgettes
-        
-        Ingrédients:
-        - 2 courgettes
-        - 200ml de crème fraîche
-        - 100g de fromage râpé
-        - 2 gousses d'ail
-        - Sel, poivre, muscade
-        
-        Instructions:
-        1. Couper les courgettes en rondelles
-        2. Disposer dans un plat à gratin
-        3. Mélanger crème, ail haché, sel, poivre, muscade
-        4. Verser sur les courgettes
-        5. Parsemer de fromage
-        6. Cuire 30 min à 180°C
-        """
-    }
-    
-    dish_lower = dish_name.lower()
-    for key in recipes:
-        if key in dish_lower:
-            return recipes[key]
-    
-    return f"Désolé, je n'ai pas de recette pour '{dish_name}' dans ma base de données."
+    store = get_recipe_store(_builtin_recipe_records())
+    matches = store.search(dish_name, k=3)
+    if matches and matches[0][0] >= RECIPE_MIN_SCORE:
+        return store.get_text(matches[0][1])
+
+    message = f"Désolé, je n'ai pas de recette pour '{dish_name}' dans ma base de données."
+    if matches:
+        message += " Plats proches : " + ", ".join(store.name(idx) for _, idx in matches) + "."
+    return message
 
 def check_dietary_info(ingredient: str) -> str:
     """Retourne les informations nutritionnelles et allergéniques d'un ingrédient"""
-    dietary_info = {
-        "oeufs": {
-            "calories_pour_100g": 155,
-            "proteines": "13g",
-            "lipides": "11g",
-            "glucides": "1g",
-            "allergenes": ["œufs"],
-            "convient_pour": ["régime protéiné"],
-            "ne_convient_pas_pour": ["végan", "végétalien"]
-        },
-        "lait": {
-            "calories_pour_100ml": 61,
-            "proteines": "3.2g",
-            "lipides": "3.3g",
-            "glucides": "4.8g",
-            "allergenes": ["lactose", "protéines laitières"],
-            "convient_pour": ["végétarien"],
-            "ne_convient_pas_pour": ["végan", "intolérant au lactose"]
-        },
-        "poulet": {
-            "calories_pour_100g": 165,
-            "proteines": "31g",
-            "lipides": "3.6g",
-            "glucides": "0g",
-            "allergenes": [],
-            "convient_pour": ["régime protéiné", "sans gluten"],
-            "ne_convient_pas_pour": ["végan", "végétarien"]
-        },
-        "champignons": {
-            "calories_pour_100g": 22,
-            "proteines": "3.1g",
-            "lipides": "0.3g",
-            "glucides": "3.3g",
-            "allergenes": [],
-            "convient_pour": ["végan", "végétarien", "sans gluten", "régime faible en calories"],
-            "ne_convient_pas_pour": []
-        },
-        "fromage": {
-            "calories_pour_100g": 402,
-            "proteines": "25g",
-            "lipides": "33g",
-            "glucides": "1.3g",
-            "allergenes": ["lactose", "protéines laitières"],
-            "convient_pour": ["végétarien"],
-            "ne_convient_pas_pour": ["végan", "intolérant au lactose"]
-        },
-        "courgettes": {
-            "calories_pour_100g": 17,
-            "proteines": "1.2g",
-            "lipides": "0.3g",
-            "glucides": "3.1g",
-            "allergenes": [],
-            "convient_pour": ["végan", "végétarien", "sans gluten", "régime faible en calories"],
-            "ne_convient_pas_pour": []
-        }
-    }
-    
-    ingredient_lower = ingredient.lower()
-    for key in dietary_info:
-        if key in ingredient_lower:
-            info = dietary_info[key]
-            result = f"\nInformations nutritionnelles pour {ingredient}:\n"
-            result += f"- Calories: {info['calories_pour_100g']} kcal/100g\n"
-            result += f"- Protéines: {info['proteines']}\n"
-            result += f"- Lipides: {info['lipides']}\n"
-            result += f"- Glucides: {info['glucides']}\n"
-            result += f"- Allergènes: {', '.join(info['allergenes']) if info['allergenes'] else 'Aucun'}\n"
-            result += f"- Convient pour: {', '.join(info['convient_pour'])}\n"
-            result += f"- Ne convient pas pour: {', '.join(info['ne_convient_pas_pour']) if info['ne_convient_pas_pour'] else 'Tout le monde'}\n"
-            return result
-    
-    return f"Pas d'informations disponibles pour '{ingredient}'"
+    return get_nutrition_table().describe(ingredient)
+
+
+def check_dietary_info_batch(items: List[Dict[str, Any]]) -> str:
+    """Calories, macros et allergènes d'une liste d'ingrédients avec quantités, en un appel"""
+    return json.dumps(get_nutrition_table().batch(items), ensure_ascii=False)
 
 
 # 4.2 - Boucle de tool calling manuelle
@@ -226,6 +191,34 @@ tools = [
                 "required": ["ingredient"]
             }
         }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "check_dietary_info_batch",
+            "description": (
+                "Analyse en un seul appel une liste d'ingrédients avec quantités : calories et macros "
+                "par ingrédient et au total, et union des allergènes"
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "items": {
+                        "type": "array",
+                        "description": "Ingrédients à analyser",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "ingredient": {"type": "string", "description": "Nom de l'ingrédient"},
+                                "quantity": {"type": "number", "description": "Quantité en g (ou ml), 100 par défaut"}
+                            },
+                            "required": ["ingredient"]
+                        }
+                    }
+                },
+                "required": ["items"]
+            }
+        }
     }
 ]
 
@@ -233,41 +226,199 @@ tools = [
 TOOLS_MAP: Dict[str, Callable] = {
     "check_fridge": check_fridge,
     "get_recipe": get_recipe,
-    "check_dietary_info": check_dietary_info
+    "check_dietary_info": check_dietary_info,
+    "check_dietary_info_batch": check_dietary_info_batch
+}
+
+# Déclarations de mise en cache des outils (voir tool_memo.py) : pur, ou valable ttl secondes ;
+# casefold liste les arguments dont la casse ne change pas le résultat
+TOOL_POLICIES: Dict[str, Dict[str, Any]] = {
+    "check_fridge": {"ttl": 60.0},
+    "get_recipe": {"pure": True, "casefold": ["dish_name"]},
+    "check_dietary_info": {"pure": True, "casefold": ["ingredient"]},
+    "check_dietary_info_batch": {"pure": True},
+}
+for _name, _policy in TOOL_POLICIES.items():
+    tool_memo.declare_tool(_name, **_policy)
+
+
+# Budget de tokens de l'historique de la boucle manuelle (voir context_budget.py)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CHEFBOT_CONTEXT_BUDGET", "6000"))
+
+# Exécution des outils : pool borné partagé et délai maximum par outil
+TOOL_WORKERS = int(os.getenv("CHEFBOT_TOOL_WORKERS", "4"))
+DEFAULT_TOOL_TIMEOUT = float(os.getenv("CHEFBOT_TOOL_TIMEOUT", "10"))
+TOOL_TIMEOUTS: Dict[str, float] = {
+    "get_recipe": 30.0,  # le premier appel indexe le corpus de recettes
 }
 
 
+class ToolExecutor:
+    """Pool d'exécution des outils, remplacé quand un outil dépasse son délai.
+
+    Un thread Python ne peut pas être interrompu : un outil synchrone bloqué garde son
+    worker jusqu'à ce qu'il rende la main (le délai ne débloque que l'appelant). Pour que
+    quelques outils bloqués n'affament pas les appels suivants, le pool est alors remplacé
+    par un pool neuf ; l'ancien finit ses tâches en arrière-plan. Les workers ainsi perdus
+    sont comptés (leaked_workers au total, hung_workers encore occupés)."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tool")
+        self.stats = {"timeouts": 0, "cancelled": 0, "leaked_workers": 0, "hung_workers": 0, "replaced_pools": 0}
+
+    def submit(self, fn: Callable, *args: Any):
+        with self._lock:
+            return self._pool.submit(fn, *args)
+
+    def abandon(self, future) -> None:
+        """Après un délai dépassé : annule l'appel s'il attend encore un worker, sinon
+        compte le worker perdu et remplace le pool"""
+        with self._lock:
+            self.stats["timeouts"] += 1
+            if future.done() or future.cancel():
+                self.stats["cancelled"] += 1
+                return
+            self.stats["leaked_workers"] += 1
+            self.stats["hung_workers"] += 1
+            self.stats["replaced_pools"] += 1
+            old, self._pool = self._pool, ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tool")
+        old.shutdown(wait=False)
+        future.add_done_callback(self._on_hung_done)
+
+    def _on_hung_done(self, _future) -> None:
+        with self._lock:
+            self.stats["hung_workers"] -= 1
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
+
+
+# Deux pools : les threads d'exécution des outils, et ceux qui répartissent les appels
+# d'un même tour (chacun attend son outil, avec délai, dans son span execute_tool_call)
+_tool_executor = ToolExecutor(TOOL_WORKERS)
+_dispatch_pool = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool-dispatch")
+
+
+def _run_tool(function_to_call: Callable, arguments: Dict[str, Any], timeout: float) -> Any:
+    if asyncio.iscoroutinefunction(function_to_call):
+        return asyncio.run(asyncio.wait_for(function_to_call(**arguments), timeout))
+    return function_to_call(**arguments)
+
+
 @observe(name="execute_tool_call")
-def execute_tool_call(tool_name: str, arguments: Dict[str, Any]) -> str:
-    """Exécute un appel d'outil et retourne le résultat"""
+def execute_tool_call(tool_name: str, arguments: Dict[str, Any], claim: Optional[tuple] = None) -> str:
+    """Exécute un appel d'outil et retourne le résultat.
+
+    claim : (numéro, appel identique précédent) déjà attribué par execute_tool_calls ;
+    sinon l'appel est numéroté ici."""
+    timeout = TOOL_TIMEOUTS.get(tool_name, DEFAULT_TOOL_TIMEOUT)
+    start = time.perf_counter()
+    status = "ok"
+    cache_status = None
+    key = tool_memo.canonical_args(arguments, tool_name)
+    run = tool_memo.current_run()
+    if claim is not None:
+        number, previous = claim
+    else:
+        number, previous = run.claim(tool_name, key) if run is not None else (None, None)
+    
+    if tool_name not in TOOLS_MAP:
+        status = "unknown_tool"
+        output = f"Erreur: outil '{tool_name}' inconnu"
+    elif previous is not None:
+        # Appel répété dans la même exécution : le résultat est déjà dans la conversation
+        cache_status = "duplicate"
+        output = f"Résultat identique à l'appel #{previous} ({tool_name} {key}), déjà fourni plus haut."
+    else:
+        hit, result = tool_memo.get_tool_cache().lookup(tool_name, key) if tool_name in TOOL_POLICIES else (False, None)
+        if hit:
+            cache_status = "hit"
+        else:
+            cache_status = "miss" if tool_name in TOOL_POLICIES else None
+            future = _tool_executor.submit(_run_tool, TOOLS_MAP[tool_name], arguments, timeout)
+            try:
+                result = future.result(timeout=timeout)
+                tool_memo.get_tool_cache().store(tool_name, key, result)
+            except (FutureTimeoutError, asyncio.TimeoutError):
+                _tool_executor.abandon(future)
+                status = "timeout"
+            except Exception as e:
+                status = "error"
+                error = e
+        
+        if status == "ok":
+            if isinstance(result, list):
+                output = json.dumps(result, ensure_ascii=False)
+            else:
+                output = str(result)
+        else:
+            if run is not None:
+                run.forget(tool_name, key, number)
+            if status == "timeout":
+                output = f"Erreur: l'outil {tool_name} n'a pas répondu en {timeout:g} s"
+            else:
+                output = f"Erreur lors de l'exécution de {tool_name}: {str(error)}"
+    
     try:
         langfuse_client.update_current_observation(
-            metadata={"tool_name": str(tool_name), "arguments": arguments}
+            metadata={
+                "tool_name": str(tool_name),
+                "arguments": arguments,
+                "status": status,
+                "call_number": number,
+                "cache": cache_status,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+                "timeout_s": timeout,
+                **({"tool_workers": _tool_executor.get_stats()} if status == "timeout" else {}),
+            }
         )
     except Exception:
         pass
     
-    if tool_name not in TOOLS_MAP:
-        return f"Erreur: outil '{tool_name}' inconnu"
-    
-    try:
-        function_to_call = TOOLS_MAP[tool_name]
-        result = function_to_call(**arguments)
-        if isinstance(result, list):
-            return json.dumps(result, ensure_ascii=False)
-        return str(result)
-    except Exception as e:
-        return f"Erreur lors de l'exécution de {tool_name}: {str(e)}"
+    return output
+
+
+def execute_tool_calls(calls: List[tuple]) -> List[str]:
+    """Exécute les appels (nom, arguments) d'un même tour en parallèle ; résultats dans l'ordre"""
+    if len(calls) <= 1:
+        return [execute_tool_call(name, args) for name, args in calls]
+    run = tool_memo.current_run()
+    keys = [tool_memo.canonical_args(args, name) for name, args in calls]
+    # Numérotation dans l'ordre des tool_calls, sur ce thread, avant la répartition
+    claims = [run.claim(name, key) if run is not None else (None, None) for (name, _), key in zip(calls, keys)]
+    this_turn = {number for number, _ in claims}
+
+    def _submit(i: int, claim: tuple):
+        # copy_context pour rattacher chaque span execute_tool_call à la trace courante
+        ctx = contextvars.copy_context()
+        return _dispatch_pool.submit(ctx.run, execute_tool_call, calls[i][0], calls[i][1], claim)
+
+    # Un doublon d'un appel de ce même tour attend que cet appel ait réussi avant de le
+    # citer ; s'il a échoué, le doublon est exécuté pour de bon
+    deferred = [i for i, (_, previous) in enumerate(claims) if previous is not None and previous in this_turn]
+    futures = {i: _submit(i, claim) for i, claim in enumerate(claims) if i not in deferred}
+    results = {i: f.result() for i, f in futures.items()}
+    for i in deferred:
+        number, previous = claims[i]
+        futures[i] = _submit(i, (number, run.resolve(calls[i][0], keys[i], number, previous)))
+    results.update((i, futures[i].result()) for i in deferred)
+    return [results[i] for i in range(len(calls))]
 
 
 @observe(name="Approche Manuelle")
-def manual_tool_calling(question: str, max_iterations: int = 5) -> str:
+@metered("manual_tool_calling")
+def manual_tool_calling(question: str, max_iterations: int = 5, token_budget: int = None) -> str:
+    budget = ContextBudget(max_tokens=token_budget or CONTEXT_TOKEN_BUDGET)
     # Ajout de metadata pour le span
     try:
         langfuse_client.update_current_observation(
             metadata={
                 "approach": "manual",
-                "max_iterations": max_iterations
+                "max_iterations": max_iterations,
+                "token_budget": budget.max_tokens
             }
         )
     except Exception:
@@ -279,7 +430,8 @@ def manual_tool_calling(question: str, max_iterations: int = 5) -> str:
             "content": (
                 "Tu es ChefBot, un assistant culinaire intelligent. "
                 "Tu as accès à des outils pour consulter le frigo, obtenir des recettes, "
-                "et vérifier les informations nutritionnelles. Utilise-les judicieusement."
+                "et vérifier les informations nutritionnelles. Utilise-les judicieusement. "
+                "Pour plusieurs ingrédients, utilise check_dietary_info_batch en un seul appel."
             )
         },
         {"role": "user", "content": question}
@@ -287,16 +439,33 @@ def manual_tool_calling(question: str, max_iterations: int = 5) -> str:
     print("\nApproche Manuelle")
     print(f"Question: {question}\n")
     
+    # Les appels d'outils répétés pendant cette exécution sont remplacés par une référence
+    with tool_memo.run_scope() as run:
+        return _manual_tool_loop(messages, max_iterations, budget, run)
+
+
+def _manual_tool_loop(messages: List[Dict[str, Any]], max_iterations: int,
+                      budget: ContextBudget, run: tool_memo.RunMemo) -> str:
+    context_tokens = []
     for iteration in range(max_iterations):
         print(f"--- Itération {iteration + 1}/{max_iterations} ---")
         
+        # Garder l'historique sous le budget de tokens avant l'appel
+        compaction = budget.compact(messages, tools)
+        context_tokens.append({"iteration": iteration + 1, **compaction})
+        if compaction["compacted_messages"]:
+            run.clear_references()
+        
         # Appel au LLM avec les outils disponibles
-        response = groq_client.chat.completions.create(
+        response = chat_completion(
+            groq_client,
+            phase="tool_loop",
             model=modele,
             messages=messages,
             tools=tools,
             tool_choice="auto",
-            temperature=0.3
+            temperature=0.3,
+            seed=SAMPLING_SEED,
         )
         
         response_message = response.choices[0].message
@@ -320,19 +489,20 @@ def manual_tool_calling(question: str, max_iterations: int = 5) -> str:
                 ]
             })
             
-            # Exécuter chaque outil demandé
+            # Exécuter les outils demandés (en parallèle s'il y en a plusieurs)
+            calls = []
             for tool_call in response_message.tool_calls:
                 tool_name = tool_call.function.name
                 tool_args = json.loads(tool_call.function.arguments)
-                
                 print(f"-- Appel de l'outil: {tool_name}")
                 print(f"-- Arguments: {tool_args}")
-                
-                # Exécuter l'outil
-                tool_result = execute_tool_call(tool_name, tool_args)
-                print(f"-- Résultat: {tool_result[:100]}...")
-                
-                # Ajouter le résultat aux messages
+                calls.append((tool_name, tool_args))
+            
+            tool_results = execute_tool_calls(calls)
+            
+            # Ajouter les résultats aux messages, dans l'ordre des tool_call_id
+            for tool_call, tool_result in zip(response_message.tool_calls, tool_results):
+                print(f"-- Résultat ({tool_call.function.name}): {tool_result[:100]}...")
                 messages.append({
                     "role": "tool",
                     "tool_call_id": tool_call.id,
@@ -349,6 +519,7 @@ def manual_tool_calling(question: str, max_iterations: int = 5) -> str:
                         "approach": "manual",
                         "max_iterations": max_iterations,
                         "iterations_used": iteration + 1,
+                        "context_tokens": context_tokens,
                         "status": "completed"
                     }
                 )
@@ -366,6 +537,7 @@ def manual_tool_calling(question: str, max_iterations: int = 5) -> str:
                 "approach": "manual",
                 "max_iterations": max_iterations,
                 "iterations_used": max_iterations,
+                "context_tokens": context_tokens,
                 "status": "max_iterations_reached"
             }
         )
@@ -379,7 +551,7 @@ def manual_tool_calling(question: str, max_iterations: int = 5) -> str:
 @tool
 def check_fridge_tool() -> List[str]:
     """Consulte le contenu du frigo et retourne la liste des ingrédients disponibles"""
-    return check_fridge()
+    return tool_memo.call_memoized("check_fridge", check_fridge)
 
 @tool
 def get_recipe_tool(dish_name: str) -> str:
@@ -389,7 +561,7 @@ def get_recipe_tool(dish_name: str) -> str:
     Args:
         dish_name: Le nom du plat pour lequel obtenir la recette
     """
-    return get_recipe(dish_name)
+    return tool_memo.call_memoized("get_recipe", get_recipe, dish_name=dish_name)
 
 @tool
 def check_dietary_info_tool(ingredient: str) -> str:
@@ -399,38 +571,55 @@ def check_dietary_info_tool(ingredient: str) -> str:
     Args:
         ingredient: Le nom de l'ingrédient à analyser
     """
-    return check_dietary_info(ingredient)
+    return tool_memo.call_memoized("check_dietary_info", check_dietary_info, ingredient=ingredient)
 
-
-@observe(name="Smolagents")
-def smolagents_approach(question: str) -> str:
-    try:
-        langfuse_client.update_current_observation(
-            metadata={"approach": "smolagents"}
-        )
-    except Exception:
-        pass
-    
-    print("Smolagents")
-    print(f"Question: {question}\n")
+@tool
+def check_dietary_info_batch_tool(items: list) -> str:
+    """
+    Analyse en un seul appel une liste d'ingrédients avec leurs quantités : calories et macros
+    par ingrédient et au total, et union des allergènes (résultat JSON)
     
+    Args:
+        items: Liste de dictionnaires {"ingredient": nom, "quantity": grammes ou ml (100 par défaut)}
+    """
+    return tool_memo.call_memoized("check_dietary_info_batch", check_dietary_info_batch, items=items)
+
+
+def build_code_agent() -> CodeAgent:
+    """Agent unique de l'approche smolagents (Partie 4)"""
     # Créer le modèle LiteLLM pointant vers Groq
-    model = LiteLLMModel(
+    model = MeteredLiteLLMModel(
         model_id=f"groq/{modele}",
+        phase="code_agent",
         temperature=0.3
     )
     
     # Créer l'agent avec les outils
-    agent = CodeAgent(
+    return CodeAgent(
         tools=[check_fridge_tool, get_recipe_tool, check_dietary_info_tool],
         model=model,
         additional_authorized_imports=["json", "typing"],
         max_steps=5
     )
+
+
+@observe(name="Smolagents")
+@metered("smolagents_approach")
+def smolagents_approach(question: str) -> str:
+    try:
+        langfuse_client.update_current_observation(
+            metadata={"approach": "smolagents"}
+        )
+    except Exception:
+        pass
+    
+    print("Smolagents")
+    print(f"Question: {question}\n")
     
-    # Exécuter la requête
+    # Exécuter la requête avec un agent déjà construit, emprunté au pool (agent_pool.py)
     try:
-        result = agent.run(question)
+        with checkout_agent("smolagents_approach", build_code_agent) as agent:
+            result = agent.run(question)
         print(f"\nRéponse:\n{result}\n")
         
         # Mise à jour du span avec le succès
@@ -522,18 +711,20 @@ def build_chefbot_empire():
         Le manager agent qui coordonne les agents spécialisés
     """
     
-    # Créer le modèle LLM
-    model = LiteLLMModel(model_id=f"groq/{modele}", temperature=0.3)
+    # Un modèle par agent pour que le comptage des tokens distingue manager et sous-agents
+    def _model(phase: str) -> MeteredLiteLLMModel:
+        return MeteredLiteLLMModel(model_id=f"groq/{modele}", phase=phase, temperature=0.3)
     
     # --- Agent 1: Nutritionist ---
     # Vérifie l'équilibre nutritionnel et les allergènes
     nutritionist = CodeAgent(
-        tools=[check_dietary_info_tool],
-        model=model,
+        tools=[check_dietary_info_batch_tool, check_dietary_info_tool],
+        model=_model("nutritionist"),
         name="nutritionist",
         description=(
             "Nutritionniste expert qui vérifie l'équilibre nutritionnel et les allergènes. "
-            "Utilise check_dietary_info_tool pour analyser les ingrédients. "
+            "Utilise check_dietary_info_batch_tool pour analyser tous les ingrédients d'un plat "
+            "(avec quantités) en un seul appel, check_dietary_info_tool pour le détail d'un ingrédient. "
             "Peut recommander des alternatives pour les allergies et intolérances."
         ),
         max_steps=5,
@@ -543,7 +734,7 @@ def build_chefbot_empire():
     # Propose des recettes et consulte le frigo
     chef_agent = CodeAgent(
         tools=[check_fridge_tool, get_recipe_tool],
-        model=model,
+        model=_model("chef_agent"),
         name="chef_agent",
         description=(
             "Chef cuisinier expert qui propose des recettes et consulte le frigo. "
@@ -556,13 +747,16 @@ def build_chefbot_empire():
     # --- Agent 3: Budget Agent ---
     # Calcule les coûts et respecte le budget
     menu_db = MenuDatabaseTool()
+    menu_solver = MenuSolverTool(menu_db)
     budget_agent = CodeAgent(
-        tools=[calculate, menu_db],
-        model=model,
+        tools=[calculate, menu_db, menu_solver],
+        model=_model("budget_agent"),
         name="budget_agent",
         description=(
             "Expert en gestion de budget qui calcule les coûts et consulte le menu. "
-            "Utilise menu_database pour trouver des plats selon le budget et "
+            "Utilise menu_solver pour trouver en un appel les meilleures combinaisons "
+            "(une restriction par convive, services demandés, budget total), "
+            "menu_database pour trouver des plats selon le budget et "
             "calculate pour effectuer les calculs de coûts totaux."
         ),
         max_steps=5,
@@ -572,7 +766,7 @@ def build_chefbot_empire():
     # Coordonne les 3 agents spécialisés, n'a aucun outil propre
     manager = CodeAgent(
         tools=[],  # Pas d'outils propres
-        model=model,
+        model=_model("manager"),
         managed_agents=[nutritionist, chef_agent, budget_agent],
         name="chefbot_manager",
         description=(
@@ -592,6 +786,7 @@ def build_chefbot_empire():
 
 # 6.2 - Test du système multi-agent
 @observe(name="Quentin & Arthur - Partie 6")
+@metered("chefbot_empire")
 def test_empire_chefbot():
     try:
         with propagate_attributes(tags=["Quentin & Arthur", "Partie 6"]):
@@ -606,8 +801,6 @@ def test_empire_chefbot():
     except Exception:
         pass
     
-    manager = build_chefbot_empire()
-
     complex_query = (
         "Je reçois 8 personnes samedi soir. Parmi eux : 2 végétariens, "
         "1 intolérant au gluten, 1 allergique aux fruits à coque. "
@@ -620,7 +813,9 @@ def test_empire_chefbot():
     print(f"\n{complex_query}\n")
     
     try:
-        result = manager.run(complex_query)
+        # Graphe manager + agents spécialisés emprunté au pool, remis à zéro au retour
+        with checkout_agent("chefbot_empire", build_chefbot_empire) as manager:
+            result = manager.run(complex_query)
         
         print("Résultat :")
         print(f"\n{result}\n")
@@ -635,7 +830,8 @@ def test_empire_chefbot():
                     "manager": "chefbot_manager",
                     "status": "completed",
                     "query_complexity": "high",
-                    "constraints": ["végétariens", "sans gluten", "sans fruits à coque", "budget 120€"]
+                    "constraints": ["végétariens", "sans gluten", "sans fruits à coque", "budget 120€"],
+                    "agent_pool": get_pool_stats().get("chefbot_empire"),
                 }
             )
         except Exception:
@@ -674,11 +870,8 @@ if __name__ == "__main__":
     # Exécuter le test du système multi-agent
     test_empire_chefbot()
     
-    # Flush final pour s'assurer que toutes les traces sont envoyées
-    try:
-        langfuse_client.flush()
-        print("\nTraces Langfuse envoyées")
-    except Exception as e:
-        print(f"\nErreur lors du flush Langfuse: {e}")
+    # Vide la file d'export et fait le flush final (aussi fait automatiquement via atexit)
+    trace_export.shutdown()
+    print("\nTraces Langfuse envoyées")
     
     print("PARTIES 4 ET 6 TERMINÉES")
@@ -1,8 +1,16 @@
 import os
 from dotenv import load_dotenv
-from smolagents import CodeAgent, Tool, LiteLLMModel, tool
-from typing import Optional, List
+from smolagents import CodeAgent, Tool, tool
+from typing import Optional, List, Tuple
+from functools import lru_cache
+import ast
+import bisect
+import heapq
+import itertools
 import json
+import operator
+from agent_models import MeteredLiteLLMModel
+from text_matcher import MultiPatternMatcher
 
 load_dotenv()
 
@@ -53,77 +61,475 @@ class MenuDatabaseTool(Tool):
             {"name": "Crème Brûlée", "price": 9, "prep_time": 60, "allergens": ["lait", "oeuf"], "category": "Dessert", "tags": ["vegetarien", "sans gluten"]}
         ]
 
-    def forward(self, category: str = None, max_price: float = None, dietary_restriction: str = None) -> str:
-        results = []
+        self._build_indexes()
+
+    # Index construits une fois ; add/update/remove les tiennent à jour.
+    # Les listes de postings sont des bitsets (int Python, bit i = plat d'id i) :
+    # un filtre se résout par intersection (&) au lieu d'un parcours de menu_data.
+
+    def _build_indexes(self) -> None:
+        self._dishes = {}             # id -> plat
+        self._ids_by_name = {}        # nom en minuscules -> id
+        self._all_mask = 0
+        self._category_masks = {}     # catégorie en minuscules -> bitset
+        self._tag_masks = {}          # tag en minuscules -> bitset
+        self._allergen_masks = {}     # allergène en minuscules -> bitset
+        self._prices = []             # [(prix, id)] trié, interrogé par bisection
+        self._next_id = 0
         for dish in self.menu_data:
-            keep = True
-            
-            # Filtre par catégorie
-            if category and dish["category"].lower() != category.lower():
-                keep = False
-            
-            # Filtre par prix
-            if max_price is not None and dish["price"] > max_price:
-                keep = False
-            
-            # Filtre par restriction (basé sur tags ou allergènes)
-            if dietary_restriction:
-                req = dietary_restriction.lower()
-                
-                # Check tags explicitly
-                dish_tags = [t.lower() for t in dish["tags"]]
-                
-                if "vegetarien" in req:
-                    if "vegetarien" not in dish_tags and "vegan" not in dish_tags:
-                        keep = False
-                
-                if "vegan" in req:
-                    if "vegan" not in dish_tags:
-                        keep = False
-
-                if "gluten" in req and ("sans" in req or "free" in req):
-                    if "sans gluten" not in dish_tags: # ou vérifier allergènes
-                        # Fallback check allergens
-                        if "gluten" in [a.lower() for a in dish["allergens"]]:
-                            keep = False
-                        # If not explicitly tagged sans gluten and no gluten allergen, assume ok? 
-                        # Safe approach: if not tagged sans gluten, exclude. But let's be lenient if no allergens.
-                        if "gluten" in [a.lower() for a in dish["allergens"]]:
-                            keep = False
-
-            if keep:
-                results.append(dish)
-        
+            self._index_dish(self._next_id, dish)
+            self._next_id += 1
+
+    def _index_dish(self, dish_id: int, dish: dict) -> None:
+        bit = 1 << dish_id
+        self._dishes[dish_id] = dish
+        self._ids_by_name[dish["name"].lower()] = dish_id
+        self._all_mask |= bit
+        cat = dish["category"].lower()
+        self._category_masks[cat] = self._category_masks.get(cat, 0) | bit
+        for t in dish.get("tags", []):
+            self._tag_masks[t.lower()] = self._tag_masks.get(t.lower(), 0) | bit
+        for a in dish.get("allergens", []):
+            self._allergen_masks[a.lower()] = self._allergen_masks.get(a.lower(), 0) | bit
+        bisect.insort(self._prices, (dish["price"], dish_id))
+
+    def _unindex_dish(self, dish_id: int) -> dict:
+        dish = self._dishes.pop(dish_id)
+        bit = 1 << dish_id
+        self._ids_by_name.pop(dish["name"].lower(), None)
+        self._all_mask &= ~bit
+        for masks, keys in (
+            (self._category_masks, [dish["category"]]),
+            (self._tag_masks, dish.get("tags", [])),
+            (self._allergen_masks, dish.get("allergens", [])),
+        ):
+            for key in keys:
+                key = key.lower()
+                masks[key] = masks.get(key, 0) & ~bit
+                if not masks[key]:
+                    del masks[key]
+        pos = bisect.bisect_left(self._prices, (dish["price"], dish_id))
+        if pos < len(self._prices) and self._prices[pos] == (dish["price"], dish_id):
+            del self._prices[pos]
+        return dish
+
+    # Mises à jour incrémentales
+
+    def add_dish(self, dish: dict) -> None:
+        """Ajoute un plat (nom, price, prep_time, allergens, category, tags)"""
+        if dish["name"].lower() in self._ids_by_name:
+            raise ValueError(f"Le plat '{dish['name']}' existe déjà")
+        dish.setdefault("allergens", [])
+        dish.setdefault("tags", [])
+        self.menu_data.append(dish)
+        self._index_dish(self._next_id, dish)
+        self._next_id += 1
+
+    def update_dish(self, name: str, **fields) -> dict:
+        """Modifie les champs d'un plat existant et réindexe ce plat"""
+        dish_id = self._ids_by_name.get(name.lower())
+        if dish_id is None:
+            raise KeyError(f"Plat inconnu: {name}")
+        dish = self._unindex_dish(dish_id)
+        dish.update(fields)
+        self._index_dish(dish_id, dish)
+        return dish
+
+    def remove_dish(self, name: str) -> dict:
+        dish_id = self._ids_by_name.get(name.lower())
+        if dish_id is None:
+            raise KeyError(f"Plat inconnu: {name}")
+        dish = self._unindex_dish(dish_id)
+        self.menu_data[:] = [d for d in self.menu_data if d is not dish]
+        return dish
+
+    # Requêtes
+
+    def _restriction_mask(self, dietary_restriction: str) -> int:
+        vegetarian, vegan, gluten_free = _parse_restriction(dietary_restriction)
+        mask = self._all_mask
+        if vegetarian:
+            mask &= self._tag_masks.get("vegetarien", 0) | self._tag_masks.get("vegan", 0)
+        if vegan:
+            mask &= self._tag_masks.get("vegan", 0)
+        if gluten_free:
+            # Comme avant : tag "sans gluten", ou à défaut pas d'allergène gluten déclaré
+            mask &= self._tag_masks.get("sans gluten", 0) | ~self._allergen_masks.get("gluten", 0)
+        return mask
+
+    def allergen_names(self) -> List[str]:
+        return list(self._allergen_masks)
+
+    def allergens_in(self, text: str) -> List[str]:
+        """Allergènes du catalogue cités comme mots entiers ("boeuf" ne cite pas "oeuf")"""
+        names = tuple(self._allergen_masks)
+        found = _allergen_matcher(names).find(text or "")
+        return [names[i] for i in sorted(found)]
+
+    def query(self, category: str = None, max_price: float = None, dietary_restriction: str = None,
+              exclude_allergens: List[str] = None) -> List[dict]:
+        """Retourne les plats correspondant aux filtres, dans l'ordre du catalogue"""
+        mask = self._all_mask
+        if category:
+            mask &= self._category_masks.get(category.lower(), 0)
+        if dietary_restriction:
+            mask &= self._restriction_mask(dietary_restriction)
+        for allergen in exclude_allergens or []:
+            mask &= ~self._allergen_masks.get(allergen.lower(), 0)
+        if max_price is None or not mask:
+            return [self._dishes[i] for i in _iter_bits(mask)]
+
+        cut = bisect.bisect_right(self._prices, (max_price, float("inf")))
+        if mask.bit_count() <= cut:
+            # Moins de candidats que de plats dans le budget : on vérifie leur prix directement
+            return [self._dishes[i] for i in _iter_bits(mask) if self._dishes[i]["price"] <= max_price]
+        mask &= _mask_from_ids(dish_id for _, dish_id in self._prices[:cut])
+        return [self._dishes[i] for i in _iter_bits(mask)]
+
+    def forward(self, category: str = None, max_price: float = None, dietary_restriction: str = None) -> str:
+        results = self.query(category, max_price, dietary_restriction)
+
         if not results:
             return "Aucun plat trouvé correspondant exactement aux critères. Essayez d'élargir la recherche."
         
         # Formatage lisible pour le LLM
         return json.dumps(results, ensure_ascii=False)
 
+
+def _iter_bits(mask: int):
+    """Ids des bits à 1, par ordre croissant (une seule conversion du bitset)"""
+    bits = bin(mask)[:1:-1]
+    i = bits.find("1")
+    while i != -1:
+        yield i
+        i = bits.find("1", i + 1)
+
+
+@lru_cache(maxsize=32)
+def _allergen_matcher(names: Tuple[str, ...]) -> MultiPatternMatcher:
+    return MultiPatternMatcher(names)
+
+
+def _mask_from_ids(ids) -> int:
+    ids = list(ids)
+    if not ids:
+        return 0
+    buf = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buf, "little")
+
+
+@lru_cache(maxsize=256)
+def _parse_restriction(dietary_restriction: str) -> Tuple[bool, bool, bool]:
+    """(végétarien, vegan, sans gluten) à partir du texte libre de la restriction"""
+    req = dietary_restriction.lower()
+    vegetarian = "vegetarien" in req
+    vegan = "vegan" in req
+    gluten_free = "gluten" in req and ("sans" in req or "free" in req)
+    return vegetarian, vegan, gluten_free
+
+# Solveur de combinaisons de menus
+# Remplace la recherche par essais/erreurs de l'agent (menu_db + calculate sur plusieurs
+# étapes) par un seul appel : branch-and-bound sur les convives, avec élagage par le
+# budget restant et par la meilleure solution k-ième trouvée.
+
+def _k_pareto(options: List[tuple], k: int) -> List[tuple]:
+    """Garde les options (prix, objectif, ...) dominées (<= sur les deux) par moins de k autres.
+
+    Une option dominée par k autres ne peut figurer dans aucun top-k : on peut la remplacer
+    par chacune d'elles sans dépasser le budget ni dégrader l'objectif.
+    """
+    kept = []
+    seen_objectives: List[float] = []
+    for opt in sorted(options, key=lambda o: (o[0], o[1])):
+        if bisect.bisect_right(seen_objectives, opt[1]) < k:
+            kept.append(opt)
+        bisect.insort(seen_objectives, opt[1])
+    return kept
+
+
+class MenuSolverTool(Tool):
+    name = "menu_solver"
+    description = (
+        "Trouve en un seul appel les meilleures combinaisons de plats pour un groupe : "
+        "une restriction par convive, les services demandés et un budget total. "
+        "Retourne les top-k menus faisables classés par prix total ou par temps de préparation."
+    )
+    inputs = {
+        "guests": {
+            "type": "array",
+            "description": "Une restriction par convive, ex: ['vegetarien', 'sans gluten', ''] ('' = mange de tout). Les allergènes cités ('sans lait', 'allergie oeuf') sont exclus.",
+        },
+        "courses": {
+            "type": "array",
+            "description": "Formules possibles pour chaque convive, catégories séparées par '+', ex: ['Entrée+Plat', 'Plat+Dessert'] ou ['Entrée+Plat+Dessert'].",
+        },
+        "total_budget": {
+            "type": "number",
+            "description": "Budget total du groupe en euros.",
+        },
+        "top_k": {
+            "type": "integer",
+            "description": "Nombre de menus à retourner (défaut 3).",
+            "nullable": True
+        },
+        "rank_by": {
+            "type": "string",
+            "description": "'price' (défaut) ou 'prep_time' pour classer les menus.",
+            "nullable": True
+        }
+    }
+    output_type = "string"
+
+    def __init__(self, menu_tool: MenuDatabaseTool = None, max_candidates_per_course: Optional[int] = None):
+        super().__init__()
+        self.menu_tool = menu_tool if menu_tool is not None else MenuDatabaseTool()
+        # Plafond optionnel de plats candidats par service et par convive. Par défaut aucun :
+        # l'ensemble k-Pareto est déjà exact, le couper peut écarter la combinaison optimale
+        self.max_candidates_per_course = max_candidates_per_course
+
+    def _guest_options(self, restriction: str, formulas: List[List[str]], rank_by: str, k: int) -> List[tuple]:
+        """Menus possibles pour un convive : (prix, objectif, formule, plats)"""
+        restriction = restriction or ""
+        excluded = [a for a in self.menu_tool.allergens_in(restriction) if a != "gluten"]
+        options = []
+        for formula in formulas:
+            per_course = []
+            for category in formula:
+                dishes = self.menu_tool.query(category, dietary_restriction=restriction or None,
+                                              exclude_allergens=excluded)
+                scored = [(d["price"], d[rank_by], d) for d in dishes]
+                scored = _k_pareto(scored, k)
+                if self.max_candidates_per_course is not None:
+                    scored = scored[:self.max_candidates_per_course]
+                if not scored:
+                    per_course = None
+                    break
+                per_course.append(scored)
+            if per_course is None:
+                continue
+            for combo in itertools.product(*per_course):
+                options.append((
+                    sum(c[0] for c in combo),
+                    sum(c[1] for c in combo),
+                    "+".join(formula),
+                    [c[2] for c in combo],
+                ))
+        return sorted(_k_pareto(options, k), key=lambda o: (o[1], o[0]))
+
+    def solve(self, guests: List[str], courses: List[str], total_budget: float,
+              top_k: int = 3, rank_by: str = "price") -> List[dict]:
+        if rank_by not in ("price", "prep_time"):
+            raise ValueError("rank_by doit valoir 'price' ou 'prep_time'")
+        formulas = [[c.strip() for c in str(f).split("+") if c.strip()] for f in courses]
+        formulas = [f for f in formulas if f]
+        if not guests or not formulas:
+            return []
+
+        per_guest = [self._guest_options(g, formulas, rank_by, top_k) for g in guests]
+        if any(not opts for opts in per_guest):
+            return []
+
+        # Bornes inférieures (prix, objectif) de ce qu'il reste à servir après le convive i
+        n = len(per_guest)
+        min_price_after = [0.0] * (n + 1)
+        min_obj_after = [0.0] * (n + 1)
+        for i in range(n - 1, -1, -1):
+            min_price_after[i] = min_price_after[i + 1] + min(o[0] for o in per_guest[i])
+            min_obj_after[i] = min_obj_after[i + 1] + min(o[1] for o in per_guest[i])
+
+        best: List[tuple] = []  # tas max sur l'objectif : (-objectif, -prix, compteur, choix)
+        counter = itertools.count()
+
+        def _search(i: int, price: float, objective: float, chosen: list) -> None:
+            if i == n:
+                entry = (-objective, -price, next(counter), list(chosen))
+                if len(best) < top_k:
+                    heapq.heappush(best, entry)
+                elif entry[:2] > best[0][:2]:
+                    heapq.heapreplace(best, entry)
+                return
+            for opt in per_guest[i]:
+                new_obj = objective + opt[1]
+                # Options triées par objectif : au-delà, aucune ne peut entrer dans le top-k
+                if len(best) == top_k and new_obj + min_obj_after[i + 1] > -best[0][0]:
+                    break
+                if price + opt[0] + min_price_after[i + 1] > total_budget:
+                    continue
+                chosen.append(opt)
+                _search(i + 1, price + opt[0], new_obj, chosen)
+                chosen.pop()
+
+        _search(0, 0, 0, [])
+
+        menus = []
+        for neg_obj, neg_price, _, chosen in sorted(best, key=lambda e: (-e[0], -e[1])):
+            menus.append({
+                "total_price": -neg_price,
+                "total_prep_time": sum(d["prep_time"] for opt in chosen for d in opt[3]),
+                "guests": [
+                    {
+                        "restriction": guests[i] or "aucune",
+                        "formula": opt[2],
+                        "dishes": [{"name": d["name"], "category": d["category"], "price": d["price"], "prep_time": d["prep_time"]} for d in opt[3]],
+                    }
+                    for i, opt in enumerate(chosen)
+                ],
+            })
+        return menus
+
+    def forward(self, guests: list, courses: list, total_budget: float, top_k: int = None, rank_by: str = None) -> str:
+        try:
+            menus = self.solve(guests, courses, total_budget, top_k=top_k or 3, rank_by=rank_by or "price")
+        except ValueError as e:
+            return f"Erreur: {e}"
+        if not menus:
+            return "Aucune combinaison ne respecte les restrictions et le budget. Essayez d'augmenter le budget ou de changer de formule."
+        return json.dumps(menus, ensure_ascii=False)
+
+
+# Évaluateur arithmétique sûr pour calculate
+# L'expression est analysée (ast) puis compilée en fermetures Python, avec une liste
+# blanche de noeuds et d'opérateurs. Les opérandes, exposants et listes sont bornés
+# pour qu'aucun calcul ne puisse bloquer un worker ; les expressions compilées sont
+# gardées dans un cache LRU.
+
+_MAX_EXPRESSION_LENGTH = 2000
+_MAX_NODES = 500
+_MAX_MAGNITUDE = 1e15
+_MAX_EXPONENT = 64
+_MAX_LIST_LENGTH = 10000
+
+_BIN_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+_UNARY_OPS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("opérande numérique attendu")
+    if value != value or abs(value) > _MAX_MAGNITUDE:
+        raise ValueError(f"valeur hors bornes (max {_MAX_MAGNITUDE:g})")
+    return value
+
+
+def _numbers(args) -> list:
+    # f(1, 2, 3) ou f([1, 2, 3])
+    if len(args) == 1 and isinstance(args[0], list):
+        args = args[0]
+    return [_number(a) for a in args]
+
+
+def _pow(base, exponent):
+    if abs(exponent) > _MAX_EXPONENT:
+        raise ValueError(f"exposant trop grand (max {_MAX_EXPONENT})")
+    return base ** exponent
+
+
+def _sumproduct(prices, quantities):
+    if not isinstance(prices, list) or not isinstance(quantities, list) or len(prices) != len(quantities):
+        raise ValueError("sumproduct attend deux listes de même longueur")
+    return _number(sum(_number(p) * _number(q) for p, q in zip(prices, quantities)))
+
+
+def _round(value, ndigits=None):
+    if ndigits is None:
+        return round(_number(value))
+    if abs(_number(ndigits)) > 10:
+        raise ValueError("round: 10 décimales au plus")
+    return round(_number(value), int(ndigits))
+
+
+_FUNCTIONS = {
+    "sum": lambda *args: _number(sum(_numbers(args))),
+    "min": lambda *args: min(_numbers(args)),
+    "max": lambda *args: max(_numbers(args)),
+    "abs": lambda value: abs(_number(value)),
+    "round": _round,
+    "sumproduct": _sumproduct,
+}
+
+
+def _compile_node(node):
+    if isinstance(node, ast.Constant):
+        value = _number(node.value)
+        return lambda: value
+    if isinstance(node, ast.BinOp):
+        left, right = _compile_node(node.left), _compile_node(node.right)
+        if isinstance(node.op, ast.Pow):
+            return lambda: _number(_pow(_number(left()), _number(right())))
+        op = _BIN_OPS.get(type(node.op))
+        if op is None:
+            raise ValueError(f"opérateur non autorisé: {type(node.op).__name__}")
+        return lambda: _number(op(_number(left()), _number(right())))
+    if isinstance(node, ast.UnaryOp):
+        op = _UNARY_OPS.get(type(node.op))
+        if op is None:
+            raise ValueError(f"opérateur non autorisé: {type(node.op).__name__}")
+        operand = _compile_node(node.operand)
+        return lambda: op(_number(operand()))
+    if isinstance(node, (ast.List, ast.Tuple)):
+        if len(node.elts) > _MAX_LIST_LENGTH:
+            raise ValueError(f"liste trop longue (max {_MAX_LIST_LENGTH})")
+        elements = [_compile_node(e) for e in node.elts]
+        return lambda: [e() for e in elements]
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS or node.keywords:
+            raise ValueError(f"fonction non autorisée (autorisées: {', '.join(_FUNCTIONS)})")
+        func = _FUNCTIONS[node.func.id]
+        args = [_compile_node(a) for a in node.args]
+        return lambda: func(*[a() for a in args])
+    raise ValueError(f"élément non autorisé: {type(node).__name__}")
+
+
+@lru_cache(maxsize=1024)
+def _compile_expression(expression: str):
+    if len(expression) > _MAX_EXPRESSION_LENGTH:
+        raise ValueError(f"expression trop longue (max {_MAX_EXPRESSION_LENGTH} caractères)")
+    tree = ast.parse(expression.replace("×", "*").replace("÷", "/"), mode="eval")
+    if sum(1 for _ in ast.walk(tree)) > _MAX_NODES:
+        raise ValueError(f"expression trop complexe (max {_MAX_NODES} noeuds)")
+    return _compile_node(tree.body)
+
+
+def evaluate_expression(expression: str):
+    """Évalue une expression arithmétique bornée (ValueError si non autorisée ou hors bornes)"""
+    result = _compile_expression(expression.strip())()
+    if isinstance(result, list):
+        raise ValueError("le résultat doit être un nombre (utilisez sum(...) pour une liste)")
+    return result
+
+
 @tool
 def calculate(expression: str) -> str:
     """
     Calcule le résultat d'une expression mathématique simple. Utile pour additionner les prix.
+    Opérateurs + - * / // % ** et fonctions sum, min, max, abs, round, sumproduct.
     Args:
-        expression: L'expression mathématique (ex: '20 + 15 + 8').
+        expression: L'expression mathématique (ex: '20 + 15 + 8', 'sum([12, 20, 8])' ou 'sumproduct([12, 20], [2, 1])' pour prix × quantités).
     """
     try:
-        # Restriction pour sécurité basique
-        allowed_chars = "0123456789+-*/(). "
-        if not all(c in allowed_chars for c in expression):
-            return "Erreur: Caractères non autorisés dans le calcul."
-        return str(eval(expression))
+        return str(evaluate_expression(expression))
     except Exception as e:
         return f"Erreur de calcul: {e}"
 
 # Main
 def main():
     # Définition du modèle
-    # Ajout d'une limite de tokens de sortie pour éviter les erreurs de quota (TPM / taille de requête)
-    # On passe max_tokens directement à LiteLLMModel pour limiter la réponse
-    model = LiteLLMModel(model_id="groq/qwen/qwen3-32b", max_tokens=5500)
+    # Limite de taille de la réponse (taille de requête) ; le débit TPM est régulé par
+    # l'ordonnanceur commun (rate_scheduler.py) que MeteredLiteLLMModel traverse
+    model = MeteredLiteLLMModel(model_id="groq/qwen/qwen3-32b", phase="restaurant_agent", max_tokens=5500)
     
     menu_tool = MenuDatabaseTool()
+    # Un seul appel au solveur remplace la recherche de combinaison par essais/erreurs
+    solver_tool = MenuSolverTool(menu_tool)
     
     # 5.2 Agent avec planification
     system_prompt = (
@@ -138,7 +544,7 @@ def main():
     print("="*50)
 
     planner_agent = CodeAgent(
-        tools=[menu_tool, calculate],
+        tools=[menu_tool, solver_tool, calculate],
         model=model,
         planning_interval=2, 
         max_steps=12,
@@ -169,7 +575,7 @@ def main():
     print("="*50)
     
     chat_agent = CodeAgent(
-        tools=[menu_tool, calculate],
+        tools=[menu_tool, solver_tool, calculate],
         model=model,
         planning_interval=2,
         max_steps=10,
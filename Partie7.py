@@ -1,43 +1,58 @@
 from dotenv import load_dotenv
 from datetime import datetime
-from groq import Groq
 from langfuse import observe, get_client, propagate_attributes, Evaluation
 from typing import List, Dict, Any
 import json
+import os
 import time
+from gateway import lazy_groq_client
+from llm import chat_completion
+from llm_cache import SAMPLING_SEED
+from context_budget import RollingContext, estimate_tokens, truncate_to_tokens
+from metering import metered
+from model_cascade import run_cascade, validate_menu, validate_plan
+from rate_scheduler import priority
+from similarity_cache import get_plan_cache
+from structured_output import (
+    EVENT_MENU_SCHEMA, PLAN_SCHEMA, JSONRepairError, coerce_object, coerce_plan, coerce_scores, complete_json,
+    get_parse_stats, judge_schema,
+)
+from trace_export import schedule_flush
 
 load_dotenv()
 
-groq_client = Groq()
+groq_client = lazy_groq_client()   # pool HTTP commun (gateway.py)
 client = get_client()
 
 
+MULTIAGENT_SCENARIOS = [
+    {
+        "input": {"constraints": "Dîner simple pour 2 personnes : entrée, plat, dessert. Pas d'allergies."},
+        "expected_output": {"must_respect": [], "expected_services": 3, "max_budget": 40},
+        "metadata": {"difficulty": "facile"},
+    },
+    {
+        "input": {"constraints": "Repas pour 4 personnes, 1 invité allergique aux noix. Entrée+plat+dessert."},
+        "expected_output": {"must_respect": ["noix"], "expected_services": 3, "max_budget": 80},
+        "metadata": {"difficulty": "moyen"},
+    },
+    {
+        "input": {"constraints": "Dîner pour 6 personnes : 2 végétariens, 1 intolérant au gluten, budget limité."},
+        "expected_output": {"must_respect": ["sans gluten", "options végétariennes"], "expected_services": 4, "max_budget": 120},
+        "metadata": {"difficulty": "difficile"},
+    },
+    {
+        "input": {"constraints": "Événement 12 personnes : contraintes culturelles (halal), allergies (fruits à coque), budget serré."},
+        "expected_output": {"must_respect": ["halal", "pas de fruits à coque"], "expected_services": 4, "max_budget": 360},
+        "metadata": {"difficulty": "extreme"},
+    },
+]
+
+
 @observe(name="Quentin & Arthur - Partie 7")
 def create_multiagent_dataset():
     name = "chefbot-multiagent-eval_quentin-arthur"
-
-    scenarios = [
-        {
-            "input": {"constraints": "Dîner simple pour 2 personnes : entrée, plat, dessert. Pas d'allergies."},
-            "expected_output": {"must_respect": [], "expected_services": 3, "max_budget": 40},
-            "metadata": {"difficulty": "facile"},
-        },
-        {
-            "input": {"constraints": "Repas pour 4 personnes, 1 invité allergique aux noix. Entrée+plat+dessert."},
-            "expected_output": {"must_respect": ["noix"], "expected_services": 3, "max_budget": 80},
-            "metadata": {"difficulty": "moyen"},
-        },
-        {
-            "input": {"constraints": "Dîner pour 6 personnes : 2 végétariens, 1 intolérant au gluten, budget limité."},
-            "expected_output": {"must_respect": ["sans gluten", "options végétariennes"], "expected_services": 4, "max_budget": 120},
-            "metadata": {"difficulty": "difficile"},
-        },
-        {
-            "input": {"constraints": "Événement 12 personnes : contraintes culturelles (halal), allergies (fruits à coque), budget serré."},
-            "expected_output": {"must_respect": ["halal", "pas de fruits à coque"], "expected_services": 4, "max_budget": 360},
-            "metadata": {"difficulty": "extreme"},
-        },
-    ]
+    scenarios = MULTIAGENT_SCENARIOS
 
     try:
         with propagate_attributes(tags=["Quentin & Arthur", "Partie 7"]):
@@ -59,6 +74,9 @@ def create_multiagent_dataset():
     return ds
 
 
+MULTIAGENT_JUDGE_CRITERIA = ["respect_contraintes", "completude", "budget", "coherence", "faisabilite"]
+
+
 @observe(name="Quentin & Arthur - Partie 7")
 def llm_judge_multiagent(question: str, output: str, expected: Dict[str, Any], judge_model: str = "meta-llama/llama-4-scout-17b-16e-instruct") -> Dict[str, Any]:
     prompt = (
@@ -74,32 +92,23 @@ def llm_judge_multiagent(question: str, output: str, expected: Dict[str, Any], j
         f"Sortie du système (menu): {output}\n"
     )
 
-    response = groq_client.chat.completions.create(
-        model=judge_model,
-        messages=[
-            {"role": "system", "content": "Tu es un évaluateur objectif qui ne répond qu'en JSON."},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=0.0,
-    )
-
-    text = response.choices[0].message.content
     try:
-        result = json.loads(text)
-    except Exception:
-        try:
-            start = text.index("{")
-            end = text.rindex("}") + 1
-            result = json.loads(text[start:end])
-        except Exception as e:
-            result = {
-                "respect_contraintes": 0.0,
-                "completude": 0.0,
-                "budget": 0.0,
-                "coherence": 0.0,
-                "faisabilite": 0.0,
-                "comment": f"parse_error: {e}",
-            }
+        result = complete_json(
+            groq_client,
+            kind="judge",
+            schema=judge_schema(MULTIAGENT_JUDGE_CRITERIA),
+            coerce=coerce_scores(MULTIAGENT_JUDGE_CRITERIA),
+            phase="judge",
+            model=judge_model,
+            messages=[
+                {"role": "system", "content": "Tu es un évaluateur objectif qui ne répond qu'en JSON."},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=0.0,
+        )
+    except JSONRepairError as e:
+        result = {name: 0.0 for name in MULTIAGENT_JUDGE_CRITERIA}
+        result["comment"] = f"parse_error: {e}"
 
     return result
 
@@ -111,8 +120,23 @@ def _safe_json_dumps(obj):
         return str(obj)
 
 
+def _item_input(item) -> Dict[str, Any]:
+    # Items Langfuse (attribut input) ou items locaux (dict)
+    if isinstance(item, dict):
+        return item.get("input") or {}
+    return getattr(item, "input", None) or {}
+
+
 @observe(name="Quentin & Arthur - Partie 7")
-def generate_menu_three_step(constraints: str, model_name: str) -> Dict[str, Any]:
+@metered("generate_menu_three_step")
+def generate_menu_three_step(constraints: str, model_name: str, keep_recent: int = None,
+                             max_step_tokens: int = None, cascade: bool = None) -> Dict[str, Any]:
+    # cascade=False force model_name à chaque appel (comparaison de modèles) ; None suit CHEFBOT_CASCADE
+    if keep_recent is None:
+        keep_recent = int(os.getenv("CHEFBOT_ROLLING_KEEP", "2"))
+    if max_step_tokens is None:
+        max_step_tokens = int(os.getenv("CHEFBOT_STEP_MAX_TOKENS", "1500"))
+
     # Reprend le pattern du plan -> exécution -> synthèse en 3 appels
     try:
         with propagate_attributes(tags=["Quentin & Arthur", "Partie 7"], ):
@@ -121,75 +145,113 @@ def generate_menu_three_step(constraints: str, model_name: str) -> Dict[str, Any
         pass
 
     def _plan():
+        # Des contraintes proches (formulation, nombres) réutilisent un plan déjà calculé pour ce modèle
+        plan_cache = get_plan_cache()
+        partition = f"generate_menu_three_step:{model_name}"
+        if plan_cache is not None:
+            cached, similarity, kind = plan_cache.lookup(constraints, partition=partition)
+            plan_cache_info.update(plan_cache=kind or "miss", plan_similarity=round(similarity, 3))
+            if cached is not None:
+                # Plan en cache : les étapes gardent model_name
+                return cached
+
         prompt = (
-            "Décompose la tâche de création d'un menu en 3 à 6 étapes claires (format JSON list of {step,title,instruction}).\n"
+            "Décompose la tâche de création d'un menu en 3 à 6 étapes claires (format JSON {\"steps\": [{step,title,instruction}, ...]}).\n"
             f"Contrainte: {constraints}"
         )
-        resp = groq_client.chat.completions.create(model=model_name, messages=[{"role": "user", "content": prompt}], temperature=0.2)
-        text = resp.choices[0].message.content
+        def _attempt(model, last):
+            return complete_json(
+                groq_client, kind="plan", schema=PLAN_SCHEMA, coerce=coerce_plan, expect="array", max_attempts=2 if last else 1,
+                phase="plan", model=model, messages=[{"role": "user", "content": prompt}], temperature=0.2,
+                seed=SAMPLING_SEED,
+            )
+
         try:
-            plan = json.loads(text)
-        except Exception:
-            try:
-                start = text.index('[')
-                end = text.rindex(']') + 1
-                plan = json.loads(text[start:end])
-            except Exception:
-                plan = [{"step": 1, "title": "Générer menu", "instruction": "Proposer un menu complet"}]
+            plan, step_model["model"] = run_cascade("generate_menu_three_step/plan", model_name, constraints, _attempt,
+                                                    lambda p: validate_plan(p, 3, 6), enabled=cascade)
+        except JSONRepairError:
+            # Plan de secours : jamais mis en cache
+            return [{"step": 1, "title": "Générer menu", "instruction": "Proposer un menu complet"}]
+        if plan_cache is not None:
+            plan_cache.store(constraints, plan, partition=partition)
         return plan
 
-    def _execute_step(step, context_text):
-        prompt = f"Exécute l'étape '{step.get('title')}'. Instruction: {step.get('instruction')}. Contexte: {context_text}"
-        resp = groq_client.chat.completions.create(model=model_name, messages=[{"role": "user", "content": prompt}], temperature=0.5)
+    def _capped_prompt(template, context, max_tokens, **render_options):
+        # Plafond dur sur le prompt complet : le contexte n'a droit qu'à ce que laisse le
+        # gabarit (titre, instruction, format attendu) ; un gabarit trop long est lui-même coupé
+        context_text = context.render(max_tokens=max_tokens - estimate_tokens(template), **render_options)
+        return truncate_to_tokens(template + context_text, max_tokens)
+
+    def _execute_step(step, context):
+        template = f"Exécute l'étape '{step.get('title')}'. Instruction: {step.get('instruction')}. Contexte: "
+        prompt = _capped_prompt(template, context, max_step_tokens)
+        prompt_tokens.append(estimate_tokens(prompt))
+        resp = chat_completion(groq_client, phase="execute", model=step_model["model"], messages=[{"role": "user", "content": prompt}], temperature=0.5,
+                               seed=SAMPLING_SEED)
         return resp.choices[0].message.content
 
-    def _synthesize(results):
-        prompt = (
+    def _synthesize(context):
+        template = (
             "A partir des résultats ci-dessous, fournis un menu hebdomadaire ou un menu pour l'événement au format JSON valide.\n"
             "Format attendu: {\"services\": [\"entrée\", \"plat\", \"dessert\"], \"menu\": {...}}\n"
             "Réponds STRICTEMENT en JSON.\n"
-            f"Résultats: {json.dumps(results, ensure_ascii=False)}"
+            "Résultats: "
         )
-        resp = groq_client.chat.completions.create(model=model_name, messages=[{"role": "user", "content": prompt}], temperature=0.3)
-        text = resp.choices[0].message.content
+        # La synthèse voit les faits de toutes les étapes et la dernière sortie en entier
+        prompt = _capped_prompt(template, context, 2 * max_step_tokens, keep_recent=1)
+        prompt_tokens.append(estimate_tokens(prompt))
+        def _attempt(model, last):
+            return complete_json(
+                groq_client, kind="event_menu", schema=EVENT_MENU_SCHEMA, coerce=coerce_object, max_attempts=2 if last else 1,
+                phase="synthesize", model=model, messages=[{"role": "user", "content": prompt}], temperature=0.3,
+                seed=SAMPLING_SEED,
+            )
+
         try:
-            menu = json.loads(text)
-        except Exception:
-            try:
-                start = text.index('{')
-                end = text.rindex('}') + 1
-                menu = json.loads(text[start:end])
-            except Exception:
-                menu = {"menu_text": text}
+            menu, _ = run_cascade("generate_menu_three_step/synthesize", model_name, constraints, _attempt,
+                                  lambda m: validate_menu(m, EVENT_MENU_SCHEMA, constraints), enabled=cascade)
+        except JSONRepairError as e:
+            menu = {"menu_text": e.text or str(e)}
         return menu
 
+    # Contexte glissant : les keep_recent dernières sorties verbatim, les plus anciennes
+    # réduites à leurs faits (plats, prix, allergènes), plafond de tokens par prompt d'étape
+    plan_cache_info: Dict[str, Any] = {}
+    step_model = {"model": model_name}   # modèle qui a produit le plan, repris pour les étapes
     plan = _plan()
-    results = []
-    context_text = f"constraints: {constraints}"
+    prompt_tokens: List[int] = []
+    context = RollingContext(f"constraints: {constraints}", keep_recent=keep_recent, max_tokens=max_step_tokens)
     for step in plan:
-        out = _execute_step(step, context_text)
-        results.append({"step": step, "output": out})
-        context_text += "\n" + out
+        out = _execute_step(step, context)
+        context.add(str(step.get("title", "Étape")), out)
 
-    menu = _synthesize(results)
+    menu = _synthesize(context)
 
     try:
-        client.flush()
+        client.update_current_observation(
+            metadata={"prompt_tokens_per_call": prompt_tokens, "keep_recent": keep_recent, "max_step_tokens": max_step_tokens,
+                      **plan_cache_info}
+        )
     except Exception:
         pass
 
+    schedule_flush()
+
     return menu
 
 
 @observe(name="Quentin & Arthur - Partie 7")
-def run_partie7_comparison(models: List[str] = None):
+@metered("run_partie7_comparison")
+def run_partie7_comparison(models: List[str] = None, dataset=None):
     if models is None:
         models = [
             "meta-llama/llama-3.3-70b-versatile",
             "meta-llama/llama-4-scout-17b-16e-instruct",
         ]
 
-    dataset = create_multiagent_dataset()
+    # dataset peut être fourni (ex: items locaux pour le benchmark hors ligne)
+    if dataset is None:
+        dataset = create_multiagent_dataset()
 
     comparison_results = {}
 
@@ -200,17 +262,22 @@ def run_partie7_comparison(models: List[str] = None):
         except Exception:
             pass
 
+        # Évaluation : priorité batch dans l'ordonnanceur de débit (posée dans la tâche,
+        # run_experiment pouvant l'exécuter hors du contexte courant)
         def task(*, item):
-            constraints = item.input.get("constraints")
-            menu = generate_menu_three_step(constraints, model_name)
+            constraints = _item_input(item).get("constraints")
+            with priority("batch"):
+                # Sans cascade : chaque modèle comparé répond lui-même à toutes les étapes
+                menu = generate_menu_three_step(constraints, model_name, cascade=False)
             return _safe_json_dumps(menu)
 
         def evaluator_llm(**kwargs):
             item = kwargs.get("item")
-            question = item.input.get("constraints") if item and hasattr(item, "input") else kwargs.get("input", {}).get("constraints")
+            question = _item_input(item).get("constraints") if item else kwargs.get("input", {}).get("constraints")
             output = kwargs.get("output")
             expected = kwargs.get("expected_output")
-            scores = llm_judge_multiagent(question, output, expected)
+            with priority("batch"):
+                scores = llm_judge_multiagent(question, output, expected)
             return [
                 Evaluation(name="respect_contraintes", value=scores.get("respect_contraintes", 0.0)),
                 Evaluation(name="completude", value=scores.get("completude", 0.0)),
@@ -252,7 +319,6 @@ def run_partie7_comparison(models: List[str] = None):
         try:
             client.update_current_trace(metadata={"comparison_summary": agg, "model": model_name})
             client.log(message=f"Partie 7 - résumé pour {model_name}: {agg}", level="INFO")
-            client.flush()
         except Exception:
             pass
 
@@ -273,10 +339,17 @@ def run_partie7_comparison(models: List[str] = None):
         try:
             client.update_current_trace(metadata={"partie7_analysis": analysis})
             client.log(message=analysis, level="INFO")
-            client.flush()
         except Exception:
             pass
 
+    try:
+        client.update_current_trace(metadata={"structured_output": get_parse_stats().get_stats()})
+    except Exception:
+        pass
+
+    # Un seul export pour toute la comparaison, en arrière-plan
+    schedule_flush()
+
     return comparison_results
 
 
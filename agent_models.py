@@ -0,0 +1,58 @@
+import time
+from typing import Optional
+
+from smolagents import LiteLLMModel
+
+from gateway import get_litellm_client
+from metering import get_meter
+from rate_scheduler import get_scheduler
+
+# Modèles smolagents instrumentés
+# Les agents smolagents appellent Groq via LiteLLM, hors de chat_completion : ce modèle
+# relève l'usage (ChatMessage.token_usage) et la latence de chaque génération dans le
+# compteur commun, avec la phase de l'agent (manager, nutritionist, chef_agent...). Les
+# générations passent par l'ordonnanceur de débit commun (rate_scheduler.py) et par le
+# pool HTTP commun (gateway.py) : créer un modèle n'ouvre pas de nouvelle connexion.
+# Le retryer de smolagents est coupé (retry=False) : l'ordonnanceur gère seul les 429.
+
+
+def _plain_messages(messages) -> list:
+    # ChatMessage smolagents ou dicts, contenu texte ou liste de blocs {"type": "text", ...} :
+    # seul le texte compte pour l'estimation des tokens
+    plain = []
+    for m in messages:
+        if not isinstance(m, dict):
+            m = m.dict() if hasattr(m, "dict") else {"content": str(m)}
+        content = m.get("content")
+        if isinstance(content, list):
+            content = " ".join(str(block.get("text", "")) for block in content if isinstance(block, dict))
+        plain.append({"role": str(m.get("role", "")), "content": content if isinstance(content, str) else str(content or "")})
+    return plain
+
+
+class MeteredLiteLLMModel(LiteLLMModel):
+    """LiteLLMModel qui passe par l'ordonnanceur de débit et enregistre tokens et latence de chaque appel"""
+
+    def __init__(self, model_id: Optional[str] = None, phase: Optional[str] = None, **kwargs):
+        kwargs.setdefault("client", get_litellm_client())
+        kwargs.setdefault("retry", False)
+        super().__init__(model_id=model_id, **kwargs)
+        self.phase = phase
+
+    def generate(self, messages, stop_sequences=None, response_format=None, tools_to_call_from=None, **kwargs):
+        start = time.perf_counter()
+        params = {"messages": _plain_messages(messages), "max_tokens": self.kwargs.get("max_tokens")}
+        message = get_scheduler().call(
+            self.model_id,
+            params,
+            lambda: super(MeteredLiteLLMModel, self).generate(
+                messages,
+                stop_sequences=stop_sequences,
+                response_format=response_format,
+                tools_to_call_from=tools_to_call_from,
+                **kwargs,
+            ),
+            usage_of=lambda m: m.token_usage,
+        )
+        get_meter().record(self.model_id, message.token_usage, time.perf_counter() - start, phase=self.phase)
+        return message
@@ -0,0 +1,290 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from langfuse import get_client
+
+from hedging import LatencyWindow
+
+# Pool d'agents smolagents préconstruits
+# Construire un graphe d'agents (manager + nutritionist, chef_agent, budget_agent, leurs
+# modèles, outils et index du menu) coûte plus cher que beaucoup de requêtes elles-mêmes.
+# Le pool garde des graphes prêts : une requête en emprunte un, l'utilise seule, puis le
+# rend. Au retour, chaque agent du graphe est remis à zéro (mémoire, variables de
+# l'exécuteur Python, fonctions qu'il a définies, état) et vérifié ; un graphe en mauvais état ou trop utilisé est
+# jeté et reconstruit. Le prompt système de chaque agent n'est rendu qu'une fois par
+# graphe. Les statistiques donnent le temps de construction économisé et l'attente.
+
+
+def iter_agents(agent: Any) -> Iterator[Any]:
+    """L'agent puis, récursivement, ses agents gérés"""
+    yield agent
+    for managed in (getattr(agent, "managed_agents", None) or {}).values():
+        yield from iter_agents(managed)
+
+
+def memoize_system_prompt(agent: Any) -> None:
+    # system_prompt est une propriété recalculée (templates Jinja) à chaque run ; outils et
+    # agents gérés ne changent pas pendant la vie d'un graphe du pool
+    for a in iter_agents(agent):
+        if hasattr(a, "initialize_system_prompt"):
+            prompt = a.initialize_system_prompt()
+            a.initialize_system_prompt = lambda prompt=prompt: prompt
+
+
+def reset_agent(agent: Any) -> None:
+    """Efface tout ce qu'une requête a laissé dans le graphe"""
+    for a in iter_agents(agent):
+        a.memory.reset()
+        a.monitor.reset()
+        a.state.clear()
+        a.task = None
+        a.step_number = 0
+        a.interrupt_switch = False
+        executor = getattr(a, "python_executor", None)
+        if executor is None:
+            continue
+        if isinstance(getattr(executor, "state", None), dict):
+            # Variables définies par le code généré lors de la requête précédente
+            executor.state.clear()
+            executor.state["__name__"] = "__main__"
+        if isinstance(getattr(executor, "custom_tools", None), dict):
+            # Fonctions définies (def ...) par ce code : elles survivent à state
+            executor.custom_tools.clear()
+
+
+def _executor_clean(agent: Any) -> bool:
+    executor = getattr(agent, "python_executor", None)
+    if executor is None:
+        return True
+    state = getattr(executor, "state", None) or {}
+    return not getattr(executor, "custom_tools", None) and set(state) <= {"__name__"}
+
+
+def check_agent(agent: Any, expected_agents: List[str]) -> bool:
+    """Graphe complet (mêmes agents gérés qu'à la construction), modèles en place, mémoire et
+    exécuteur Python vides"""
+    agents = list(iter_agents(agent))
+    if sorted(getattr(a, "name", "") or "" for a in agents[1:]) != expected_agents:
+        return False
+    return all(getattr(a, "model", None) is not None and not a.memory.steps and _executor_clean(a) for a in agents)
+
+
+class _Entry:
+    __slots__ = ("agent", "uses", "expected")
+
+    def __init__(self, agent: Any):
+        self.agent = agent
+        self.uses = 0
+        self.expected = sorted(getattr(a, "name", "") or "" for a in list(iter_agents(agent))[1:])
+
+
+class AgentPool:
+    """Graphes d'agents réutilisables, au plus size construits à la fois"""
+
+    def __init__(self, name: str, factory: Callable[[], Any], size: int = 4, max_uses: int = 100,
+                 timeout: float = 30.0):
+        self.name = name
+        self.factory = factory
+        self.size = size
+        self.max_uses = max_uses
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._idle: deque = deque()
+        self._total = 0         # graphes du pool, au repos ou empruntés
+        self._building = 0
+        self._wait_times = LatencyWindow()
+        self.stats = {"checkouts": 0, "reused": 0, "built": 0, "overflow": 0, "waits": 0,
+                      "health_failures": 0, "recycled": 0, "build_ms_total": 0.0, "wait_ms_total": 0.0}
+
+    def _build(self) -> _Entry:
+        start = time.perf_counter()
+        agent = self.factory()
+        memoize_system_prompt(agent)
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self.stats["built"] += 1
+            self.stats["build_ms_total"] += elapsed * 1000
+        return _Entry(agent)
+
+    def warm(self, count: Optional[int] = None) -> None:
+        """Construit d'avance jusqu'à count graphes (défaut : size)"""
+        target = min(self.size, self.size if count is None else count)
+        while True:
+            with self._cond:
+                if self._total >= target:
+                    return
+                self._total += 1
+                self._building += 1
+            try:
+                entry = self._build()
+            except Exception:
+                with self._cond:
+                    self._total -= 1
+                    self._building -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._building -= 1
+                self._idle.append(entry)
+                self._cond.notify()
+
+    def warm_in_background(self, count: Optional[int] = None) -> threading.Thread:
+        thread = threading.Thread(target=self._warm_quietly, args=(count,), name=f"warm-{self.name}", daemon=True)
+        thread.start()
+        return thread
+
+    def _warm_quietly(self, count: Optional[int]) -> None:
+        try:
+            self.warm(count)
+        except Exception:
+            pass
+
+    def _acquire(self) -> tuple:
+        """(entrée, graphe déjà construit, attente en s, hors pool)"""
+        start = time.perf_counter()
+        deadline = start + self.timeout
+        entry = None
+        waited = overflow = False
+        with self._cond:
+            self.stats["checkouts"] += 1
+            while True:
+                if self._idle:
+                    entry = self._idle.popleft()
+                    self.stats["reused"] += 1
+                    break
+                if self._total < self.size:
+                    self._total += 1
+                    break
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    # Pool saturé trop longtemps : graphe temporaire, jeté au retour
+                    self.stats["overflow"] += 1
+                    overflow = True
+                    break
+                waited = True
+                self._cond.wait(remaining)
+        wait = time.perf_counter() - start if waited else 0.0
+        if waited:
+            self._wait_times.add(wait)
+            with self._cond:
+                self.stats["waits"] += 1
+                self.stats["wait_ms_total"] += wait * 1000
+
+        reused = entry is not None
+        if entry is None:
+            try:
+                entry = self._build()
+            except Exception:
+                if not overflow:
+                    with self._cond:
+                        self._total -= 1
+                        self._cond.notify()
+                raise
+        return entry, reused, wait, overflow
+
+    def _release(self, entry: _Entry, overflow: bool) -> None:
+        if overflow:
+            return
+        entry.uses += 1
+        healthy = False
+        try:
+            reset_agent(entry.agent)
+            healthy = check_agent(entry.agent, entry.expected)
+        except Exception:
+            pass
+        with self._cond:
+            if not healthy:
+                self.stats["health_failures"] += 1
+            elif entry.uses >= self.max_uses:
+                self.stats["recycled"] += 1
+            else:
+                self._idle.append(entry)
+                self._cond.notify()
+                return
+            # Place libérée : le prochain emprunt reconstruira un graphe neuf
+            self._total -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def checkout(self) -> Iterator[Any]:
+        """Emprunte un graphe pour la durée du bloc (aucune autre requête ne l'utilise)"""
+        entry, reused, wait, overflow = self._acquire()
+        try:
+            get_client().update_current_observation(metadata={"agent_pool": {
+                "pool": self.name, "reused": reused, "overflow": overflow, "wait_ms": round(wait * 1000, 1),
+            }})
+        except Exception:
+            pass
+        try:
+            yield entry.agent
+        finally:
+            self._release(entry, overflow)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self.stats)
+            stats.update(size=self.size, graphs=self._total, idle=len(self._idle),
+                         in_use=self._total - len(self._idle) - self._building)
+        avg_build_ms = stats["build_ms_total"] / stats["built"] if stats["built"] else 0.0
+        p95_wait = self._wait_times.percentile(0.95, 1)
+        stats["avg_build_ms"] = round(avg_build_ms, 1)
+        # Chaque emprunt servi par un graphe déjà construit évite une construction
+        stats["construction_saved_ms"] = round(stats["reused"] * avg_build_ms, 1)
+        stats["avg_wait_ms"] = round(stats["wait_ms_total"] / stats["checkouts"], 2) if stats["checkouts"] else 0.0
+        stats["p95_wait_ms"] = round(p95_wait * 1000, 1) if p95_wait is not None else 0.0
+        stats["build_ms_total"] = round(stats["build_ms_total"], 1)
+        stats["wait_ms_total"] = round(stats["wait_ms_total"], 1)
+        return stats
+
+
+_pools: Dict[str, AgentPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _enabled() -> bool:
+    return os.getenv("CHEFBOT_AGENT_POOL", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def get_agent_pool(name: str, factory: Callable[[], Any]) -> Optional[AgentPool]:
+    """Pool partagé nommé, ou None si CHEFBOT_AGENT_POOL=0 (construction à chaque requête).
+    Réglages : CHEFBOT_AGENT_POOL_SIZE (graphes par pool, défaut 4),
+    CHEFBOT_AGENT_POOL_WARM (graphes construits d'avance en arrière-plan, défaut 1),
+    CHEFBOT_AGENT_POOL_MAX_USES (emprunts avant reconstruction, défaut 100),
+    CHEFBOT_AGENT_POOL_TIMEOUT (attente maximale en s avant un graphe hors pool, défaut 30)."""
+    if not _enabled():
+        return None
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = _pools[name] = AgentPool(
+                name,
+                factory,
+                size=int(os.getenv("CHEFBOT_AGENT_POOL_SIZE", "4")),
+                max_uses=int(os.getenv("CHEFBOT_AGENT_POOL_MAX_USES", "100")),
+                timeout=float(os.getenv("CHEFBOT_AGENT_POOL_TIMEOUT", "30")),
+            )
+            warm = int(os.getenv("CHEFBOT_AGENT_POOL_WARM", "1"))
+            if warm > 0:
+                pool.warm_in_background(warm)
+        return pool
+
+
+@contextmanager
+def checkout_agent(name: str, factory: Callable[[], Any]) -> Iterator[Any]:
+    """Graphe emprunté au pool name, ou construit pour la requête si le pool est désactivé"""
+    pool = get_agent_pool(name, factory)
+    if pool is None:
+        yield factory()
+        return
+    with pool.checkout() as agent:
+        yield agent
+
+
+def get_pool_stats() -> Dict[str, Dict[str, Any]]:
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.name: pool.get_stats() for pool in pools}
@@ -0,0 +1,231 @@
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+import mock_groq_server
+
+# Benchmark de bout en bout des points d'entrée contre le serveur Groq simulé
+# Mesure par point d'entrée : latence p50/p95, débit, et surcoût côté client
+# (temps total - temps pendant lequel le serveur simulé traitait au moins une requête).
+#
+#   python benchmark.py --iterations 20 --latency lognormal:0.05:0.3
+#   python benchmark.py --entry-points ask_chef,plan_weekly_menu --max-overhead-ms 50 --json bench.json
+
+QUESTION = "Que proposerais-tu pour un dîner de printemps avec des asperges et du saumon ?"
+CONSTRAINTS = "Menu végétarien pour 4 personnes, ingrédients de printemps, déjeuner et dîner."
+TOOL_QUESTION = "J'ai faim. Qu'est-ce que je peux cuisiner avec ce que j'ai dans mon frigo ?"
+PARTIE7_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _load_entry_points() -> Dict[str, Any]:
+    """Importe les modules après configuration de l'environnement (clients créés à l'import).
+
+    Retourne {nom: callable} ; un module non importable donne {nom: raison} pour ses points d'entrée.
+    """
+    entry_points: Dict[str, Any] = {}
+
+    try:
+        chefbot = importlib.import_module("chefbot")
+        entry_points["ask_chef"] = lambda: chefbot.ask_chef(QUESTION, "printemps", temperature=0.5)
+        entry_points["ask_chef_stream"] = lambda: "".join(chefbot.ask_chef_stream(QUESTION, "printemps"))
+        entry_points["plan_weekly_menu"] = lambda: chefbot.plan_weekly_menu(CONSTRAINTS)
+    except ImportError as e:
+        for name in ("ask_chef", "ask_chef_stream", "plan_weekly_menu"):
+            entry_points[name] = f"module indisponible: {e}"
+
+    try:
+        partie46 = importlib.import_module("Partie4-6")
+        entry_points["manual_tool_calling"] = lambda: partie46.manual_tool_calling(TOOL_QUESTION)
+    except ImportError as e:
+        entry_points["manual_tool_calling"] = f"module indisponible: {e}"
+
+    try:
+        partie7 = importlib.import_module("Partie7")
+        dataset = SimpleNamespace(items=list(partie7.MULTIAGENT_SCENARIOS[:1]))
+        entry_points["generate_menu_three_step"] = lambda: partie7.generate_menu_three_step(CONSTRAINTS, PARTIE7_MODEL)
+        entry_points["run_partie7_comparison"] = lambda: partie7.run_partie7_comparison(models=[PARTIE7_MODEL], dataset=dataset)
+    except ImportError as e:
+        for name in ("generate_menu_three_step", "run_partie7_comparison"):
+            entry_points[name] = f"module indisponible: {e}"
+
+    return entry_points
+
+
+def bench_entry_point(fn: Callable[[], Any], state: "mock_groq_server.MockState",
+                      iterations: int, concurrency: int, warmup: int) -> Dict[str, Any]:
+    for _ in range(warmup):
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+
+    # Passe séquentielle : latence et surcoût client attribuables à chaque appel
+    latencies, overheads, errors = [], [], 0
+    requests_before = state.snapshot()["requests"]
+    for _ in range(iterations):
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                fn()
+        except Exception:
+            errors += 1
+        end = time.perf_counter()
+        latencies.append(end - start)
+        overheads.append((end - start) - state.busy_time(start, end))
+    llm_calls = (state.snapshot()["requests"] - requests_before) / max(iterations, 1)
+
+    # Passe concurrente : débit
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        with contextlib.redirect_stdout(io.StringIO()):
+            futures = [pool.submit(fn) for _ in range(iterations)]
+            for f in futures:
+                try:
+                    f.result()
+                except Exception:
+                    errors += 1
+    throughput = iterations / (time.perf_counter() - start)
+
+    return {
+        "iterations": iterations,
+        "errors": errors,
+        "llm_calls_per_run": round(llm_calls, 2),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 2),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "overhead_p50_ms": round(_percentile(overheads, 50) * 1000, 2),
+        "overhead_p95_ms": round(_percentile(overheads, 95) * 1000, 2),
+        "throughput_rps": round(throughput, 2),
+        "concurrency": concurrency,
+    }
+
+
+def _print_report(report: Dict[str, Any]) -> None:
+    header = f"{'entry point':<26}{'p50 ms':>10}{'p95 ms':>10}{'ovh p50':>10}{'ovh p95':>10}{'calls':>8}{'rps':>9}{'err':>5}"
+    print(header)
+    print("-" * len(header))
+    for name, res in report["results"].items():
+        if isinstance(res, str):
+            print(f"{name:<26}  ignoré ({res})")
+            continue
+        print(
+            f"{name:<26}{res['p50_ms']:>10.1f}{res['p95_ms']:>10.1f}{res['overhead_p50_ms']:>10.2f}"
+            f"{res['overhead_p95_ms']:>10.2f}{res['llm_calls_per_run']:>8.1f}{res['throughput_rps']:>9.2f}{res['errors']:>5}"
+        )
+
+
+def run_benchmark(
+    entry_points: Optional[List[str]] = None,
+    iterations: int = 10,
+    concurrency: int = 4,
+    warmup: int = 1,
+    latency: str = "fixed:0.02",
+    token_rate: float = 5000.0,
+    rate_limit_rate: float = 0.0,
+    use_cache: bool = False,
+    rate_limits: bool = False,
+) -> Dict[str, Any]:
+    server, base_url = mock_groq_server.start_in_thread(
+        latency=latency, token_rate=token_rate, rate_limit_rate=rate_limit_rate
+    )
+    os.environ["GROQ_BASE_URL"] = base_url
+    os.environ["GROQ_API_BASE"] = base_url + "/openai/v1"  # LiteLLM (smolagents)
+    os.environ.setdefault("GROQ_API_KEY", "mock")
+    if not use_cache:
+        for name in ("CHEFBOT_CACHE", "CHEFBOT_PLAN_CACHE", "CHEFBOT_ANSWER_CACHE"):
+            os.environ[name] = "0"
+    if not rate_limits:
+        # Les limites réelles de Groq (quelques dizaines de requêtes/min) fausseraient la mesure
+        os.environ["CHEFBOT_RATE_LIMITS"] = "off"
+    logging.getLogger("langfuse").setLevel(logging.CRITICAL)
+
+    available = _load_entry_points()
+    selected = entry_points or list(available)
+    results: Dict[str, Any] = {}
+    try:
+        for name in selected:
+            fn = available.get(name, "point d'entrée inconnu")
+            if isinstance(fn, str):
+                results[name] = fn
+                continue
+            server.state.reset()
+            results[name] = bench_entry_point(fn, server.state, iterations, concurrency, warmup)
+            results[name]["rate_limited"] = server.state.snapshot()["rate_limited"]
+    finally:
+        server.shutdown()
+
+    return {
+        "config": {
+            "iterations": iterations,
+            "concurrency": concurrency,
+            "latency": latency,
+            "token_rate": token_rate,
+            "rate_limit_rate": rate_limit_rate,
+            "cache": use_cache,
+            "rate_limits": rate_limits,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hors ligne des points d'entrée ChefBot")
+    parser.add_argument("--entry-points", help="liste séparée par des virgules (défaut: tous)")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--latency", default="fixed:0.02", help="fixed:s | uniform:min:max | lognormal:median:sigma")
+    parser.add_argument("--token-rate", type=float, default=5000.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--cache", action="store_true", help="laisse actifs les caches de complétions, de plans et de réponses")
+    parser.add_argument("--rate-limits", action="store_true", help="applique les limites RPM/TPM de l'ordonnanceur")
+    parser.add_argument("--json", help="écrit le rapport JSON dans ce fichier")
+    parser.add_argument("--max-overhead-ms", type=float, help="échoue (code 1) si un surcoût p95 dépasse ce seuil")
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        entry_points=args.entry_points.split(",") if args.entry_points else None,
+        iterations=args.iterations,
+        concurrency=args.concurrency,
+        warmup=args.warmup,
+        latency=args.latency,
+        token_rate=args.token_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        use_cache=args.cache,
+        rate_limits=args.rate_limits,
+    )
+    _print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.max_overhead_ms is not None:
+        regressions = [
+            name for name, res in report["results"].items()
+            if isinstance(res, dict) and res["overhead_p95_ms"] > args.max_overhead_ms
+        ]
+        if regressions:
+            print(f"\nSurcoût p95 > {args.max_overhead_ms} ms: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,51 @@
 from dotenv import load_dotenv
 from datetime import datetime
-from groq import Groq
 from langfuse import observe, get_client, propagate_attributes, Evaluation
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, AsyncIterator
 import json
+import os
+import time
+from gateway import acomplete, lazy_groq_client
+from llm import chat_completion
+from llm_cache import SAMPLING_SEED, get_completion_cache
+from metering import meter_scope, metered
+from model_cascade import get_cascade, run_cascade, validate_answer, validate_menu, validate_plan
+from rate_scheduler import priority
+from experiment_runner import run_local_experiment
+from plan_dag import normalize_plan, run_plan_dag, critical_path_length
+from similarity_cache import get_answer_cache, get_plan_cache
+from structured_output import (
+    PLAN_SCHEMA, WEEK_MENU_SCHEMA, JSONRepairError, coerce_object, coerce_plan, coerce_scores, complete_json,
+    get_parse_stats, judge_schema,
+)
+from text_matcher import get_spec_matcher
+from trace_export import schedule_flush
 
 load_dotenv()
 
-# Initialise clients
-groq_client = Groq()
+# Initialise clients (créés au premier appel, adossés au pool HTTP commun de gateway.py)
+groq_client = lazy_groq_client()
 
 client = get_client()
 
 modele = "meta-llama/llama-4-scout-17b-16e-instruct"
 
 # Partie 1 :
-@observe(name="Quentin & Arthur")
-def ask_chef(question: str, saison : str, temperature: float = 0.5) -> str:
+CHEF_SYSTEM_PROMPT = (
+    "Tu es ChefBot, un chef cuisinier français spécialisé en cuisine de saison. "
+    "Réponds en français, propose des ingrédients de saison, techniques de cuisson, "
+    "variantes et suggestions de présentation. Sois clair, pratique et concis."
+)
+
+
+def _chef_messages(question: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": CHEF_SYSTEM_PROMPT},
+        {"role": "user", "content": question},
+    ]
 
+
+def _tag_ask_chef_trace(saison: str, temperature: float, streaming: bool = False) -> None:
     # Ajout de metadata et tags pour Langfuse
     try:
         with propagate_attributes(tags=["Quentin & Arthur", "Partie 1"]):
@@ -26,41 +54,168 @@ def ask_chef(question: str, saison : str, temperature: float = 0.5) -> str:
                     "type": "ask_chef",
                     "season": saison,
                     "temperature": temperature,
+                    "streaming": streaming,
                 }
             )
     except Exception:
         # Ne pas échouer si Langfuse n'est pas configuré
         pass
 
-    system_prompt = (
-        "Tu es ChefBot, un chef cuisinier français spécialisé en cuisine de saison. "
-        "Réponds en français, propose des ingrédients de saison, techniques de cuisson, "
-        "variantes et suggestions de présentation. Sois clair, pratique et concis."
-    )
 
-    response = groq_client.chat.completions.create(
-        model=modele,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": question},
-        ],
-        temperature=temperature,
-    )
+def _answer_partition(saison: str, temperature: float) -> str:
+    # Une réponse n'est réutilisée que pour la même saison, le même modèle et une
+    # température proche (tranches de 0.25)
+    return f"{modele}|{(saison or '').strip().casefold()}|t{round(float(temperature) * 4) / 4:.2f}"
 
-    # Extraire le contenu de la première sélection
-    content = response.choices[0].message.content
 
-    # Flush Langfuse (best-effort)
+def _tag_answer_cache(kind: str, similarity: float, stats: Dict[str, Any]) -> None:
     try:
-        client.flush()
+        client.update_current_trace(metadata={"cache_hit": kind != "miss"})
+        client.update_current_observation(
+            metadata={"cache_hit": kind != "miss", "answer_cache": kind,
+                      "answer_similarity": round(similarity, 3), "answer_cache_stats": stats}
+        )
     except Exception:
         pass
 
+
+@observe(name="Quentin & Arthur")
+@metered("ask_chef")
+def ask_chef(question: str, saison : str, temperature: float = 0.5) -> str:
+    _tag_ask_chef_trace(saison, temperature)
+
+    # Les questions quasi identiques (même saison, température proche) sont servies sans appel à Groq
+    answer_cache = get_answer_cache()
+    partition = _answer_partition(saison, temperature)
+    if answer_cache is not None:
+        cached, similarity, kind = answer_cache.lookup(question, partition=partition)
+        _tag_answer_cache(kind or "miss", similarity, answer_cache.get_stats())
+        if cached is not None:
+            schedule_flush()
+            return cached
+
+    def _answer(model: str, last: bool) -> str:
+        # Question d'un utilisateur : passe devant les appels des évaluations
+        with priority("interactive"):
+            response = chat_completion(
+                groq_client,
+                phase="answer",
+                hedge=True,
+                model=model,
+                messages=_chef_messages(question),
+                temperature=temperature,
+                seed=SAMPLING_SEED,
+            )
+        # Extraire le contenu de la première sélection
+        return response.choices[0].message.content
+
+    # Cascade (sur option) : un modèle moins cher répond d'abord, le modèle principal
+    # ne prend la main que si la réponse est trop courte ou enfreint la question
+    content, _ = run_cascade("ask_chef/answer", modele, question, _answer,
+                             lambda answer: validate_answer(answer, question))
+    if answer_cache is not None and content:
+        answer_cache.store(question, str(content), partition=partition)
+
+    # Export Langfuse en arrière-plan, hors du chemin critique
+    schedule_flush()
+
     return str(content)
 
+
+class _StreamStats:
+    """Mesure le time-to-first-token, le débit et la latence totale d'un stream"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token_at = None
+        self.chunks = 0
+        self.completion_tokens = None
+        self.usage = None
+
+    def on_chunk(self, chunk: Any) -> str:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            self.chunks += 1
+        # Groq renvoie l'usage réel dans x_groq sur le dernier chunk
+        x_groq = getattr(chunk, "x_groq", None)
+        usage = getattr(x_groq, "usage", None) or getattr(chunk, "usage", None)
+        if usage is not None and getattr(usage, "completion_tokens", None):
+            self.completion_tokens = usage.completion_tokens
+            self.usage = usage
+        return delta or ""
+
+    def finalize(self) -> None:
+        end = time.perf_counter()
+        tokens = self.completion_tokens or self.chunks
+        generation_time = end - self.first_token_at if self.first_token_at is not None else None
+        metadata = {
+            "time_to_first_token_ms": round((self.first_token_at - self.start) * 1000, 1) if self.first_token_at is not None else None,
+            "total_latency_ms": round((end - self.start) * 1000, 1),
+            "completion_tokens": tokens,
+            "tokens_per_sec": round(tokens / generation_time, 1) if generation_time else None,
+        }
+        try:
+            client.update_current_observation(metadata=metadata)
+        except Exception:
+            pass
+        schedule_flush()
+
+
+@observe(name="Quentin & Arthur")
+def ask_chef_stream(question: str, saison: str, temperature: float = 0.5) -> Iterator[str]:
+    """Version streaming de ask_chef : produit les morceaux de texte au fil de l'eau"""
+    _tag_ask_chef_trace(saison, temperature, streaming=True)
+
+    stats = _StreamStats()
+    with meter_scope(pipeline="ask_chef_stream"), priority("interactive"):
+        stream = chat_completion(
+            groq_client,
+            phase="answer",
+            model=modele,
+            messages=_chef_messages(question),
+            temperature=temperature,
+            stream=True,
+        )
+    try:
+        for chunk in stream:
+            delta = stats.on_chunk(chunk)
+            if delta:
+                yield delta
+    finally:
+        stats.finalize()
+
+
+@observe(name="Quentin & Arthur")
+async def ask_chef_stream_async(question: str, saison: str, temperature: float = 0.5) -> AsyncIterator[str]:
+    """Variante asynchrone de ask_chef_stream (client AsyncGroq)"""
+    _tag_ask_chef_trace(saison, temperature, streaming=True)
+
+    stats = _StreamStats()
+    with meter_scope(pipeline="ask_chef_stream_async"), priority("interactive"):
+        stream = await acomplete(
+            phase="answer",
+            model=modele,
+            messages=_chef_messages(question),
+            temperature=temperature,
+            stream=True,
+        )
+    try:
+        async for chunk in stream:
+            delta = stats.on_chunk(chunk)
+            if delta:
+                yield delta
+    finally:
+        stats.finalize()
+
 # Partie 2 :
 @observe(name="Quentin & Arthur")
-def plan_weekly_menu(constraints: str) -> Dict[str, Any]:
+@metered("plan_weekly_menu")
+def plan_weekly_menu(constraints: str, max_concurrency: int = None) -> Dict[str, Any]:
+    if max_concurrency is None:
+        max_concurrency = int(os.getenv("CHEFBOT_PLAN_CONCURRENCY", "4"))
+
     # Ajout de metadata et tags pour Langfuse - Trace principale
     try:
         with propagate_attributes(tags=["Quentin & Arthur", "Partie 2"]):
@@ -74,6 +229,9 @@ def plan_weekly_menu(constraints: str) -> Dict[str, Any]:
     except Exception:
         pass
 
+    # Modèle des étapes d'exécution : celui qui a produit le plan (cascade), modele sur un hit du cache
+    step_model = {"model": modele}
+
     def _log_langfuse_error(message: str) -> None:
         try:
             client.log(message=message, level="ERROR")
@@ -101,9 +259,26 @@ def plan_weekly_menu(constraints: str) -> Dict[str, Any]:
         except Exception:
             pass
 
+        # Des contraintes proches (formulation, nombres) réutilisent un plan déjà calculé
+        plan_cache = get_plan_cache()
+        if plan_cache is not None:
+            cached, similarity, kind = plan_cache.lookup(constraints, partition=f"plan_weekly_menu:{modele}")
+            try:
+                client.update_current_observation(
+                    metadata={"plan_cache": kind or "miss", "plan_similarity": round(similarity, 3),
+                              "plan_cache_stats": plan_cache.get_stats()}
+                )
+            except Exception:
+                pass
+            if cached is not None:
+                # Le modèle qui a produit ce plan n'est pas connu : les étapes gardent modele
+                return normalize_plan(cached)
+
         prompt = (
             "Décompose la tâche de création d'un menu hebdomadaire en étapes claires. "
-            "Renvoie strictement un JSON de la forme [ {\"step\": 1, \"title\": \"...\", \"instruction\": \"...\"}, ... ] et rien d'autre. "
+            "Renvoie strictement un JSON de la forme {\"steps\": [ {\"step\": 1, \"title\": \"...\", \"instruction\": \"...\", \"depends_on\": []}, ... ]} et rien d'autre. "
+            "\"depends_on\" liste les numéros des étapes dont le résultat est nécessaire à cette étape; "
+            "laisse-la vide pour les étapes indépendantes afin qu'elles puissent être exécutées en parallèle. "
             "Prends en compte ces contraintes: " + constraints
         )
 
@@ -112,35 +287,35 @@ def plan_weekly_menu(constraints: str) -> Dict[str, Any]:
             "Tu dois créer un plan d'action étape par étape pour générer un menu hebdomadaire en respectant les contraintes données."
         )
 
-        for attempt in range(2):
-            try:
-                resp = groq_client.chat.completions.create(
-                    model=modele,
-                    messages=[
-                        {"role": "system", "content": contexte},
-                        {"role": "user", "content": prompt},
-                    ],
-                    temperature=0.2,
-                )
-                text = resp.choices[0].message.content
-                try:
-                    plan = json.loads(text)
-                except json.JSONDecodeError:
-                    # Fallback: try to extract JSON list
-                    start = text.index('[')
-                    end = text.rindex(']') + 1
-                    plan = json.loads(text[start:end])
-                
-                if isinstance(plan, list):
-                    return plan
-                else:
-                    raise ValueError("Plan JSON is not a list")
-            except Exception as e:
-                _log_langfuse_error(f"Plan parsing error (attempt {attempt+1}): {e}")
-                if attempt == 0:
-                    continue
-                else:
-                    raise
+        # Réponse JSON contrainte par schéma, réparée localement si besoin (structured_output.py)
+        def _attempt(model: str, last: bool) -> List[Dict[str, Any]]:
+            return normalize_plan(complete_json(
+                groq_client,
+                kind="plan",
+                schema=PLAN_SCHEMA,
+                coerce=coerce_plan,
+                expect="array",
+                # Un modèle de la cascade n'a droit qu'à un essai : l'escalade tient lieu de relance
+                max_attempts=2 if last else 1,
+                phase="plan",
+                model=model,
+                messages=[
+                    {"role": "system", "content": contexte},
+                    {"role": "user", "content": prompt},
+                ],
+                temperature=0.2,
+                seed=SAMPLING_SEED,
+            ))
+
+        try:
+            plan, step_model["model"] = run_cascade("plan_weekly_menu/plan", modele, constraints, _attempt, validate_plan)
+        except JSONRepairError as e:
+            _log_langfuse_error(f"Plan parsing error: {e}")
+            raise
+
+        if plan_cache is not None:
+            plan_cache.store(constraints, plan, partition=f"plan_weekly_menu:{modele}")
+        return plan
 
     @observe(name="Quentin & Arthur, Partie 2 - execution")
     def _execute_step(step: Dict[str, Any], context: Dict[str, Any]) -> str:
@@ -153,7 +328,8 @@ def plan_weekly_menu(constraints: str) -> Dict[str, Any]:
                 metadata={
                     "step": "execution",
                     "step_number": step.get("step", "?"),
-                    "step_title": title
+                    "step_title": title,
+                    "depends_on": step.get("depends_on", []),
                 }
             )
         except Exception:
@@ -166,13 +342,16 @@ def plan_weekly_menu(constraints: str) -> Dict[str, Any]:
             "Réponds en français et sois précis."
         )
 
-        resp = groq_client.chat.completions.create(
-            model=modele,
+        resp = chat_completion(
+            groq_client,
+            phase="execute",
+            model=step_model["model"],
             messages=[
                 {"role": "system", "content": "Tu es ChefBot, un chef cuisinier français expert."},
                 {"role": "user", "content": prompt},
             ],
             temperature=0.5,
+            seed=SAMPLING_SEED,
         )
 
         return resp.choices[0].message.content
@@ -206,40 +385,33 @@ def plan_weekly_menu(constraints: str) -> Dict[str, Any]:
             "Résultats: " + json.dumps(results, ensure_ascii=False)
         )
 
-        for attempt in range(2):
-            try:
-                resp = groq_client.chat.completions.create(
-                    model=modele,
-                    messages=[
-                        {"role": "system", "content": "Tu es ChefBot, synthétiseur de menus. Il faut créer un menu hebdomadaire à partir des résultats d'exécution."},
-                        {"role": "user", "content": prompt},
-                    ],
-                    temperature=0.3,
-                )
-                text = resp.choices[0].message.content
-                
-                # Tenter de parser le JSON directement
-                try:
-                    menu = json.loads(text)
-                    return menu
-                except json.JSONDecodeError:
-                    # Si échec, essayer d'extraire le JSON (par exemple s'il est entouré de ```json ... ```)
-                    try:
-                        start = text.index('{')
-                        end = text.rindex('}') + 1
-                        json_str = text[start:end]
-                        menu = json.loads(json_str)
-                        return menu
-                    except (ValueError, json.JSONDecodeError):
-                        _log_langfuse_error(f"Failed to extract JSON from response: {text}")
-                        raise ValueError("Synthesis response is not valid JSON")
-
-            except Exception as e:
-                _log_langfuse_error(f"Synthesis JSON parsing error (attempt {attempt+1}): {e}")
-                if attempt == 0:
-                    continue
-                else:
-                    raise
+        def _attempt(model: str, last: bool) -> Dict[str, Any]:
+            return complete_json(
+                groq_client,
+                kind="week_menu",
+                schema=WEEK_MENU_SCHEMA,
+                coerce=coerce_object,
+                max_attempts=2 if last else 1,
+                phase="synthesize",
+                hedge=True,
+                model=model,
+                messages=[
+                    {"role": "system", "content": "Tu es ChefBot, synthétiseur de menus. Il faut créer un menu hebdomadaire à partir des résultats d'exécution."},
+                    {"role": "user", "content": prompt},
+                ],
+                temperature=0.3,
+                seed=SAMPLING_SEED,
+            )
+
+        # Le menu final est validé (schéma, termes interdits, plats connus) avant d'être accepté
+        try:
+            menu, _ = run_cascade("plan_weekly_menu/synthesize", modele, constraints, _attempt,
+                                  lambda menu: validate_menu(menu, WEEK_MENU_SCHEMA, constraints))
+            return menu
+        except JSONRepairError as e:
+            _log_langfuse_error(f"Synthesis JSON parsing error: {e}")
+            raise
+
     try:
         plan = _plan(constraints)
         # Mettre à jour la trace avec le nombre d'étapes planifiées
@@ -250,7 +422,10 @@ def plan_weekly_menu(constraints: str) -> Dict[str, Any]:
                     "partie": "Partie 2",
                     "constraints": constraints,
                     "num_steps_planned": len(plan) if isinstance(plan, list) else 0,
-                    "plan_steps": [s.get("title", "?") for s in plan] if isinstance(plan, list) else []
+                    "plan_steps": [s.get("title", "?") for s in plan] if isinstance(plan, list) else [],
+                    "plan_dependencies": {s["step"]: s["depends_on"] for s in plan},
+                    "critical_path_length": critical_path_length(plan),
+                    "max_concurrency": max_concurrency,
                 }
             )
         except Exception:
@@ -259,16 +434,15 @@ def plan_weekly_menu(constraints: str) -> Dict[str, Any]:
         _log_langfuse_error(f"Failed to produce plan: {e}")
         raise
 
-    results: List[Dict[str, Any]] = []
-    context: Dict[str, Any] = {"constraints": constraints}
-    for step in plan:
-        try:
-            out = _execute_step(step, context)
-        except Exception as e:
-            _log_langfuse_error(f"Error executing step {step}: {e}")
-            out = f"Error: {e}"
-        results.append({"step": step, "output": out})
-        context[f"step_{step.get('step', len(results))}"] = out
+    # Les étapes indépendantes s'exécutent en parallèle; chacune ne reçoit que
+    # les sorties des étapes dont elle dépend
+    results: List[Dict[str, Any]] = run_plan_dag(
+        plan,
+        _execute_step,
+        base_context={"constraints": constraints},
+        max_concurrency=max_concurrency,
+        on_error=lambda step, e: _log_langfuse_error(f"Error executing step {step}: {e}"),
+    )
 
     try:
         menu = _synthesize(results)
@@ -292,10 +466,7 @@ def plan_weekly_menu(constraints: str) -> Dict[str, Any]:
         _log_langfuse_error(f"Failed to synthesize menu: {e}")
         raise
 
-    try:
-        client.flush()
-    except Exception:
-        pass
+    schedule_flush()
 
     return menu
 
@@ -364,28 +535,15 @@ def create_chefbot_dataset():
 
 @observe(name="Quentin & Arthur - Evaluator")
 def rule_evaluator(output: str, expected: Dict) -> Dict:
-    text = output.lower()
-    scores = {}
-
-    avoid = expected.get("must_avoid", [])
-    if avoid:
-        avoid_violations = [a for a in avoid if a.lower() in text]
-        scores["avoid_score"] = 0.0 if avoid_violations else 1.0
-        scores["avoid_violations"] = avoid_violations
-    else:
-        scores["avoid_score"] = 1.0
-
-    include = expected.get("must_include", [])
-    if include:
-        included = [i for i in include if i.lower() in text]
-        scores["include_ratio"] = len(included) / len(include)
-        scores["included_items"] = included
-    else:
-        scores["include_ratio"] = 1.0
+    # Matcher compilé une fois par expected (cache), une seule passe sur le texte,
+    # insensible aux accents, aux pluriels simples et respectant les frontières de mots
+    return get_spec_matcher(expected).score(output)
 
-    scores["overall"] = (scores["avoid_score"] + scores["include_ratio"]) / 2
+def rule_evaluator_batch(outputs: List[str], expected: Dict) -> List[Dict]:
+    """Note un lot de sorties contre un même expected (le matcher n'est compilé qu'une fois)"""
+    return get_spec_matcher(expected).score_batch(outputs)
 
-    return scores
+JUDGE_CRITERIA = ["pertinence", "creativite", "praticite"]
 
 @observe(name="Quentin & Arthur - LLM Judge")
 def llm_judge(question: str, output: str, expected: Dict) -> Dict:
@@ -400,31 +558,35 @@ def llm_judge(question: str, output: str, expected: Dict) -> Dict:
         f"Sortie: {output}\n"
     )
 
-    response = groq_client.chat.completions.create(
-        model=modele,
-        messages=[
-            {"role": "system", "content": "Tu es un évaluateur objectif qui ne répond qu'en JSON."},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=0.0,
-    )
-
-    text = response.choices[0].message.content
+    # Verdict contraint par schéma ; les notes à 0 ne sont plus qu'un dernier recours
     try:
-        result = json.loads(text)
-    except Exception:
-        # fallback: try to extract JSON between braces
-        try:
-            start = text.index("{")
-            end = text.rindex("}") + 1
-            result = json.loads(text[start:end])
-        except Exception as e:
-            result = {"pertinence": 0.0, "creativite": 0.0, "praticite": 0.0, "comment": f"parse_error: {e}"}
+        result = complete_json(
+            groq_client,
+            kind="judge",
+            schema=judge_schema(JUDGE_CRITERIA),
+            coerce=coerce_scores(JUDGE_CRITERIA),
+            phase="judge",
+            model=modele,
+            messages=[
+                {"role": "system", "content": "Tu es un évaluateur objectif qui ne répond qu'en JSON."},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=0.0,
+        )
+    except JSONRepairError as e:
+        result = {name: 0.0 for name in JUDGE_CRITERIA}
+        result["comment"] = f"parse_error: {e}"
 
     return result
 
 @observe(name="Quentin & Arthur - Rule Evaluator")
-def run_evaluation():
+@metered("run_evaluation")
+def run_evaluation(max_workers: int = None, mode: str = None):
+    if max_workers is None:
+        max_workers = int(os.getenv("CHEFBOT_EVAL_WORKERS", "4"))
+    if mode is None:
+        mode = os.getenv("CHEFBOT_EVAL_MODE", "threads")
+
     dataset = create_chefbot_dataset()
 
     @observe(name="Quentin & Arthur - Task")
@@ -470,20 +632,39 @@ def run_evaluation():
             Evaluation(name="praticite", value=scores.get("praticite", 0.0)),
         ]
 
-    # Run the experiment using the built-in runner
-    results = client.run_experiment(
-        name=f"chefbot-menu-eval-{datetime.now().strftime('%Y%m%d-%H%M%S')}",
-        data=dataset.items,
-        task=task,
-        evaluators=[evaluator_rule, evaluator_llm],
-        description="Evaluation of ChefBot weekly menu planner",
-        metadata={"model": modele},
-    )
+    # Runner local : plusieurs items en vol, jugement de l'item N pendant la génération
+    # de l'item N+1, scores envoyés par lots à la fin. Priorité batch : les questions
+    # interactives passent devant dans l'ordonnanceur de débit
+    with priority("batch"):
+        results = run_local_experiment(
+            name=f"chefbot-menu-eval-{datetime.now().strftime('%Y%m%d-%H%M%S')}",
+            data=dataset.items,
+            task=task,
+            evaluators=[evaluator_rule, evaluator_llm],
+            description="Evaluation of ChefBot weekly menu planner",
+            metadata={"model": modele, "max_workers": max_workers, "mode": mode},
+            max_workers=max_workers,
+            mode=mode,
+        )
 
+    cache = get_completion_cache()
+    if cache is not None:
+        try:
+            client.update_current_trace(metadata={"completion_cache": cache.get_stats()})
+        except Exception:
+            pass
     try:
-        client.flush()
+        client.update_current_trace(metadata={"structured_output": get_parse_stats().get_stats()})
     except Exception:
         pass
+    cascade = get_cascade()
+    if cascade is not None:
+        try:
+            client.update_current_trace(metadata={"cascade": cascade.get_stats()})
+        except Exception:
+            pass
+
+    schedule_flush()
     return results
 
 # Partie 4 :
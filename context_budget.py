@@ -0,0 +1,207 @@
+import json
+import math
+import re
+from typing import Any, Dict, List, Optional, Sequence
+
+from text_matcher import MultiPatternMatcher
+
+# Compaction du contexte de la boucle de tool calling manuelle
+# Avant chaque appel au LLM, on estime localement le nombre de tokens de l'historique
+# (messages + schéma des outils). Au-delà du budget, les anciens résultats d'outils sont
+# résumés puis réduits à une ligne, du plus ancien au plus récent ; les résultats du
+# dernier tour, le message système et la question restent intacts. Les messages ne sont
+# jamais retirés (chaque tool_call doit garder sa réponse tool_call_id).
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+_MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Estimation locale : ~1 token par mot court ou signe, mots longs découpés par 4 caractères"""
+    if not text:
+        return 0
+    return sum(max(1, math.ceil(len(piece) / 4)) for piece in _PIECE_RE.findall(text))
+
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    tokens = _MESSAGE_OVERHEAD + estimate_tokens(message.get("content"))
+    for call in message.get("tool_calls") or []:
+        function = call.get("function", {})
+        tokens += estimate_tokens(function.get("name")) + estimate_tokens(function.get("arguments"))
+    return tokens
+
+
+def estimate_messages_tokens(messages: Sequence[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None) -> int:
+    tokens = sum(estimate_message_tokens(m) for m in messages)
+    if tools:
+        tokens += estimate_tokens(json.dumps(tools, ensure_ascii=False))
+    return tokens
+
+
+def summarize_content(content: str, max_chars: int) -> str:
+    """Résumé court d'un contenu (listes JSON : nombre d'éléments et premiers éléments)"""
+    if len(content) <= max_chars:
+        return content
+    if content.startswith("[résumé]"):
+        return content[:max_chars].rstrip() + "…"
+    try:
+        data = json.loads(content)
+    except ValueError:
+        data = None
+    if isinstance(data, list):
+        head = ", ".join(str(x) for x in data[:5])
+        summary = f"[résumé] {len(data)} éléments : {head}{', …' if len(data) > 5 else ''}"
+    elif isinstance(data, dict):
+        summary = f"[résumé] objet avec les clés : {', '.join(list(data)[:10])}"
+    else:
+        lines = [line.strip() for line in content.strip().splitlines() if line.strip()]
+        summary = "[résumé] " + " | ".join(lines)
+    if len(summary) > max_chars:
+        summary = summary[:max_chars].rstrip() + "…"
+    return f"{summary} ({len(content)} caractères à l'origine)"
+
+
+class ContextBudget:
+    """Maintient l'historique de la boucle manuelle sous un budget de tokens"""
+
+    def __init__(self, max_tokens: int = 6000, summary_chars: int = 300, stub_chars: int = 80):
+        self.max_tokens = max_tokens
+        self.summary_chars = summary_chars
+        self.stub_chars = stub_chars
+
+    def compact(self, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Compacte messages sur place ; retourne les comptes de tokens avant/après"""
+        before = estimate_messages_tokens(messages, tools)
+        stats = {"tokens_before": before, "tokens_after": before, "compacted_messages": 0}
+        if before <= self.max_tokens:
+            return stats
+
+        # Résultats du dernier tour : tout ce qui suit le dernier message assistant
+        last_assistant = max((i for i, m in enumerate(messages) if m.get("role") == "assistant"), default=len(messages))
+        older_tools = [i for i, m in enumerate(messages[:last_assistant]) if m.get("role") == "tool"]
+        older_assistants = [i for i, m in enumerate(messages[:last_assistant]) if m.get("role") == "assistant"]
+
+        total = before
+        compacted = set()
+        # Passe 1 : résumés ; passe 2 : une ligne ; passe 3 : texte libre des anciens messages assistant
+        for max_chars, indexes in (
+            (self.summary_chars, older_tools),
+            (self.stub_chars, older_tools),
+            (self.stub_chars, older_assistants),
+        ):
+            for i in indexes:
+                if total <= self.max_tokens:
+                    break
+                content = messages[i].get("content")
+                if not content or len(content) <= max_chars:
+                    continue
+                old_tokens = estimate_message_tokens(messages[i])
+                messages[i] = dict(messages[i], content=summarize_content(content, max_chars))
+                total += estimate_message_tokens(messages[i]) - old_tokens
+                compacted.add(i)
+
+        stats["tokens_after"] = total
+        stats["compacted_messages"] = len(compacted)
+        return stats
+
+
+_TRUNCATION_MARKER = " […]"
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Coupe text pour ne pas dépasser max_tokens (même estimation que estimate_tokens),
+    marque de coupure comprise"""
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    marker = _TRUNCATION_MARKER if estimate_tokens(_TRUNCATION_MARKER) < max_tokens else ""
+    limit = max_tokens - estimate_tokens(marker)
+    tokens = 0
+    for match in _PIECE_RE.finditer(text):
+        tokens += max(1, math.ceil(len(match.group()) / 4))
+        if tokens > limit:
+            return text[:match.start()].rstrip() + marker
+    return text
+
+
+# Contexte glissant pour les pipelines plan -> étapes -> synthèse
+# Les sorties récentes sont gardées telles quelles ; les plus anciennes sont réduites
+# aux faits utiles à la suite (plats retenus, prix, allergènes mentionnés).
+
+_ALLERGENS = (
+    "gluten", "lactose", "lait", "oeufs", "arachides", "fruits à coque", "noix", "amandes", "noisettes",
+    "crustacés", "crevettes", "mollusques", "poisson", "soja", "sésame", "moutarde", "céleri", "sulfites", "lupin",
+)
+_PRICE_RE = re.compile(r"(\d+(?:[.,]\d{1,2})?)\s?(?:€|euros?\b|eur\b)", re.IGNORECASE)
+_DISH_RE = re.compile(
+    r"^\s*(?:[-*•]\s*|\d+[.)]\s*)?(?:\*\*)?(?:entrée|plat(?: principal)?|dessert|apéritif|déjeuner|dîner|diner|petit[- ]déjeuner)"
+    r"(?:\*\*)?\s*[:\-–]\s*(.+)$",
+    re.IGNORECASE | re.MULTILINE,
+)
+_allergen_matcher = MultiPatternMatcher(_ALLERGENS)
+
+
+def extract_facts(text: str, max_dishes: int = 8) -> Dict[str, List[str]]:
+    """Faits structurés d'une sortie d'étape : plats retenus, prix et allergènes cités"""
+    dishes = []
+    for match in _DISH_RE.finditer(text or ""):
+        dish = match.group(1).strip(" *").strip()
+        if dish and len(dish) <= 120 and dish not in dishes:
+            dishes.append(dish)
+        if len(dishes) >= max_dishes:
+            break
+    prices = []
+    for match in _PRICE_RE.finditer(text or ""):
+        price = match.group(1).replace(",", ".") + " €"
+        if price not in prices:
+            prices.append(price)
+    found = _allergen_matcher.find(text or "")
+    return {
+        "plats": dishes,
+        "prix": prices[:10],
+        "allergenes": [a for i, a in enumerate(_ALLERGENS) if i in found],
+    }
+
+
+class RollingContext:
+    """Contexte borné : contraintes + faits des étapes anciennes + sorties récentes verbatim"""
+
+    def __init__(self, header: str, keep_recent: int = 2, max_tokens: int = 1500):
+        self.header = header
+        self.keep_recent = max(0, keep_recent)
+        self.max_tokens = max_tokens
+        self.steps: List[Dict[str, Any]] = []
+
+    def add(self, title: str, output: str) -> None:
+        self.steps.append({"title": title, "output": output or "", "facts": extract_facts(output or "")})
+
+    @staticmethod
+    def _facts_line(step: Dict[str, Any]) -> str:
+        facts = step["facts"]
+        parts = [f"{name}: {' | '.join(values)}" for name, values in facts.items() if values]
+        return f"- {step['title']} — " + ("; ".join(parts) if parts else "aucun fait extrait")
+
+    def render(self, max_tokens: Optional[int] = None, keep_recent: Optional[int] = None) -> str:
+        """Texte de contexte sous le plafond de tokens"""
+        max_tokens = self.max_tokens if max_tokens is None else max_tokens
+        keep = self.keep_recent if keep_recent is None else keep_recent
+        older = self.steps[:-keep] if keep else self.steps
+        recent = self.steps[-keep:] if keep else []
+
+        sections = [self.header]
+        if older:
+            sections.append("Faits des étapes précédentes:\n" + "\n".join(self._facts_line(s) for s in older))
+        fixed = "\n\n".join(sections)
+        budget = max_tokens - estimate_tokens(fixed)
+        if budget <= 0:
+            return truncate_to_tokens(fixed, max_tokens)
+
+        # Le budget restant est partagé entre les sorties récentes, la plus récente d'abord servie
+        blocks = []
+        for i, step in enumerate(reversed(recent)):
+            share = budget // (len(recent) - i)
+            block = truncate_to_tokens(f"Résultat de l'étape '{step['title']}':\n{step['output']}", share)
+            budget -= estimate_tokens(block)
+            blocks.append(block)
+        return "\n\n".join([fixed] + list(reversed(blocks)))
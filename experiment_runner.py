@@ -0,0 +1,237 @@
+import asyncio
+import contextvars
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from langfuse import observe, get_client
+
+from trace_export import submit_export
+
+# Runner d'expériences local
+# Remplace client.run_experiment (un item à la fois) par un pool borné :
+# la génération (task) et l'évaluation sont pipelinées, l'ordre des résultats
+# est celui du dataset, et les scores sont envoyés à Langfuse par lots à la fin.
+
+client = get_client()
+
+
+class ExperimentItemResult:
+    """Résultat d'un item : sortie de la tâche, évaluations et trace associée"""
+
+    def __init__(self, index: int, item: Any):
+        self.index = index
+        self.item = item
+        self.output: Any = None
+        self.evaluations: List[Any] = []
+        self.trace_id: Optional[str] = None
+        self.error: Optional[str] = None
+
+
+class LocalExperimentResult:
+    """Même forme que le résultat de client.run_experiment (attribut items)"""
+
+    def __init__(self, name: str, items: List[ExperimentItemResult]):
+        self.name = name
+        self.items = items
+
+    def averages(self) -> Dict[str, float]:
+        totals: Dict[str, List[float]] = {}
+        for it in self.items:
+            for ev in it.evaluations:
+                if isinstance(ev.value, (int, float)):
+                    totals.setdefault(ev.name, []).append(float(ev.value))
+        return {k: round(sum(v) / len(v), 4) for k, v in totals.items()}
+
+
+def _item_field(item: Any, field: str) -> Any:
+    if isinstance(item, dict):
+        return item.get(field)
+    return getattr(item, field, None)
+
+
+def _evaluator_kwargs(result: ExperimentItemResult) -> Dict[str, Any]:
+    return {
+        "item": result.item,
+        "input": _item_field(result.item, "input"),
+        "output": result.output,
+        "expected_output": _item_field(result.item, "expected_output"),
+        "metadata": _item_field(result.item, "metadata"),
+    }
+
+
+def _as_list(evaluations: Any) -> List[Any]:
+    if evaluations is None:
+        return []
+    if isinstance(evaluations, list):
+        return evaluations
+    return [evaluations]
+
+
+# Chaque item est la racine de sa propre trace (comme client.run_experiment) : l'appelant
+# passe langfuse_trace_id, sinon l'item deviendrait un span de la trace de l'appelant et
+# tous les liens dataset-run et scores iraient sur cette seule trace
+@observe(name="Quentin & Arthur - Experiment Item")
+def _traced_task(task: Callable, item: Any) -> Any:
+    return task(item=item)
+
+
+@observe(name="Quentin & Arthur - Experiment Item")
+async def _traced_task_async(task: Callable, item: Any) -> Any:
+    return await task(item=item)
+
+
+def _run_task(task: Callable, result: ExperimentItemResult) -> None:
+    result.trace_id = client.create_trace_id()
+    try:
+        result.output = _traced_task(task, result.item, langfuse_trace_id=result.trace_id)
+    except Exception as e:
+        result.error = f"task: {e}"
+
+
+def _run_evaluators(evaluators: List[Callable], result: ExperimentItemResult) -> None:
+    if result.error is not None:
+        return
+    kwargs = _evaluator_kwargs(result)
+    for evaluator in evaluators:
+        try:
+            result.evaluations.extend(_as_list(evaluator(**kwargs)))
+        except Exception as e:
+            result.error = f"evaluator {getattr(evaluator, '__name__', evaluator)}: {e}"
+
+
+def _run_threads(items, task, evaluators, max_workers) -> List[ExperimentItemResult]:
+    results = [ExperimentItemResult(i, item) for i, item in enumerate(items)]
+    eval_done = threading.Semaphore(0)
+
+    # Deux pools : pendant qu'un item est jugé, les workers de tâche passent au suivant
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="exp-task") as task_pool, \
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="exp-eval") as eval_pool:
+
+        def _evaluate(result):
+            try:
+                _run_evaluators(evaluators, result)
+            finally:
+                eval_done.release()
+
+        for result in results:
+            # Contextes copiés ici, sur le thread appelant : le callback de fin de tâche
+            # s'exécute sur le worker, dont le contexte n'a ni la priorité ni le span parent
+            task_ctx = contextvars.copy_context()
+            eval_ctx = contextvars.copy_context()
+            future = task_pool.submit(task_ctx.run, _run_task, task, result)
+            future.add_done_callback(
+                lambda _f, r=result, ctx=eval_ctx: eval_pool.submit(ctx.run, _evaluate, r)
+            )
+
+        for _ in results:
+            eval_done.acquire()
+
+    return results
+
+
+async def _call(fn: Callable, **kwargs) -> Any:
+    if inspect.iscoroutinefunction(fn):
+        return await fn(**kwargs)
+    return await asyncio.to_thread(fn, **kwargs)
+
+
+async def _run_asyncio(items, task, evaluators, max_workers) -> List[ExperimentItemResult]:
+    results = [ExperimentItemResult(i, item) for i, item in enumerate(items)]
+    task_slots = asyncio.Semaphore(max_workers)
+    eval_slots = asyncio.Semaphore(max_workers)
+
+    async def _one(result):
+        async with task_slots:
+            if inspect.iscoroutinefunction(task):
+                result.trace_id = client.create_trace_id()
+                try:
+                    result.output = await _traced_task_async(task, result.item, langfuse_trace_id=result.trace_id)
+                except Exception as e:
+                    result.error = f"task: {e}"
+            else:
+                await asyncio.to_thread(_run_task, task, result)
+        # Le slot de tâche est libéré avant le jugement : l'item suivant démarre
+        async with eval_slots:
+            if result.error is not None:
+                return
+            kwargs = _evaluator_kwargs(result)
+            outcomes = await asyncio.gather(
+                *[_call(ev, **kwargs) for ev in evaluators], return_exceptions=True
+            )
+            for evaluator, outcome in zip(evaluators, outcomes):
+                if isinstance(outcome, Exception):
+                    result.error = f"evaluator {getattr(evaluator, '__name__', evaluator)}: {outcome}"
+                else:
+                    result.evaluations.extend(_as_list(outcome))
+
+    await asyncio.gather(*[_one(r) for r in results])
+    return results
+
+
+def _upload_batch(name: str, description: Optional[str], metadata: Optional[Dict[str, Any]],
+                  batch: List[ExperimentItemResult]) -> None:
+    """Envoie les liens dataset-run et les scores d'un lot à Langfuse"""
+    for result in batch:
+        if result.trace_id is None:
+            continue
+        item_id = _item_field(result.item, "id")
+        if item_id:
+            try:
+                client.api.dataset_run_items.create(
+                    run_name=name,
+                    run_description=description,
+                    metadata=metadata,
+                    dataset_item_id=item_id,
+                    trace_id=result.trace_id,
+                )
+            except Exception:
+                pass
+        for ev in result.evaluations:
+            try:
+                client.create_score(
+                    name=ev.name,
+                    value=ev.value,
+                    trace_id=result.trace_id,
+                    comment=getattr(ev, "comment", None),
+                )
+            except Exception:
+                pass
+
+
+def _upload_results(name: str, description: Optional[str], metadata: Optional[Dict[str, Any]],
+                    results: List[ExperimentItemResult], batch_size: int) -> None:
+    # Chaque lot part sur le thread d'export : l'appelant récupère ses résultats sans attendre
+    for start in range(0, len(results), batch_size):
+        batch = results[start:start + batch_size]
+        submit_export(lambda batch=batch: _upload_batch(name, description, metadata, batch))
+
+
+def run_local_experiment(
+    name: str,
+    data: List[Any],
+    task: Callable,
+    evaluators: List[Callable],
+    description: Optional[str] = None,
+    metadata: Optional[Dict[str, Any]] = None,
+    max_workers: int = 4,
+    mode: str = "threads",
+    upload_batch_size: int = 50,
+) -> LocalExperimentResult:
+    """Exécute task puis evaluators sur chaque item avec au plus max_workers requêtes en vol par étage.
+
+    mode="threads" utilise deux ThreadPoolExecutor (génération / évaluation),
+    mode="asyncio" une boucle asyncio (les tâches et évaluateurs peuvent être async).
+    Les résultats sont retournés dans l'ordre de data.
+    """
+    items = list(data)
+    if mode == "threads":
+        results = _run_threads(items, task, evaluators, max_workers)
+    elif mode == "asyncio":
+        results = asyncio.run(_run_asyncio(items, task, evaluators, max_workers))
+    else:
+        raise ValueError(f"mode inconnu: {mode} (attendu 'threads' ou 'asyncio')")
+
+    _upload_results(name, description, metadata, results, upload_batch_size)
+    return LocalExperimentResult(name, results)
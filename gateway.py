@@ -0,0 +1,139 @@
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any, Callable, Optional
+
+import httpx
+from groq import AsyncGroq, Groq
+
+from llm import achat_completion, chat_completion
+
+# Passerelle LLM : un seul pool de connexions HTTP par process
+# Les clients Groq (sync et async) et les modèles smolagents (LiteLLM) partagent un client
+# httpx avec keep-alive : connexions TCP et sessions TLS sont réutilisées d'un appel et
+# d'une session à l'autre. Tout est créé au premier usage, pas à l'import.
+# Réglages : CHEFBOT_HTTP_POOL_SIZE (connexions simultanées, défaut 100),
+# CHEFBOT_HTTP_KEEPALIVE (connexions gardées ouvertes, défaut 20),
+# CHEFBOT_HTTP_KEEPALIVE_EXPIRY (secondes, défaut 30), CHEFBOT_HTTP_TIMEOUT (défaut 60).
+# Un client async est lié à sa boucle d'événements : il y en a un par boucle.
+# Les clients ne relancent rien eux-mêmes (max_retries=0) : les 429 remontent directement
+# à l'ordonnanceur de débit (rate_scheduler.py), seul à gérer attente et nouvelles tentatives.
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(os.getenv("CHEFBOT_HTTP_POOL_SIZE", "100")),
+        max_keepalive_connections=int(os.getenv("CHEFBOT_HTTP_KEEPALIVE", "20")),
+        keepalive_expiry=float(os.getenv("CHEFBOT_HTTP_KEEPALIVE_EXPIRY", "30")),
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(float(os.getenv("CHEFBOT_HTTP_TIMEOUT", "60")), connect=5.0)
+
+
+_lock = threading.Lock()
+_http_client: Optional[httpx.Client] = None
+_groq_client: Optional[Groq] = None
+_litellm_handler: Any = None
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncGroq]" = weakref.WeakKeyDictionary()
+
+
+def get_http_client() -> httpx.Client:
+    """Client httpx partagé (pool de connexions keep-alive)"""
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(limits=_limits(), timeout=_timeout(), follow_redirects=True)
+        return _http_client
+
+
+def get_groq_client() -> Groq:
+    """Client Groq partagé, adossé au pool commun"""
+    global _groq_client
+    http_client = get_http_client()
+    with _lock:
+        if _groq_client is None:
+            _groq_client = Groq(http_client=http_client, max_retries=0)
+        return _groq_client
+
+
+def get_async_groq_client() -> AsyncGroq:
+    """Client AsyncGroq de la boucle d'événements courante (un pool httpx async par boucle)"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            http_client = httpx.AsyncClient(limits=_limits(), timeout=_timeout(), follow_redirects=True)
+            client = _async_clients[loop] = AsyncGroq(http_client=http_client, max_retries=0)
+        return client
+
+
+class LazyGroqClient:
+    """Adaptateur pour les modules qui gardent un groq_client global : se comporte comme un
+    client Groq, mais le client partagé n'est créé qu'au premier appel"""
+
+    def __init__(self, factory: Callable[[], Any] = get_groq_client):
+        self._factory = factory
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._factory(), name)
+
+
+def lazy_groq_client() -> LazyGroqClient:
+    return LazyGroqClient(get_groq_client)
+
+
+def lazy_async_groq_client() -> LazyGroqClient:
+    return LazyGroqClient(get_async_groq_client)
+
+
+def complete(phase: Optional[str] = None, hedge: bool = False, **params: Any) -> Any:
+    """chat.completions.create via le client partagé (cache, comptage, ordonnanceur : voir llm.py)"""
+    return chat_completion(get_groq_client(), phase=phase, hedge=hedge, **params)
+
+
+async def acomplete(phase: Optional[str] = None, **params: Any) -> Any:
+    """Variante asynchrone de complete (client AsyncGroq de la boucle courante)"""
+    return await achat_completion(get_async_groq_client(), phase=phase, **params)
+
+
+# smolagents / LiteLLM
+
+def _get_litellm_handler() -> Any:
+    global _litellm_handler
+    from litellm.llms.custom_httpx.http_handler import HTTPHandler
+
+    http_client = get_http_client()
+    with _lock:
+        if _litellm_handler is None:
+            _litellm_handler = HTTPHandler(client=http_client)
+        return _litellm_handler
+
+
+class PooledLiteLLMClient:
+    """Remplace le module litellm comme client d'un LiteLLMModel : chaque complétion passe
+    par le pool commun au lieu d'un client HTTP propre à LiteLLM"""
+
+    def completion(self, **kwargs: Any) -> Any:
+        import litellm
+
+        kwargs.setdefault("client", _get_litellm_handler())
+        return litellm.completion(**kwargs)
+
+
+_litellm_client = PooledLiteLLMClient()
+
+
+def get_litellm_client() -> PooledLiteLLMClient:
+    return _litellm_client
+
+
+def close() -> None:
+    """Ferme le pool synchrone (fin de process, tests) ; il sera recréé au prochain appel"""
+    global _http_client, _groq_client, _litellm_handler
+    with _lock:
+        http_client, _http_client, _groq_client, _litellm_handler = _http_client, None, None, None
+    if http_client is not None:
+        http_client.close()
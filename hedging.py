@@ -0,0 +1,173 @@
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from langfuse import get_client
+
+# Requêtes couvertes (hedging), sur option
+# Si une complétion n'est pas revenue après le percentile p (ex: p95) des latences récentes
+# du modèle, une seconde requête identique est lancée, éventuellement vers un modèle de
+# secours. La première réponse gagne ; l'autre est annulée si elle n'a pas démarré, sinon
+# son résultat est ignoré (un appel HTTP synchrone ne s'interrompt pas) mais son usage
+# est quand même compté. Un budget borne les couvertures à un pourcentage du trafic :
+# chaque requête crédite `budget` couverture, une couverture en consomme une.
+
+class LatencyWindow:
+    """Latences récentes d'un modèle (fenêtre glissante)"""
+
+    def __init__(self, size: int = 200):
+        self._values: deque = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._values.append(seconds)
+
+    def percentile(self, pct: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._values) < min_samples:
+                return None
+            values = sorted(self._values)
+        return values[min(len(values) - 1, int(pct * len(values)))]
+
+
+class Hedger:
+    """Lance une requête de couverture quand la première tarde"""
+
+    def __init__(self, percentile: float = 0.95, budget: float = 0.05, min_samples: int = 20,
+                 fallback_model: Optional[str] = None, max_workers: int = 32, window: int = 200):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.fallback_model = fallback_model
+        self.window = window
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, LatencyWindow] = {}
+        self._credit = 1.0
+        self.stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "primary_wins": 0, "budget_denied": 0, "errors": 0}
+
+    def _window(self, model: str) -> LatencyWindow:
+        with self._lock:
+            window = self._latencies.get(model)
+            if window is None:
+                window = self._latencies[model] = LatencyWindow(self.window)
+            return window
+
+    def _take_credit(self) -> bool:
+        with self._lock:
+            if self._credit >= 1.0:
+                self._credit -= 1.0
+                return True
+            self.stats["budget_denied"] += 1
+            return False
+
+    def _submit(self, fn: Callable[[], Any]) -> Future:
+        # copy_context : trace Langfuse, étiquettes de comptage et priorité suivent l'appel
+        ctx = contextvars.copy_context()
+        return self._pool.submit(ctx.run, fn)
+
+    def call(self, model: str, primary: Callable[[], Any], hedge: Callable[[str], Any],
+             on_discarded: Optional[Callable[[Any, float], None]] = None) -> Any:
+        """primary() puis, si elle dépasse le délai de couverture, hedge(modèle) en parallèle.
+        on_discarded(résultat, latence) reçoit la réponse perdante (comptage de l'usage)."""
+        with self._lock:
+            self.stats["calls"] += 1
+            self._credit = min(10.0, self._credit + self.budget)
+        delay = self._window(model).percentile(self.percentile, self.min_samples)
+
+        start = time.perf_counter()
+
+        def _timed(fn: Callable[[], Any], target: str) -> Tuple[Any, float, str]:
+            result = fn()
+            elapsed = time.perf_counter() - start
+            return result, elapsed, target
+
+        def _observe(future: Future) -> None:
+            # La latence de la requête principale alimente la fenêtre même si elle perd
+            if not future.cancelled() and future.exception() is None:
+                self._window(model).add(future.result()[1])
+
+        if delay is None:
+            # Pas encore assez de latences observées : appel direct, sans couverture
+            result, elapsed, _ = _timed(primary, model)
+            self._window(model).add(elapsed)
+            return result
+
+        first = self._submit(lambda: _timed(primary, model))
+        first.add_done_callback(_observe)
+        done, _ = wait([first], timeout=delay)
+        if done or not self._take_credit():
+            return first.result()[0]
+
+        target = self.fallback_model or model
+        second = self._submit(lambda: _timed(lambda: hedge(target), target))
+        with self._lock:
+            self.stats["hedged"] += 1
+
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                winner = future
+                loser = second if winner is first else first
+                self._finish(winner is second, delay, target, loser, on_discarded)
+                return winner.result()[0]
+        with self._lock:
+            self.stats["errors"] += 1
+        raise error
+
+    def _finish(self, hedge_won: bool, delay: float, target: str, loser: Future,
+                on_discarded: Optional[Callable[[Any, float], None]]) -> None:
+        with self._lock:
+            self.stats["hedge_wins" if hedge_won else "primary_wins"] += 1
+
+        def _discard(future: Future) -> None:
+            if not future.cancelled() and future.exception() is None:
+                on_discarded(*future.result()[:2])
+
+        if not loser.cancel() and on_discarded is not None:
+            loser.add_done_callback(_discard)
+        try:
+            get_client().update_current_observation(metadata={"hedge": {
+                "delay_ms": round(delay * 1000, 1), "winner": "hedge" if hedge_won else "primary", "hedge_model": target,
+            }})
+        except Exception:
+            pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["credit"] = round(self._credit, 3)
+        stats["hedge_rate"] = stats["hedged"] / stats["calls"] if stats["calls"] else 0.0
+        stats["hedge_win_rate"] = stats["hedge_wins"] / stats["hedged"] if stats["hedged"] else 0.0
+        return stats
+
+
+_hedger: Optional[Hedger] = None
+_hedger_lock = threading.Lock()
+
+
+def get_hedger() -> Optional[Hedger]:
+    """Hedger partagé, ou None si la couverture n'est pas activée (CHEFBOT_HEDGE=1).
+    Réglages : CHEFBOT_HEDGE_PERCENTILE (défaut 0.95), CHEFBOT_HEDGE_BUDGET (part maximale
+    du trafic couverte, défaut 0.05), CHEFBOT_HEDGE_MIN_SAMPLES (défaut 20),
+    CHEFBOT_HEDGE_FALLBACK_MODEL (modèle de la requête de couverture, défaut : le même)."""
+    global _hedger
+    with _hedger_lock:
+        if _hedger is None and os.getenv("CHEFBOT_HEDGE", "0").strip().lower() in ("1", "true", "yes", "on"):
+            _hedger = Hedger(
+                percentile=float(os.getenv("CHEFBOT_HEDGE_PERCENTILE", "0.95")),
+                budget=float(os.getenv("CHEFBOT_HEDGE_BUDGET", "0.05")),
+                min_samples=int(os.getenv("CHEFBOT_HEDGE_MIN_SAMPLES", "20")),
+                fallback_model=os.getenv("CHEFBOT_HEDGE_FALLBACK_MODEL") or None,
+            )
+        return _hedger
@@ -0,0 +1,130 @@
+import time
+from typing import Any, AsyncIterator, Iterator, Optional
+
+from hedging import get_hedger
+from llm_cache import get_completion_cache
+from metering import current_tags, get_meter
+from rate_scheduler import current_priority, get_scheduler
+
+# Point d'entrée unique pour les appels chat.completions.create des différentes parties
+
+
+def _metered_stream(stream: Any, model: str, start: float, pipeline: Optional[str], phase: Optional[str],
+                    estimated: int) -> Iterator[Any]:
+    # Groq renvoie l'usage dans x_groq (ou usage) sur le dernier chunk ; il corrige alors
+    # l'estimation de l'ordonnanceur, inconnue à la création du stream
+    usage = None
+    try:
+        for chunk in stream:
+            x_groq = getattr(chunk, "x_groq", None)
+            usage = getattr(x_groq, "usage", None) or getattr(chunk, "usage", None) or usage
+            yield chunk
+    finally:
+        get_scheduler().settle(model, estimated, usage)
+        get_meter().record(model, usage, time.perf_counter() - start, phase=phase, pipeline=pipeline)
+
+
+async def _ametered_stream(stream: Any, model: str, start: float, pipeline: Optional[str], phase: Optional[str],
+                           estimated: int) -> AsyncIterator[Any]:
+    usage = None
+    try:
+        async for chunk in stream:
+            x_groq = getattr(chunk, "x_groq", None)
+            usage = getattr(x_groq, "usage", None) or getattr(chunk, "usage", None) or usage
+            yield chunk
+    finally:
+        get_scheduler().settle(model, estimated, usage)
+        # Fin du stream possiblement hors du span appelant : usage compté sans y être rattaché
+        get_meter().record(model, usage, time.perf_counter() - start, phase=phase, pipeline=pipeline, attach=False)
+
+
+def _model_of(response: Any, model: str) -> str:
+    # Une requête de couverture peut avoir été servie par le modèle de secours
+    return getattr(response, "model", None) or model
+
+
+def _send(groq_client, params: dict, phase: Optional[str], hedge: bool) -> Any:
+    scheduler = get_scheduler()
+
+    def _create(model: str) -> Any:
+        call = dict(params, model=model)
+        return scheduler.call(model, call, lambda: groq_client.chat.completions.create(**call))
+
+    model = params.get("model")
+    # Couverture sur option, jamais pour les streams ni les appels batch (évaluations)
+    hedger = get_hedger() if hedge and not params.get("stream") and current_priority() != "batch" else None
+    if hedger is None:
+        return _create(model)
+
+    def _discarded(response: Any, latency: float) -> None:
+        # Réponse perdante : facturée, donc comptée, sans être rattachée au span
+        get_meter().record(_model_of(response, model), getattr(response, "usage", None),
+                           latency, phase=phase, attach=False)
+
+    return hedger.call(model, lambda: _create(model), _create, on_discarded=_discarded)
+
+
+def chat_completion(groq_client, phase: Optional[str] = None, hedge: bool = False, **params) -> Any:
+    """Appelle groq_client.chat.completions.create en passant par le cache de complétions.
+
+    phase étiquette l'appel dans le comptage des tokens (voir metering.py). Les appels
+    réellement envoyés passent par l'ordonnanceur de débit (voir rate_scheduler.py).
+    hedge=True autorise une requête de couverture si CHEFBOT_HEDGE est activé (voir hedging.py).
+    """
+    start = time.perf_counter()
+    model = params.get("model")
+    cache = get_completion_cache()
+    if cache is None or cache.should_bypass(params):
+        response = _send(groq_client, params, phase, hedge)
+        if params.get("stream"):
+            # Étiquettes lues maintenant : le stream peut être consommé hors du meter_scope
+            pipeline, scope_phase = current_tags()
+            return _metered_stream(response, model, start, pipeline, phase or scope_phase,
+                                   get_scheduler().estimate(params))
+        get_meter().record(_model_of(response, model), getattr(response, "usage", None), time.perf_counter() - start, phase=phase)
+        return response
+
+    key = cache.make_key(params)
+    cached = cache.get(key)
+    if cached is not None:
+        get_meter().record(model, getattr(cached, "usage", None), time.perf_counter() - start, phase=phase, cached=True)
+        return cached
+
+    response = _send(groq_client, params, phase, hedge)
+    served_by = _model_of(response, model)
+    get_meter().record(served_by, getattr(response, "usage", None), time.perf_counter() - start, phase=phase)
+    # Réponse du modèle de secours (couverture) : pas sous la clé du modèle demandé
+    if served_by == model:
+        cache.put(key, response)
+    return response
+
+
+async def achat_completion(async_groq_client, phase: Optional[str] = None, **params) -> Any:
+    """Variante asynchrone de chat_completion (client AsyncGroq) : même cache, même comptage,
+    même ordonnanceur. Pas de couverture (hedging) en asynchrone."""
+    start = time.perf_counter()
+    model = params.get("model")
+
+    async def _asend() -> Any:
+        return await get_scheduler().acall(model, params, lambda: async_groq_client.chat.completions.create(**params))
+
+    cache = get_completion_cache()
+    if cache is None or cache.should_bypass(params):
+        response = await _asend()
+        if params.get("stream"):
+            pipeline, scope_phase = current_tags()
+            return _ametered_stream(response, model, start, pipeline, phase or scope_phase,
+                                    get_scheduler().estimate(params))
+        get_meter().record(_model_of(response, model), getattr(response, "usage", None), time.perf_counter() - start, phase=phase)
+        return response
+
+    key = cache.make_key(params)
+    cached = cache.get(key)
+    if cached is not None:
+        get_meter().record(model, getattr(cached, "usage", None), time.perf_counter() - start, phase=phase, cached=True)
+        return cached
+
+    response = await _asend()
+    get_meter().record(_model_of(response, model), getattr(response, "usage", None), time.perf_counter() - start, phase=phase)
+    cache.put(key, response)
+    return response
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+# Cache des complétions Groq
+# Deux niveaux : un LRU en mémoire devant un stockage disque adressé par contenu
+# (le nom du fichier est le hash SHA-256 des paramètres de la requête).
+
+# Graine passée par les points d'entrée (ask_chef, plan, étapes, synthèse, boucle d'outils) :
+# leurs appels échantillonnés deviennent rejouables depuis le cache. Un appel peut s'en
+# exclure en passant seed=None.
+SAMPLING_SEED = int(os.getenv("CHEFBOT_SAMPLING_SEED", "42"))
+
+# Paramètres qui n'influencent pas le contenu de la réponse : exclus de la clé
+_NON_SEMANTIC_PARAMS = {"timeout", "extra_headers", "extra_query", "extra_body", "stream"}
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _to_plain(response: Any) -> Dict[str, Any]:
+    """Convertit une réponse du SDK Groq en dict JSON-sérialisable"""
+    if isinstance(response, dict):
+        return response
+    if hasattr(response, "model_dump"):
+        return response.model_dump(mode="json")
+    if hasattr(response, "to_dict"):
+        return response.to_dict()
+    return json.loads(json.dumps(response, default=lambda o: getattr(o, "__dict__", str(o))))
+
+
+def _to_namespace(data: Any) -> Any:
+    """Reconstruit un objet à attributs (resp.choices[0].message.content) depuis un dict"""
+    if isinstance(data, dict):
+        return SimpleNamespace(**{k: _to_namespace(v) for k, v in data.items()})
+    if isinstance(data, list):
+        return [_to_namespace(v) for v in data]
+    return data
+
+
+class CompletionCache:
+    """Cache LRU mémoire + disque pour les appels chat.completions.create"""
+
+    def __init__(
+        self,
+        directory: str,
+        max_memory_entries: int = 512,
+        max_disk_bytes: int = 256 * 1024 * 1024,
+        max_age_seconds: float = 7 * 24 * 3600,
+        bypass_nonzero_temperature: bool = True,
+    ):
+        self.directory = directory
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.max_age_seconds = max_age_seconds
+        self.bypass_nonzero_temperature = bypass_nonzero_temperature
+
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes: Optional[int] = None
+        self.stats = {
+            "hits": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "evictions": 0,
+        }
+
+    # Clé et politique
+
+    def make_key(self, params: Dict[str, Any]) -> str:
+        keyed = {k: v for k, v in params.items() if k not in _NON_SEMANTIC_PARAMS}
+        canonical = json.dumps(keyed, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def should_bypass(self, params: Dict[str, Any]) -> bool:
+        # Un appel échantillonné (température > 0, 1 par défaut côté API) n'est rejoué depuis
+        # le cache que s'il fixe une graine : la graine fait alors partie de la clé
+        temperature = params.get("temperature")
+        sampled = (1.0 if temperature is None else temperature) > 0 and params.get("seed") is None
+        bypass = bool(params.get("stream")) or (self.bypass_nonzero_temperature and sampled)
+        if bypass:
+            with self._lock:
+                self.stats["bypassed"] += 1
+        return bypass
+
+    # Lecture / écriture
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, data = entry
+                if now - created <= self.max_age_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats["hits"] += 1
+                    self.stats["memory_hits"] += 1
+                    return _to_namespace(data)
+                del self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+
+        created = record.get("created", 0)
+        if now - created > self.max_age_seconds:
+            self._remove_file(path)
+            with self._lock:
+                self.stats["misses"] += 1
+                self.stats["evictions"] += 1
+            return None
+
+        data = record.get("response")
+        with self._lock:
+            self._remember(key, created, data)
+            self.stats["hits"] += 1
+            self.stats["disk_hits"] += 1
+        return _to_namespace(data)
+
+    def put(self, key: str, response: Any) -> None:
+        data = _to_plain(response)
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, data)
+
+        path = self._path(key)
+        payload = json.dumps({"created": created, "response": data}, ensure_ascii=False)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Le cache disque est best-effort : on garde au moins le niveau mémoire
+            return
+
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(payload.encode("utf-8"))
+            over_budget = self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _remember(self, key: str, created: float, data: Any) -> None:
+        self._memory[key] = (created, data)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    # Éviction disque (âge puis taille, les plus anciens d'abord)
+
+    def _remove_file(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict_disk(self) -> None:
+        now = time.time()
+        files = []
+        for root, _dirs, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+
+        evicted = 0
+        kept = []
+        for mtime, size, path in files:
+            if now - mtime > self.max_age_seconds:
+                self._remove_file(path)
+                evicted += 1
+            else:
+                kept.append((mtime, size, path))
+
+        kept.sort()
+        total = sum(size for _, size, _ in kept)
+        while kept and total > self.max_disk_bytes:
+            _, size, path = kept.pop(0)
+            self._remove_file(path)
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._disk_bytes = total
+            self.stats["evictions"] += evicted
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        for root, _dirs, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".json"):
+                    self._remove_file(os.path.join(root, name))
+        with self._lock:
+            self._disk_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+_cache: Optional[CompletionCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    """Retourne le cache partagé du process (None si désactivé via CHEFBOT_CACHE=0)"""
+    global _cache
+    if not _env_flag("CHEFBOT_CACHE", True):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = CompletionCache(
+                directory=os.getenv("CHEFBOT_CACHE_DIR", os.path.join(".chefbot_cache", "completions")),
+                max_memory_entries=int(os.getenv("CHEFBOT_CACHE_MAX_ENTRIES", "512")),
+                max_disk_bytes=int(os.getenv("CHEFBOT_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+                max_age_seconds=float(os.getenv("CHEFBOT_CACHE_MAX_AGE", str(7 * 24 * 3600))),
+                bypass_nonzero_temperature=_env_flag("CHEFBOT_CACHE_BYPASS_TEMPERATURE", True),
+            )
+        return _cache
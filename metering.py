@@ -0,0 +1,266 @@
+import atexit
+import contextlib
+import contextvars
+import csv
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from langfuse import get_client
+
+# Comptage des tokens et du coût de tous les appels LLM
+# Chaque complétion (Groq via chat_completion, LiteLLM via les modèles smolagents) produit
+# un enregistrement : tokens prompt/complétion/total, latence, modèle, et les étiquettes
+# pipeline (point d'entrée) et phase (plan, execute, synthesize, judge, agent...).
+# Les étiquettes viennent de meter_scope() (variable de contexte, suit les threads lancés
+# avec copy_context) ou de l'argument phase= de chat_completion. Les totaux sont agrégés
+# en mémoire et exportables en JSON ou CSV avec une estimation du coût par modèle.
+
+# Prix indicatifs en USD par million de tokens (entrée, sortie) ; surchargeables par un
+# fichier JSON {"modele": [entree, sortie]} désigné par CHEFBOT_PRICES_FILE
+MODEL_PRICES: Dict[str, Tuple[float, float]] = {
+    "openai/gpt-oss-120b": (0.15, 0.75),
+    "openai/gpt-oss-20b": (0.10, 0.50),
+    "meta-llama/llama-4-scout-17b-16e-instruct": (0.11, 0.34),
+    "meta-llama/llama-4-maverick-17b-128e-instruct": (0.20, 0.60),
+    "meta-llama/llama-3.3-70b-versatile": (0.59, 0.79),
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+    "llama-3.1-8b-instant": (0.05, 0.08),
+    "qwen/qwen3-32b": (0.29, 0.59),
+}
+
+
+def _load_prices() -> Dict[str, Tuple[float, float]]:
+    prices = dict(MODEL_PRICES)
+    path = os.getenv("CHEFBOT_PRICES_FILE")
+    if path:
+        with open(path, encoding="utf-8") as f:
+            prices.update({k: tuple(v) for k, v in json.load(f).items()})
+    return prices
+
+
+def _normalize_model(model: str) -> str:
+    # Les modèles LiteLLM sont préfixés par le fournisseur ("groq/qwen/qwen3-32b")
+    return model[len("groq/"):] if model.startswith("groq/") else model
+
+
+class UsageScope:
+    """Totaux des appels faits à l'intérieur d'un meter_scope"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.cached_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency_ms = 0.0
+        self.by_phase: Dict[str, Dict[str, int]] = {}
+
+    def add(self, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self.calls += 1
+            self.cached_calls += record["cached"]
+            self.prompt_tokens += record["prompt_tokens"]
+            self.completion_tokens += record["completion_tokens"]
+            self.latency_ms += record["latency_ms"]
+            phase = self.by_phase.setdefault(record["phase"] or "-", {"calls": 0, "total_tokens": 0})
+            phase["calls"] += 1
+            phase["total_tokens"] += record["total_tokens"]
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "cached_calls": self.cached_calls,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "total_tokens": self.prompt_tokens + self.completion_tokens,
+                "llm_latency_ms": round(self.latency_ms, 1),
+                "by_phase": {k: dict(v) for k, v in self.by_phase.items()},
+            }
+
+
+_tags: contextvars.ContextVar = contextvars.ContextVar("metering_tags", default=(None, None, ()))
+
+
+@contextlib.contextmanager
+def meter_scope(pipeline: Optional[str] = None, phase: Optional[str] = None) -> Iterator[UsageScope]:
+    """Étiquette les appels LLM du bloc. Le pipeline le plus externe l'emporte (un
+    plan_weekly_menu lancé par run_evaluation reste compté dans run_evaluation), la
+    phase la plus interne l'emporte."""
+    outer_pipeline, outer_phase, scopes = _tags.get()
+    scope = UsageScope()
+    token = _tags.set((outer_pipeline or pipeline, phase or outer_phase, scopes + (scope,)))
+    try:
+        yield scope
+    finally:
+        _tags.reset(token)
+
+
+def current_tags() -> Tuple[Optional[str], Optional[str]]:
+    pipeline, phase, _ = _tags.get()
+    return pipeline, phase
+
+
+def metered(pipeline: str):
+    """Décorateur de point d'entrée : étiquette ses appels LLM et ajoute leurs totaux
+    (llm_usage) aux metadata du span courant. À placer sous @observe."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with meter_scope(pipeline=pipeline) as usage:
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    try:
+                        get_client().update_current_observation(metadata={"llm_usage": usage.summary()})
+                    except Exception:
+                        pass
+        return wrapper
+    return decorator
+
+
+class UsageMeter:
+    """Agrégation en mémoire des enregistrements d'usage, par (pipeline, phase, modèle)"""
+
+    def __init__(self, max_records: int = 10000):
+        self._lock = threading.Lock()
+        self.records: deque = deque(maxlen=max_records)
+        self._totals: Dict[Tuple[str, str, str], Dict[str, float]] = {}
+        self.prices = _load_prices()
+
+    def record(self, model: str, usage: Any, latency_s: float, phase: Optional[str] = None,
+               cached: bool = False, attach: bool = True, pipeline: Optional[str] = None) -> Dict[str, Any]:
+        """Enregistre l'usage d'une complétion (objet usage OpenAI/Groq, TokenUsage smolagents ou dict)"""
+        scope_pipeline, scope_phase, scopes = _tags.get()
+        pipeline = pipeline or scope_pipeline
+
+        def _get(name):
+            value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+            return int(value or 0)
+
+        prompt_tokens = _get("prompt_tokens") or _get("input_tokens")
+        completion_tokens = _get("completion_tokens") or _get("output_tokens")
+        rec = {
+            "ts": time.time(),
+            "pipeline": pipeline or "-",
+            "phase": phase or scope_phase or "-",
+            "model": _normalize_model(model or "?"),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": _get("total_tokens") or prompt_tokens + completion_tokens,
+            "latency_ms": round(latency_s * 1000, 2),
+            "cached": bool(cached),
+        }
+        key = (rec["pipeline"], rec["phase"], rec["model"])
+        with self._lock:
+            self.records.append(rec)
+            totals = self._totals.setdefault(key, {
+                "calls": 0, "cached_calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "total_tokens": 0, "latency_ms": 0.0, "billed_prompt_tokens": 0, "billed_completion_tokens": 0,
+            })
+            totals["calls"] += 1
+            totals["cached_calls"] += rec["cached"]
+            totals["latency_ms"] += rec["latency_ms"]
+            for name in ("prompt_tokens", "completion_tokens", "total_tokens"):
+                totals[name] += rec[name]
+            if not rec["cached"]:
+                # Une réponse servie par le cache n'est pas facturée
+                totals["billed_prompt_tokens"] += prompt_tokens
+                totals["billed_completion_tokens"] += completion_tokens
+        for scope in scopes:
+            scope.add(rec)
+
+        if attach:
+            try:
+                get_client().update_current_observation(metadata={"llm_call": rec})
+            except Exception:
+                pass
+        return rec
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+        price = self.prices.get(model)
+        if price is None:
+            return None
+        return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+    def rows(self) -> List[Dict[str, Any]]:
+        """Une ligne par (pipeline, phase, modèle) avec le coût estimé"""
+        with self._lock:
+            items = [(k, dict(v)) for k, v in self._totals.items()]
+        rows = []
+        for (pipeline, phase, model), totals in sorted(items):
+            cost = self.cost(model, totals["billed_prompt_tokens"], totals["billed_completion_tokens"])
+            rows.append({
+                "pipeline": pipeline,
+                "phase": phase,
+                "model": model,
+                "calls": totals["calls"],
+                "cached_calls": totals["cached_calls"],
+                "prompt_tokens": totals["prompt_tokens"],
+                "completion_tokens": totals["completion_tokens"],
+                "total_tokens": totals["total_tokens"],
+                "avg_latency_ms": round(totals["latency_ms"] / totals["calls"], 1),
+                "cost_usd": round(cost, 6) if cost is not None else None,
+            })
+        return rows
+
+    def report(self) -> Dict[str, Any]:
+        rows = self.rows()
+        by_phase: Dict[str, Dict[str, Any]] = {}
+        by_model: Dict[str, Dict[str, Any]] = {}
+        for row in rows:
+            for group, key in ((by_phase, f"{row['pipeline']}/{row['phase']}"), (by_model, row["model"])):
+                agg = group.setdefault(key, {"calls": 0, "total_tokens": 0, "cost_usd": 0.0})
+                agg["calls"] += row["calls"]
+                agg["total_tokens"] += row["total_tokens"]
+                if row["cost_usd"] is None:
+                    agg["cost_unknown"] = True
+                else:
+                    agg["cost_usd"] = round(agg["cost_usd"] + row["cost_usd"], 6)
+        return {
+            "rows": rows,
+            "by_phase": by_phase,
+            "by_model": by_model,
+            "total_tokens": sum(r["total_tokens"] for r in rows),
+            "total_cost_usd": round(sum(r["cost_usd"] or 0.0 for r in rows), 6),
+        }
+
+    def write_report(self, path: str) -> None:
+        """Rapport JSON (détail + totaux par phase et par modèle) ou CSV (une ligne par groupe)"""
+        if path.lower().endswith(".csv"):
+            rows = self.rows()
+            fields = ["pipeline", "phase", "model", "calls", "cached_calls", "prompt_tokens",
+                      "completion_tokens", "total_tokens", "avg_latency_ms", "cost_usd"]
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self.report(), f, ensure_ascii=False, indent=2)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.records.clear()
+            self._totals.clear()
+
+
+_meter: Optional[UsageMeter] = None
+_meter_lock = threading.Lock()
+
+
+def get_meter() -> UsageMeter:
+    """Compteur partagé ; CHEFBOT_USAGE_REPORT=chemin.json|.csv écrit le rapport à la sortie"""
+    global _meter
+    with _meter_lock:
+        if _meter is None:
+            _meter = UsageMeter()
+            report_path = os.getenv("CHEFBOT_USAGE_REPORT")
+            if report_path:
+                atexit.register(_meter.write_report, report_path)
+        return _meter
@@ -0,0 +1,347 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+# Serveur local compatible OpenAI/Groq (POST .../chat/completions)
+# Sert à exécuter les points d'entrée sans l'API Groq : latence injectée selon une
+# distribution, débit de tokens, scripts d'appels d'outils et erreurs 429.
+#
+# Utilisation :
+#   python mock_groq_server.py --port 8765 --latency lognormal:0.3:0.5 --token-rate 400
+#   GROQ_BASE_URL=http://127.0.0.1:8765 GROQ_API_KEY=mock python chefbot.py
+
+DEFAULT_TOOL_SCRIPT = [
+    [{"name": "check_fridge", "arguments": {}}],
+    [
+        {"name": "get_recipe", "arguments": {"dish_name": "omelette"}},
+        {"name": "check_dietary_info", "arguments": {"ingredient": "oeufs"}},
+    ],
+]
+
+_FILLER = (
+    "Voici une proposition de saison : velouté de légumes, filet de poisson grillé à l'huile d'olive, "
+    "légumineuses mijotées et salade de fruits frais. Cuisson douce, assaisonnement simple, "
+    "présentation colorée et portions adaptées aux convives."
+).split()
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class LatencyModel:
+    """Distribution de latence avant le premier token, en secondes.
+
+    Spécifications acceptées : "fixed:0.2", "uniform:0.1:0.4", "lognormal:median:sigma".
+    """
+
+    def __init__(self, spec: str = "fixed:0.05"):
+        self.spec = spec
+        parts = spec.split(":")
+        self.kind = parts[0]
+        self.params = [float(p) for p in parts[1:]]
+        if self.kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Distribution de latence inconnue: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(self.params[0], self.params[1])
+        median, sigma = self.params
+        return rng.lognormvariate(0.0, sigma) * median
+
+
+class MockState:
+    """Configuration et compteurs partagés par les threads du serveur"""
+
+    def __init__(
+        self,
+        latency: str = "fixed:0.05",
+        token_rate: float = 1000.0,
+        completion_tokens: int = 120,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 0.05,
+        tool_script: Optional[List[List[Dict[str, Any]]]] = None,
+        seed: int = 0,
+    ):
+        self.latency = LatencyModel(latency)
+        self.token_rate = token_rate
+        self.completion_tokens = completion_tokens
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.tool_script = DEFAULT_TOOL_SCRIPT if tool_script is None else tool_script
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        # Intervalles (début, fin) en time.perf_counter() passés à servir des requêtes
+        self.intervals: List[Tuple[float, float]] = []
+
+    def draw(self) -> Tuple[float, bool]:
+        with self._lock:
+            self.requests += 1
+            limited = self._rng.random() < self.rate_limit_rate
+            if limited:
+                self.rate_limited += 1
+            return self.latency.sample(self._rng), limited
+
+    def record(self, start: float, end: float) -> None:
+        with self._lock:
+            self.intervals.append((start, end))
+
+    def busy_time(self, since: float, until: float) -> float:
+        """Temps (s) pendant lequel au moins une requête était en cours dans [since, until]"""
+        with self._lock:
+            spans = sorted((max(s, since), min(e, until)) for s, e in self.intervals if e > since and s < until)
+        total = 0.0
+        cur_start = cur_end = None
+        for s, e in spans:
+            if cur_end is None or s > cur_end:
+                if cur_end is not None:
+                    total += cur_end - cur_start
+                cur_start, cur_end = s, e
+            else:
+                cur_end = max(cur_end, e)
+        if cur_end is not None:
+            total += cur_end - cur_start
+        return total
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.rate_limited = 0
+            self.intervals = []
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"requests": self.requests, "rate_limited": self.rate_limited}
+
+
+# Réponses canned selon le prompt
+
+def _last_user_text(messages: List[Dict[str, Any]]) -> str:
+    for msg in reversed(messages):
+        if msg.get("role") == "user" and isinstance(msg.get("content"), str):
+            return msg["content"]
+    return ""
+
+
+def _canned_content(body: Dict[str, Any], state: MockState) -> str:
+    prompt = _last_user_text(body.get("messages", []))
+    if re.search(r"D[ée]compose", prompt):
+        return json.dumps([
+            {"step": 1, "title": "Analyser les contraintes", "instruction": "Lister les contraintes", "depends_on": []},
+            {"step": 2, "title": "Choisir les entrées", "instruction": "Proposer des entrées", "depends_on": [1]},
+            {"step": 3, "title": "Choisir les plats", "instruction": "Proposer des plats", "depends_on": [1]},
+            {"step": 4, "title": "Choisir les desserts", "instruction": "Proposer des desserts", "depends_on": [1]},
+            {"step": 5, "title": "Vérifier l'équilibre", "instruction": "Contrôler les apports", "depends_on": [2, 3, 4]},
+            {"step": 6, "title": "Liste de courses", "instruction": "Établir la liste", "depends_on": [5]},
+        ], ensure_ascii=False)
+    if "respect_contraintes" in prompt:
+        return json.dumps({"respect_contraintes": 0.8, "completude": 0.9, "budget": 0.7, "coherence": 0.8, "faisabilite": 0.9, "comment": "mock"})
+    if "pertinence" in prompt:
+        return json.dumps({"pertinence": 0.8, "creativite": 0.7, "praticite": 0.9, "comment": "mock"})
+    if "week_menu" in prompt:
+        days = ["lundi", "mardi", "mercredi", "jeudi", "vendredi", "samedi", "dimanche"]
+        return json.dumps({"week_menu": {d: {"dejeuner": "Salade de légumes et lentilles", "diner": "Poisson et légumes de saison"} for d in days}}, ensure_ascii=False)
+    if "services" in prompt:
+        return json.dumps({"services": ["entrée", "plat", "dessert"], "menu": {"entrée": "Velouté de potiron", "plat": "Ratatouille", "dessert": "Salade de fruits"}}, ensure_ascii=False)
+    words = [_FILLER[i % len(_FILLER)] for i in range(state.completion_tokens)]
+    return " ".join(words)
+
+
+def _scripted_tool_calls(body: Dict[str, Any], state: MockState) -> Optional[List[Dict[str, Any]]]:
+    if not body.get("tools"):
+        return None
+    turn = sum(1 for m in body.get("messages", []) if m.get("role") == "assistant" and m.get("tool_calls"))
+    if turn >= len(state.tool_script):
+        return None
+    return [
+        {
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+            "type": "function",
+            "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments", {}), ensure_ascii=False)},
+        }
+        for call in state.tool_script[turn]
+    ]
+
+
+class MockGroqHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Évite les 40 ms de Nagle + ACK retardé entre en-têtes et corps (fausserait le surcoût mesuré)
+    disable_nagle_algorithm = True
+    state: MockState = None  # défini par make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/mock/stats"):
+            self._send_json(200, self.state.snapshot())
+        elif self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": []})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        try:
+            body = json.loads(raw)
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid JSON"}})
+            return
+
+        start = time.perf_counter()
+        try:
+            self._complete(body)
+        finally:
+            self.state.record(start, time.perf_counter())
+
+    def _complete(self, body: Dict[str, Any]) -> None:
+        state = self.state
+        latency, limited = state.draw()
+        if limited:
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached (mock)", "type": "tokens", "code": "rate_limit_exceeded"}},
+                headers={"Retry-After": str(state.retry_after)},
+            )
+            return
+
+        model = body.get("model", "mock")
+        prompt_tokens = sum(estimate_tokens(json.dumps(m, ensure_ascii=False)) for m in body.get("messages", []))
+        tool_calls = _scripted_tool_calls(body, state)
+        content = None if tool_calls else _canned_content(body, state)
+        completion_tokens = estimate_tokens(content) if content else 10 * len(tool_calls)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:16]}"
+        created = int(time.time())
+
+        time.sleep(latency)
+        if body.get("stream"):
+            self._stream(completion_id, created, model, content or "", tool_calls, usage)
+            return
+
+        # Temps de génération simulé : completion_tokens / token_rate
+        time.sleep(completion_tokens / state.token_rate)
+        message = {"role": "assistant", "content": content}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            "usage": usage,
+        }, headers={"x-mock-latency-ms": f"{latency * 1000:.1f}"})
+
+    def _stream(self, completion_id, created, model, content, tool_calls, usage) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def _chunk(delta, finish_reason=None, x_groq=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            if x_groq:
+                payload["x_groq"] = x_groq
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        _chunk({"role": "assistant", "content": ""})
+        pieces = re.findall(r"\S+\s*", content)
+        per_token = 1.0 / self.state.token_rate
+        for piece in pieces:
+            _chunk({"content": piece})
+            time.sleep(per_token * estimate_tokens(piece))
+        _chunk({}, finish_reason="stop", x_groq={"id": completion_id, "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def make_server(host: str = "127.0.0.1", port: int = 0, **state_kwargs) -> ThreadingHTTPServer:
+    """Crée le serveur (port=0 : port libre). server.state donne accès aux compteurs."""
+    state = MockState(**state_kwargs)
+    handler = type("BoundMockGroqHandler", (MockGroqHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+
+def start_in_thread(**kwargs) -> Tuple[ThreadingHTTPServer, str]:
+    """Démarre le serveur en arrière-plan et retourne (server, base_url)"""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, name="mock-groq", daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serveur Groq/OpenAI simulé pour ChefBot")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="fixed:0.05", help="fixed:s | uniform:min:max | lognormal:median:sigma")
+    parser.add_argument("--token-rate", type=float, default=1000.0, help="tokens générés par seconde")
+    parser.add_argument("--completion-tokens", type=int, default=120, help="longueur des réponses texte libre")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="probabilité de répondre 429")
+    parser.add_argument("--retry-after", type=float, default=0.05)
+    parser.add_argument("--tool-script", help="fichier JSON: liste de tours, chaque tour = liste de {name, arguments}")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tool_script = None
+    if args.tool_script:
+        with open(args.tool_script, "r", encoding="utf-8") as f:
+            tool_script = json.load(f)
+
+    server = make_server(
+        args.host,
+        args.port,
+        latency=args.latency,
+        token_rate=args.token_rate,
+        completion_tokens=args.completion_tokens,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        tool_script=tool_script,
+        seed=args.seed,
+    )
+    print(f"Mock Groq sur http://{args.host}:{server.server_address[1]} (GROQ_BASE_URL)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import json
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from langfuse import get_client
+
+from metering import get_meter
+from text_matcher import MultiPatternMatcher, get_spec_matcher, normalize_text
+
+# Cascade de modèles : le moins cher d'abord
+# Chaque appel est d'abord tenté avec les modèles moins chers que le modèle du module
+# (CHEFBOT_CASCADE_MODELS, triés par prix), et le résultat est validé localement :
+#   - schéma JSON (plans et menus) ;
+#   - règles tirées des contraintes, comme rule_evaluator (aucun terme interdit) ;
+#   - plats connus de MenuDatabaseTool cités dans la réponse : allergènes exclus, régime,
+#     prix par personne.
+# Un résultat refusé passe au modèle suivant ; le modèle du module répond en dernier
+# recours sans être bloqué. Les taux d'escalade sont suivis par type de contrainte.
+
+# Types de contraintes : mots-clés (normalisés) et termes à éviter dans la réponse
+CONSTRAINT_RULES: Dict[str, Dict[str, List[str]]] = {
+    "vegan": {
+        "keywords": ["vegan", "vegane", "vegetalien", "vegetalienne"],
+        "avoid": ["viande", "poulet", "boeuf", "porc", "jambon", "poisson", "saumon", "thon", "lait", "fromage", "beurre", "oeuf", "miel", "crème"],
+    },
+    "vegetarien": {
+        "keywords": ["vegetarien", "vegetarienne", "vegetarian", "sans viande"],
+        "avoid": ["viande", "poulet", "boeuf", "porc", "jambon", "lardon", "poisson", "saumon", "thon", "crevette"],
+    },
+    "sans_gluten": {
+        "keywords": ["sans gluten", "coeliaque", "celiaque"],
+        "avoid": ["farine de blé", "pâtes", "pain", "semoule", "couscous"],
+    },
+    "sans_porc": {
+        "keywords": ["sans porc", "halal"],
+        "avoid": ["porc", "jambon", "lardon", "bacon", "saucisson"],
+    },
+    "diabete": {
+        "keywords": ["diabete", "diabetique", "sans sucre"],
+        "avoid": ["sucre", "miel", "sirop"],
+    },
+    "allergies": {"keywords": ["allergie", "allergique", "intolerance", "intolerant"], "avoid": []},
+    "budget": {"keywords": ["budget", "economique", "euro", "€", "pas cher"], "avoid": []},
+}
+
+# Allergènes reconnus dans les contraintes : termes à éviter, allergènes de MenuDatabaseTool
+ALLERGENS: Dict[str, Tuple[List[str], List[str]]] = {
+    "noix": (["noix", "noisette", "amande", "cajou", "pistache"], []),
+    "arachide": (["arachide", "cacahuète"], []),
+    "crustace": (["crustacé", "crevette", "homard", "crabe", "langoustine"], []),
+    "lait": (["lait", "fromage", "beurre", "crème"], ["lait", "beurre"]),
+    "lactose": (["lait", "fromage", "beurre", "crème"], ["lait", "beurre"]),
+    "oeuf": (["oeuf"], ["oeuf"]),
+    "poisson": (["poisson", "saumon", "thon", "cabillaud"], ["poisson"]),
+    "gluten": (["farine de blé", "pâtes", "pain"], ["gluten"]),
+    "soja": (["soja", "tofu"], []),
+    "sesame": (["sésame"], []),
+    "sulfite": (["vin"], ["sulfites"]),
+}
+
+_NEGATION_RE = re.compile(r"\bsans\s+\w+(?:\s+(?:de|d'|du|des|à|au|aux)\s*\w+)?", re.IGNORECASE)
+_BUDGET_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(?:€|euros?)", re.IGNORECASE)
+_PER_PERSON_RE = re.compile(r"par\s+personne|/\s*pers", re.IGNORECASE)
+_SERVINGS_RE = re.compile(r"(\d+)\s*(?:personnes?|adultes?|convives?|invités?)", re.IGNORECASE)
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+# Négations qui changent le sens d'une contrainte : « sans porc », « pas d'allergie aux noix »,
+# « ni aux crustacés », « aucune viande »
+_SIGNATURE_NEGATION_RE = re.compile(
+    r"\b(?:sans|pas|ni|aucune?|non)\s+(?:d'|d’|de\s+|du\s+|des\s+|aux?\s+)?\w+(?:\s+(?:de|d'|du|des|à|au|aux)\s*\w+)?",
+    re.IGNORECASE,
+)
+
+
+def _contains(padded: str, phrase: str) -> bool:
+    normalized = normalize_text(phrase)
+    return bool(normalized) and f" {normalized} " in padded
+
+
+@lru_cache(maxsize=512)
+def analyze_constraints(constraints: str) -> Dict[str, Any]:
+    """Types de contraintes, termes à éviter, allergènes et budget par personne"""
+    padded = f" {normalize_text(constraints or '')} "
+    types = [name for name, rule in CONSTRAINT_RULES.items() if any(_contains(padded, k) for k in rule["keywords"])]
+    if "vegan" in types and "vegetarien" not in types:
+        types.append("vegetarien")
+
+    avoid: List[str] = []
+    for name in types:
+        avoid += CONSTRAINT_RULES[name]["avoid"]
+    allergens: List[str] = []
+    db_allergens: List[str] = []
+    # Les allergènes ne sont lus que si une allergie est mentionnée ("allergie aux noix")
+    if "allergies" in types:
+        for name, (terms, db_names) in ALLERGENS.items():
+            if _contains(padded, name):
+                allergens.append(name)
+                avoid += terms
+                db_allergens += db_names
+    if "sans_gluten" in types:
+        db_allergens.append("gluten")
+
+    budget = None
+    amount = _BUDGET_RE.search(constraints or "")
+    if amount:
+        budget = float(amount.group(1).replace(",", "."))
+        servings = _SERVINGS_RE.search(constraints)
+        if not _PER_PERSON_RE.search(constraints) and servings and int(servings.group(1)) > 0:
+            budget /= int(servings.group(1))
+        if "budget" not in types:
+            types.append("budget")
+
+    return {
+        "types": types or ["general"],
+        "avoid": sorted(set(avoid)),
+        "allergens": allergens,
+        "db_allergens": sorted(set(db_allergens)),
+        "vegetarian": "vegetarien" in types,
+        "vegan": "vegan" in types,
+        "gluten_free": "sans_gluten" in types,
+        "budget_per_person": budget,
+    }
+
+
+def constraint_signature(text: str, numbers: bool = True) -> Tuple[Tuple[str, ...], ...]:
+    """Ce qui doit être identique pour que deux textes proches appellent la même réponse :
+    nombres (sauf numbers=False), négations (« sans X », « pas de X »...), types de
+    contraintes (régimes, budget) et allergènes"""
+    profile = analyze_constraints(text or "")
+    negations = sorted({normalize_text(m) for m in _SIGNATURE_NEGATION_RE.findall(text or "")})
+    return (
+        tuple(_NUMBER_RE.findall(text or "")) if numbers else (),
+        tuple(negations),
+        tuple(sorted(profile["types"])),
+        tuple(profile["allergens"]),
+    )
+
+
+def validate_schema(value: Any, schema: Dict[str, Any], path: str = "$") -> List[str]:
+    """Validation minimale (type, required, properties, items, additionalProperties)"""
+    expected = schema.get("type")
+    checks = {"object": dict, "array": list, "string": str, "integer": int, "number": (int, float), "boolean": bool}
+    if expected in checks and (not isinstance(value, checks[expected]) or (expected in ("integer", "number") and isinstance(value, bool))):
+        return [f"{path}: {expected} attendu"]
+    issues: List[str] = []
+    if isinstance(value, dict):
+        for key in schema.get("required", []):
+            if key not in value:
+                issues.append(f"{path}.{key}: absent")
+        properties = schema.get("properties", {})
+        extra = schema.get("additionalProperties")
+        for key, item in value.items():
+            sub = properties.get(key, extra if isinstance(extra, dict) else None)
+            if sub:
+                issues += validate_schema(item, sub, f"{path}.{key}")
+        if expected == "object" and not value:
+            issues.append(f"{path}: objet vide")
+    elif isinstance(value, list) and "items" in schema:
+        for i, item in enumerate(value):
+            issues += validate_schema(item, schema["items"], f"{path}[{i}]")
+    return issues
+
+
+_menu_db = None
+_menu_db_lock = threading.Lock()
+
+
+def _get_menu_db():
+    """MenuDatabaseTool partagé et automate des noms de plats (import paresseux de Partie5)"""
+    global _menu_db
+    with _menu_db_lock:
+        if _menu_db is None:
+            from Partie5 import MenuDatabaseTool
+
+            tool = MenuDatabaseTool()
+            dishes = list(tool.menu_data)
+            _menu_db = (dishes, MultiPatternMatcher([d["name"] for d in dishes]))
+        return _menu_db
+
+
+def check_output(text: str, constraints: str) -> List[str]:
+    """Problèmes détectés localement dans une réponse (vide si elle est acceptable)"""
+    profile = analyze_constraints(constraints)
+    # "sans viande", "sans gluten" : mentions négatives, pas des violations
+    cleaned = _NEGATION_RE.sub(" ", text or "")
+    issues: List[str] = []
+
+    if profile["avoid"]:
+        # Même règle que rule_evaluator : aucun terme de must_avoid dans la sortie
+        scores = get_spec_matcher({"must_avoid": profile["avoid"]}).score(cleaned)
+        if scores.get("avoid_violations"):
+            issues.append("termes interdits: " + ", ".join(scores["avoid_violations"]))
+
+    if profile["db_allergens"] or profile["vegetarian"] or profile["gluten_free"] or profile["budget_per_person"]:
+        dishes, matcher = _get_menu_db()
+        for i in sorted(matcher.find(cleaned)):
+            dish = dishes[i]
+            tags = set(dish.get("tags", []))
+            allergens = set(dish.get("allergens", []))
+            if allergens & set(profile["db_allergens"]):
+                issues.append(f"{dish['name']}: allergène {', '.join(sorted(allergens & set(profile['db_allergens'])))}")
+            if profile["vegan"] and "vegan" not in tags:
+                issues.append(f"{dish['name']}: non vegan")
+            elif profile["vegetarian"] and not tags & {"vegetarien", "vegan"}:
+                issues.append(f"{dish['name']}: non végétarien")
+            if profile["gluten_free"] and "gluten" in allergens and "sans gluten" not in tags:
+                issues.append(f"{dish['name']}: contient du gluten")
+            budget = profile["budget_per_person"]
+            if budget is not None and dish["price"] > budget:
+                issues.append(f"{dish['name']}: {dish['price']}€ > budget {budget:.2f}€/pers")
+    return issues
+
+
+def validate_answer(text: str, constraints: str, min_chars: int = 80) -> List[str]:
+    if not text or len(text.strip()) < min_chars:
+        return ["réponse vide ou trop courte"]
+    return check_output(text, constraints)
+
+
+def validate_menu(menu: Any, schema: Dict[str, Any], constraints: str) -> List[str]:
+    issues = validate_schema(menu, schema)
+    return issues or check_output(json.dumps(menu, ensure_ascii=False), constraints)
+
+
+def validate_plan(plan: Any, min_steps: int = 2, max_steps: int = 10) -> List[str]:
+    if not isinstance(plan, list) or not min_steps <= len(plan) <= max_steps:
+        return [f"plan de {len(plan) if isinstance(plan, list) else 0} étapes"]
+    return []
+
+
+class ModelCascade:
+    """Essaie les modèles du moins cher au modèle final, escalade si la validation échoue"""
+
+    def __init__(self, models: List[str]):
+        self.models = models
+        self._lock = threading.Lock()
+        self._by_type: Dict[str, Dict[str, int]] = {}
+        self._by_step: Dict[str, Dict[str, Any]] = {}
+
+    def tiers(self, final_model: str) -> List[str]:
+        """Modèles configurés moins chers que final_model (par prix de sortie), puis final_model"""
+        prices = get_meter().prices
+        final_price = prices.get(final_model, (float("inf"), float("inf")))
+        cheaper = [m for m in self.models if m != final_model and prices.get(m, (float("inf"),) * 2)[1] < final_price[1]]
+        return sorted(cheaper, key=lambda m: prices[m][1]) + [final_model]
+
+    def _record(self, key: str, types: List[str], served_by: str, escalations: int) -> None:
+        with self._lock:
+            for name in types:
+                stats = self._by_type.setdefault(name, {"requests": 0, "escalated": 0, "escalations": 0})
+                stats["requests"] += 1
+                stats["escalated"] += escalations > 0
+                stats["escalations"] += escalations
+            step = self._by_step.setdefault(key, {"requests": 0, "escalated": 0, "served_by": {}})
+            step["requests"] += 1
+            step["escalated"] += escalations > 0
+            step["served_by"][served_by] = step["served_by"].get(served_by, 0) + 1
+
+    def run(self, key: str, final_model: str, constraints: str,
+            attempt: Callable[[str, bool], Any], validate: Callable[[Any], List[str]]) -> Tuple[Any, str]:
+        """attempt(modèle, dernier) -> résultat ; validate(résultat) -> problèmes.
+        Renvoie (résultat, modèle qui l'a produit)."""
+        tiers = self.tiers(final_model)
+        types = analyze_constraints(constraints)["types"]
+        trail = []
+        for i, model in enumerate(tiers):
+            last = i == len(tiers) - 1
+            try:
+                result = attempt(model, last)
+                issues = [] if last else validate(result)
+            except Exception as e:
+                if last:
+                    raise
+                issues = [f"{type(e).__name__}: {e}"]
+            if not issues:
+                self._record(key, types, model, len(trail))
+                try:
+                    get_client().update_current_observation(metadata={"cascade": {
+                        "step": key, "model": model, "tier": i, "escalations": trail, "constraint_types": types,
+                    }})
+                except Exception:
+                    pass
+                return result, model
+            trail.append({"model": model, "issues": issues[:5]})
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            by_type = {k: dict(v) for k, v in self._by_type.items()}
+            by_step = {k: {**v, "served_by": dict(v["served_by"])} for k, v in self._by_step.items()}
+        for stats in list(by_type.values()) + list(by_step.values()):
+            stats["escalation_rate"] = round(stats["escalated"] / stats["requests"], 4) if stats["requests"] else 0.0
+        return {"by_constraint_type": by_type, "by_step": by_step}
+
+
+_cascade: Optional[ModelCascade] = None
+_cascade_lock = threading.Lock()
+
+
+def get_cascade() -> Optional[ModelCascade]:
+    """Cascade partagée, ou None si elle n'est pas activée (CHEFBOT_CASCADE=1).
+    CHEFBOT_CASCADE_MODELS : modèles candidats, séparés par des virgules."""
+    global _cascade
+    with _cascade_lock:
+        if _cascade is None and os.getenv("CHEFBOT_CASCADE", "0").strip().lower() in ("1", "true", "yes", "on"):
+            models = os.getenv("CHEFBOT_CASCADE_MODELS", "llama-3.1-8b-instant,openai/gpt-oss-20b")
+            _cascade = ModelCascade([m.strip() for m in models.split(",") if m.strip()])
+        return _cascade
+
+
+def run_cascade(key: str, final_model: str, constraints: str, attempt: Callable[[str, bool], Any],
+                validate: Callable[[Any], List[str]], enabled: Optional[bool] = None) -> Tuple[Any, str]:
+    """Passe par la cascade si elle est active (enabled=False la contourne), sinon appelle
+    directement le modèle final"""
+    cascade = get_cascade() if enabled is not False else None
+    if cascade is None:
+        return attempt(final_model, True), final_model
+    return cascade.run(key, final_model, constraints, attempt, validate)
@@ -0,0 +1,211 @@
+import json
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+from text_matcher import normalize_text
+
+# Table nutritionnelle en colonnes pour check_dietary_info
+# Construite une fois (données intégrées ou fichier JSON CHEFBOT_NUTRITION_PATH) :
+# un tableau NumPy par nutriment (valeurs pour 100 g ou 100 ml), un masque d'allergènes
+# par ingrédient (bit i = allergène i) et un index mot -> ligne. Un lot d'ingrédients
+# avec quantités est calculé en une seule opération vectorisée.
+
+NUTRIENTS = ("calories", "proteines", "lipides", "glucides")
+
+BUILTIN_NUTRITION = [
+    {
+        "name": "oeufs", "unit": "g",
+        "calories": 155, "proteines": 13, "lipides": 11, "glucides": 1,
+        "allergenes": ["œufs"],
+        "convient_pour": ["régime protéiné"],
+        "ne_convient_pas_pour": ["végan", "végétalien"],
+    },
+    {
+        "name": "lait", "unit": "ml",
+        "calories": 61, "proteines": 3.2, "lipides": 3.3, "glucides": 4.8,
+        "allergenes": ["lactose", "protéines laitières"],
+        "convient_pour": ["végétarien"],
+        "ne_convient_pas_pour": ["végan", "intolérant au lactose"],
+    },
+    {
+        "name": "poulet", "unit": "g",
+        "calories": 165, "proteines": 31, "lipides": 3.6, "glucides": 0,
+        "allergenes": [],
+        "convient_pour": ["régime protéiné", "sans gluten"],
+        "ne_convient_pas_pour": ["végan", "végétarien"],
+    },
+    {
+        "name": "champignons", "unit": "g",
+        "calories": 22, "proteines": 3.1, "lipides": 0.3, "glucides": 3.3,
+        "allergenes": [],
+        "convient_pour": ["végan", "végétarien", "sans gluten", "régime faible en calories"],
+        "ne_convient_pas_pour": [],
+    },
+    {
+        "name": "fromage", "unit": "g",
+        "calories": 402, "proteines": 25, "lipides": 33, "glucides": 1.3,
+        "allergenes": ["lactose", "protéines laitières"],
+        "convient_pour": ["végétarien"],
+        "ne_convient_pas_pour": ["végan", "intolérant au lactose"],
+    },
+    {
+        "name": "courgettes", "unit": "g",
+        "calories": 17, "proteines": 1.2, "lipides": 0.3, "glucides": 3.1,
+        "allergenes": [],
+        "convient_pour": ["végan", "végétarien", "sans gluten", "régime faible en calories"],
+        "ne_convient_pas_pour": [],
+    },
+]
+
+
+def _fmt(value: float) -> str:
+    return f"{float(value):g}"
+
+
+# Quantité saisie par un agent : 200, "200g", "1,5 kg", "25 cl"... ramenée en g ou ml
+_QUANTITY_RE = re.compile(r"^\s*(\d+(?:[.,]\d+)?)\s*(kg|mg|g|cl|ml|l)?\b", re.IGNORECASE)
+_UNIT_FACTORS = {None: 1.0, "g": 1.0, "ml": 1.0, "kg": 1000.0, "l": 1000.0, "cl": 10.0, "mg": 0.001}
+
+
+def parse_quantity(value: Any) -> Optional[float]:
+    """Quantité en g ou ml, None si illisible"""
+    if value is None or value == "":
+        return 0.0
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    match = _QUANTITY_RE.match(str(value))
+    if not match:
+        return None
+    unit = match.group(2).lower() if match.group(2) else None
+    return float(match.group(1).replace(",", ".")) * _UNIT_FACTORS[unit]
+
+
+class NutritionTable:
+    """Valeurs nutritionnelles en colonnes NumPy + masque d'allergènes"""
+
+    def __init__(self, rows: Sequence[Dict[str, Any]]):
+        self.names: List[str] = [r["name"] for r in rows]
+        self.units: List[str] = [r.get("unit", "g") for r in rows]
+        self.columns: Dict[str, np.ndarray] = {
+            n: np.array([float(r.get(n, 0.0)) for r in rows], dtype=np.float64) for n in NUTRIENTS
+        }
+
+        self.allergen_names: List[str] = sorted({a for r in rows for a in r.get("allergenes", [])})
+        if len(self.allergen_names) > 64:
+            raise ValueError("NutritionTable: 64 allergènes au maximum")
+        bit = {a: i for i, a in enumerate(self.allergen_names)}
+        self.allergen_mask = np.array(
+            [sum(1 << bit[a] for a in set(r.get("allergenes", []))) for r in rows], dtype=np.uint64
+        )
+        self.suitable_for = [tuple(r.get("convient_pour", [])) for r in rows]
+        self.not_suitable_for = [tuple(r.get("ne_convient_pas_pour", [])) for r in rows]
+
+        # Index : nom normalisé -> ligne (les noms de plusieurs mots sont cherchés comme sous-séquence)
+        self._by_key: Dict[str, int] = {}
+        for i, name in enumerate(self.names):
+            self._by_key.setdefault(normalize_text(name), i)
+        self._multiword = [k for k in self._by_key if " " in k]
+
+    @classmethod
+    def from_file(cls, path: str) -> "NutritionTable":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def lookup(self, ingredient: str) -> Optional[int]:
+        """Ligne de la table pour un libellé libre ("200g de fromage râpé" -> fromage)"""
+        normalized = normalize_text(ingredient)
+        padded = f" {normalized} "
+        for key in self._multiword:
+            if f" {key} " in padded:
+                return self._by_key[key]
+        for token in normalized.split():
+            row = self._by_key.get(token)
+            if row is not None:
+                return row
+        return None
+
+    def allergens_of(self, mask: int) -> List[str]:
+        return [a for i, a in enumerate(self.allergen_names) if mask >> i & 1]
+
+    def describe(self, ingredient: str) -> str:
+        row = self.lookup(ingredient)
+        if row is None:
+            return f"Pas d'informations disponibles pour '{ingredient}'"
+        unit = self.units[row]
+        allergens = self.allergens_of(int(self.allergen_mask[row]))
+        not_suitable = self.not_suitable_for[row]
+        result = f"\nInformations nutritionnelles pour {ingredient}:\n"
+        result += f"- Calories: {_fmt(self.columns['calories'][row])} kcal/100{unit}\n"
+        result += f"- Protéines: {_fmt(self.columns['proteines'][row])}g\n"
+        result += f"- Lipides: {_fmt(self.columns['lipides'][row])}g\n"
+        result += f"- Glucides: {_fmt(self.columns['glucides'][row])}g\n"
+        result += f"- Allergènes: {', '.join(allergens) if allergens else 'Aucun'}\n"
+        result += f"- Convient pour: {', '.join(self.suitable_for[row])}\n"
+        result += f"- Ne convient pas pour: {', '.join(not_suitable) if not_suitable else 'Tout le monde'}\n"
+        return result
+
+    def batch(self, items: Sequence[Union[Dict[str, Any], str]]) -> Dict[str, Any]:
+        """Calories et macros par ingrédient et au total, union des allergènes.
+
+        items: [{"ingredient": "poulet", "quantity": 600}, ...] (quantité en g ou ml,
+        100 par défaut, "200g" ou "1,5 kg" acceptés) ; une chaîne seule vaut 100 g.
+        Un item illisible (quantité, type) est rangé dans "inconnus" au lieu de lever.
+        """
+        labels, rows, quantities, unknown = [], [], [], []
+        for item in items:
+            if isinstance(item, str):
+                item = {"ingredient": item}
+            if not isinstance(item, dict):
+                unknown.append(str(item))
+                continue
+            label = str(item.get("ingredient", ""))
+            row = self.lookup(label)
+            quantity = parse_quantity(item.get("quantity", 100))
+            if row is None or quantity is None:
+                unknown.append(label if quantity is not None else f"{label} (quantité: {item.get('quantity')})")
+                continue
+            labels.append(label)
+            rows.append(row)
+            quantities.append(quantity)
+
+        idx = np.array(rows, dtype=np.intp)
+        factors = np.array(quantities, dtype=np.float64) / 100.0
+        per_nutrient = {n: self.columns[n][idx] * factors for n in NUTRIENTS}
+        mask = int(np.bitwise_or.reduce(self.allergen_mask[idx])) if rows else 0
+
+        per_item = []
+        for i, row in enumerate(rows):
+            entry = {"ingredient": labels[i], "matched": self.names[row], "quantity": quantities[i], "unit": self.units[row]}
+            entry.update({n: round(float(per_nutrient[n][i]), 2) for n in NUTRIENTS})
+            entry["allergenes"] = self.allergens_of(int(self.allergen_mask[row]))
+            per_item.append(entry)
+
+        not_suitable = sorted({d for row in rows for d in self.not_suitable_for[row]})
+        return {
+            "items": per_item,
+            "total": {n: round(float(per_nutrient[n].sum()), 2) for n in NUTRIENTS},
+            "allergenes": self.allergens_of(mask),
+            "ne_convient_pas_pour": not_suitable,
+            "inconnus": unknown,
+        }
+
+
+_table: Optional[NutritionTable] = None
+_table_lock = threading.Lock()
+
+
+def get_nutrition_table() -> NutritionTable:
+    """Table partagée : fichier CHEFBOT_NUTRITION_PATH s'il est défini, sinon données intégrées"""
+    global _table
+    with _table_lock:
+        if _table is None:
+            path = os.getenv("CHEFBOT_NUTRITION_PATH")
+            _table = NutritionTable.from_file(path) if path else NutritionTable(BUILTIN_NUTRITION)
+        return _table
@@ -0,0 +1,106 @@
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional
+
+# Exécution d'un plan sous forme de graphe de dépendances (DAG)
+# Chaque étape déclare "depends_on": [numéros d'étapes]. Les étapes dont les
+# dépendances sont satisfaites partent en parallèle, dans la limite de max_concurrency.
+
+
+def step_id(step: Dict[str, Any], index: int) -> Any:
+    return step.get("step", index + 1)
+
+
+def normalize_plan(plan: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Retourne une copie du plan où chaque étape a un "depends_on" valide et acyclique.
+
+    Seules les dépendances vers des étapes situées plus haut dans la liste sont gardées.
+    Si aucune étape ne déclare "depends_on" (le modèle a ignoré la consigne), on
+    retombe sur une exécution en chaîne, comme avant.
+    """
+    declared = any(isinstance(s, dict) and "depends_on" in s for s in plan)
+    normalized = []
+    seen = []
+    for index, step in enumerate(plan):
+        step = dict(step) if isinstance(step, dict) else {"instruction": str(step)}
+        sid = step_id(step, index)
+        while sid in seen:
+            # Numéro d'étape dupliqué : on en attribue un libre
+            sid = len(seen) + 1 if not isinstance(sid, int) else sid + 1
+        step["step"] = sid
+        if declared:
+            raw = step.get("depends_on") or []
+            if not isinstance(raw, list):
+                raw = [raw]
+            deps = []
+            for d in raw:
+                # Le modèle renvoie parfois "2" au lieu de 2
+                match = next((s for s in seen if str(s) == str(d)), None)
+                if match is not None and match not in deps:
+                    deps.append(match)
+        else:
+            deps = [seen[-1]] if seen else []
+        step["depends_on"] = deps
+        seen.append(sid)
+        normalized.append(step)
+    return normalized
+
+
+def critical_path_length(plan: List[Dict[str, Any]]) -> int:
+    """Nombre d'étapes sur le plus long chemin du DAG (plan normalisé)"""
+    depth: Dict[Any, int] = {}
+    for step in plan:
+        depth[step["step"]] = 1 + max((depth[d] for d in step["depends_on"]), default=0)
+    return max(depth.values(), default=0)
+
+
+def run_plan_dag(
+    plan: List[Dict[str, Any]],
+    execute: Callable[[Dict[str, Any], Dict[str, Any]], str],
+    base_context: Dict[str, Any],
+    max_concurrency: int = 4,
+    on_error: Optional[Callable[[Dict[str, Any], Exception], None]] = None,
+) -> List[Dict[str, Any]]:
+    """Exécute un plan normalisé et retourne [{"step", "output"}] dans l'ordre du plan.
+
+    Chaque étape reçoit base_context plus les sorties de ses seules dépendances
+    (clés "step_<n>"). Une étape en erreur produit "Error: ..." et ses dépendantes
+    s'exécutent quand même.
+    """
+    # 0 ou négatif (ex: CHEFBOT_PLAN_CONCURRENCY=0) : exécution séquentielle
+    max_concurrency = max(1, int(max_concurrency or 1))
+    outputs: Dict[Any, str] = {}
+    pending = list(plan)
+    running = {}
+
+    def _context_for(step):
+        ctx = dict(base_context)
+        for dep in step["depends_on"]:
+            ctx[f"step_{dep}"] = outputs[dep]
+        return ctx
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        while pending or running:
+            for step in [s for s in pending if all(d in outputs for d in s["depends_on"])]:
+                if len(running) >= max_concurrency:
+                    break
+                pending.remove(step)
+                # copy_context pour garder la trace Langfuse parente dans le thread
+                ctx = contextvars.copy_context()
+                running[pool.submit(ctx.run, execute, step, _context_for(step))] = step
+
+            if not running:
+                # Ne devrait pas arriver avec un plan normalisé
+                raise ValueError("Plan DAG bloqué: dépendances non satisfaisables")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    outputs[step["step"]] = future.result()
+                except Exception as e:
+                    if on_error is not None:
+                        on_error(step, e)
+                    outputs[step["step"]] = f"Error: {e}"
+
+    return [{"step": step, "output": outputs[step["step"]]} for step in plan]
@@ -0,0 +1,323 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from langfuse import get_client
+
+from context_budget import estimate_messages_tokens
+
+# Ordonnanceur des appels LLM, commun à tout le process
+# Chaque modèle a deux seaux à jetons : requêtes/minute et tokens/minute. Un appel n'est
+# admis que si les deux seaux le permettent ; ses tokens sont estimés localement (prompt
+# + complétion attendue) puis corrigés avec l'usage réel renvoyé par l'API. Les appels en
+# attente passent par ordre de priorité (interactive avant default avant batch), puis
+# d'arrivée. Un 429 bloque le modèle pour tout le monde pendant Retry-After (ou un délai
+# exponentiel) puis l'appel est retenté. Les appels Groq (chat_completion) et les modèles
+# LiteLLM (MeteredLiteLLMModel) passent tous par get_scheduler().
+
+# Limites par défaut de l'offre gratuite Groq (requêtes/min, tokens/min) ; surchargeables
+# par un fichier JSON {"modele": [rpm, tpm]} désigné par CHEFBOT_RATE_LIMITS_FILE
+# ("*" pour les modèles absents), ou désactivées par CHEFBOT_RATE_LIMITS=off
+MODEL_LIMITS: Dict[str, Tuple[float, float]] = {
+    "llama-3.1-8b-instant": (30, 6000),
+    "llama-3.3-70b-versatile": (30, 12000),
+    "meta-llama/llama-3.3-70b-versatile": (30, 12000),
+    "meta-llama/llama-4-scout-17b-16e-instruct": (30, 30000),
+    "meta-llama/llama-4-maverick-17b-128e-instruct": (30, 6000),
+    "openai/gpt-oss-120b": (30, 8000),
+    "openai/gpt-oss-20b": (30, 8000),
+    "qwen/qwen3-32b": (60, 6000),
+}
+
+PRIORITIES = {"interactive": 0, "default": 1, "batch": 2}
+
+_priority: contextvars.ContextVar = contextvars.ContextVar("scheduler_priority", default=None)
+
+
+@contextlib.contextmanager
+def priority(name: str) -> Iterator[None]:
+    """Classe de priorité des appels LLM du bloc (interactive, default, batch). La classe
+    la plus externe l'emporte : un ask_chef lancé par une évaluation reste en batch."""
+    if name not in PRIORITIES:
+        raise ValueError(f"Priorité inconnue: {name}")
+    token = _priority.set(_priority.get() or name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> str:
+    return _priority.get() or "default"
+
+
+def _normalize_model(model: Optional[str]) -> str:
+    model = model or "?"
+    return model[len("groq/"):] if model.startswith("groq/") else model
+
+
+def _load_limits() -> Optional[Dict[str, Tuple[float, float]]]:
+    if os.getenv("CHEFBOT_RATE_LIMITS", "on").strip().lower() in ("0", "off", "false", "no"):
+        return None
+    limits = dict(MODEL_LIMITS)
+    path = os.getenv("CHEFBOT_RATE_LIMITS_FILE")
+    if path:
+        with open(path, encoding="utf-8") as f:
+            limits.update({k: tuple(v) for k, v in json.load(f).items()})
+    return limits
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Délai Retry-After d'une erreur 429 (Groq, OpenAI ou LiteLLM), ou None"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for name in ("retry-after", "Retry-After", "x-ratelimit-reset-requests"):
+        value = headers.get(name) if hasattr(headers, "get") else None
+        if value:
+            try:
+                return float(str(value).rstrip("s"))
+            except ValueError:
+                continue
+    return None
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429 or type(error).__name__ == "RateLimitError"
+
+
+class _ModelLane:
+    """Seaux à jetons et file d'attente d'un modèle"""
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = float(rpm)
+        self.tpm = float(tpm)
+        self.requests = self.rpm
+        self.tokens = self.tpm
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiting: List[Tuple[int, int]] = []   # tas de (priorité, numéro d'arrivée)
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60.0)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60.0)
+
+    def delay(self, tokens: float, now: float) -> float:
+        """Temps avant de pouvoir admettre un appel de tokens tokens (0 si admissible)"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        need_requests = max(0.0, 1.0 - self.requests) * 60.0 / self.rpm
+        need_tokens = max(0.0, tokens - self.tokens) * 60.0 / self.tpm
+        return max(need_requests, need_tokens)
+
+
+class RateScheduler:
+    """Admission des appels LLM par modèle, priorités et gestion des 429"""
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[float, float]]] = None,
+                 completion_estimate: int = 512, max_retries: int = 3, base_backoff: float = 1.0):
+        self.limits = limits
+        self.completion_estimate = completion_estimate
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self._cond = threading.Condition()
+        self._lanes: Dict[str, _ModelLane] = {}
+        self._arrivals = itertools.count()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def _lane(self, model: str) -> Optional[_ModelLane]:
+        if self.limits is None:
+            return None
+        lane = self._lanes.get(model)
+        if lane is None:
+            limit = self.limits.get(model) or self.limits.get("*")
+            if limit is None:
+                return None
+            lane = self._lanes[model] = _ModelLane(*limit)
+        return lane
+
+    def _stat(self, model: str) -> Dict[str, float]:
+        return self._stats.setdefault(model, {
+            "calls": 0, "queued": 0, "wait_s": 0.0, "max_wait_s": 0.0,
+            "rate_limited": 0, "retries": 0, "estimated_tokens": 0, "actual_tokens": 0,
+        })
+
+    def estimate(self, params: Dict[str, Any]) -> int:
+        """Tokens prompt estimés localement + complétion attendue (bornée par max_tokens)"""
+        prompt = estimate_messages_tokens(params.get("messages") or [], params.get("tools"))
+        max_tokens = params.get("max_tokens") or params.get("max_completion_tokens")
+        completion = min(int(max_tokens), self.completion_estimate) if max_tokens else self.completion_estimate
+        return prompt + completion
+
+    def acquire(self, model: str, tokens: int, priority_name: Optional[str] = None) -> float:
+        """Bloque jusqu'à l'admission de l'appel ; renvoie le temps d'attente en secondes"""
+        model = _normalize_model(model)
+        start = time.monotonic()
+        rank = PRIORITIES.get(priority_name or current_priority(), PRIORITIES["default"])
+        with self._cond:
+            stat = self._stat(model)
+            stat["calls"] += 1
+            stat["estimated_tokens"] += tokens
+            lane = self._lane(model)
+            if lane is None:
+                return 0.0
+            tokens = min(tokens, lane.tpm)   # un appel plus gros que le seau ne passerait jamais
+            ticket = (rank, next(self._arrivals))
+            heapq.heappush(lane.waiting, ticket)
+            queued = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    lane.refill(now)
+                    if lane.waiting[0] == ticket:
+                        delay = lane.delay(tokens, now)
+                        if delay <= 0:
+                            lane.requests -= 1
+                            lane.tokens -= tokens
+                            break
+                    else:
+                        delay = 0.05
+                    queued = True
+                    self._cond.wait(timeout=min(delay, 1.0))
+            finally:
+                lane.waiting.remove(ticket)
+                heapq.heapify(lane.waiting)
+                self._cond.notify_all()
+            waited = time.monotonic() - start
+            if queued:
+                stat["queued"] += 1
+            stat["wait_s"] += waited
+            stat["max_wait_s"] = max(stat["max_wait_s"], waited)
+            return waited
+
+    def settle(self, model: str, estimated: int, usage: Any) -> None:
+        """Corrige le seau de tokens avec l'usage réel (le solde peut devenir négatif)"""
+        model = _normalize_model(model)
+        if usage is None:
+            return
+        total = usage.get("total_tokens") if isinstance(usage, dict) else getattr(usage, "total_tokens", None)
+        if total is None:
+            prompt = getattr(usage, "input_tokens", 0) or 0
+            completion = getattr(usage, "output_tokens", 0) or 0
+            total = prompt + completion
+        with self._cond:
+            self._stat(model)["actual_tokens"] += int(total or 0)
+            lane = self._lane(model)
+            if lane is not None:
+                lane.tokens -= int(total or 0) - min(estimated, lane.tpm)
+                self._cond.notify_all()
+
+    def penalize(self, model: str, retry_after: float) -> bool:
+        """429 reçu : le modèle est bloqué pour tous les appelants pendant retry_after.
+        Renvoie False si le modèle n'est pas limité ici (l'appelant attend lui-même)."""
+        model = _normalize_model(model)
+        with self._cond:
+            stat = self._stat(model)
+            stat["rate_limited"] += 1
+            stat["retries"] += 1
+            lane = self._lane(model)
+            if lane is not None:
+                lane.blocked_until = max(lane.blocked_until, time.monotonic() + retry_after)
+                lane.tokens = min(lane.tokens, 0.0)
+            self._cond.notify_all()
+            return lane is not None
+
+    def _backoff(self, error: Exception, attempt: int) -> float:
+        delay = retry_after_seconds(error)
+        if delay is None:
+            delay = self.base_backoff * (2 ** attempt) * (1 + random.random() * 0.25)
+        return delay
+
+    def call(self, model: str, params: Dict[str, Any], fn: Callable[[], Any],
+             usage_of: Callable[[Any], Any] = lambda r: getattr(r, "usage", None)) -> Any:
+        """Exécute fn() une fois admis, avec nouvel essai sur 429 ; l'usage de la réponse
+        (usage_of) corrige l'estimation"""
+        estimated = self.estimate(params)
+        waited = 0.0
+        for attempt in range(self.max_retries + 1):
+            waited += self.acquire(model, estimated)
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(e, attempt)
+                if not self.penalize(model, delay):
+                    time.sleep(delay)   # sans seaux, personne d'autre n'applique l'attente
+                continue
+            self.settle(model, estimated, usage_of(result))
+            if waited >= 0.001 or attempt:
+                try:
+                    get_client().update_current_observation(metadata={"scheduler": {
+                        "wait_ms": round(waited * 1000, 1), "retries": attempt,
+                        "priority": current_priority(), "estimated_tokens": estimated,
+                    }})
+                except Exception:
+                    pass
+            return result
+
+    async def acall(self, model: str, params: Dict[str, Any], fn: Callable[[], Any],
+                    usage_of: Callable[[Any], Any] = lambda r: getattr(r, "usage", None)) -> Any:
+        """Variante asynchrone : fn renvoie une coroutine ; l'attente se fait hors de la boucle"""
+        estimated = self.estimate(params)
+        waited = 0.0
+        for attempt in range(self.max_retries + 1):
+            # to_thread copie le contexte : la priorité courante est conservée
+            waited += await asyncio.to_thread(self.acquire, model, estimated)
+            try:
+                result = await fn()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(e, attempt)
+                if not self.penalize(model, delay):
+                    await asyncio.sleep(delay)
+                continue
+            self.settle(model, estimated, usage_of(result))
+            if waited >= 0.001 or attempt:
+                try:
+                    get_client().update_current_observation(metadata={"scheduler": {
+                        "wait_ms": round(waited * 1000, 1), "retries": attempt,
+                        "priority": current_priority(), "estimated_tokens": estimated,
+                    }})
+                except Exception:
+                    pass
+            return result
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._cond:
+            stats = {k: dict(v) for k, v in self._stats.items()}
+            for model, lane in self._lanes.items():
+                stats.setdefault(model, {}).update(
+                    rpm=lane.rpm, tpm=lane.tpm, waiting=len(lane.waiting),
+                    tokens_available=round(lane.tokens), requests_available=round(lane.requests, 2),
+                )
+        return stats
+
+
+_scheduler: Optional[RateScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RateScheduler:
+    """Ordonnanceur partagé ; CHEFBOT_COMPLETION_ESTIMATE (tokens de complétion supposés
+    avant correction, défaut 512), CHEFBOT_RATE_RETRIES (nouveaux essais sur 429, défaut 3)"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RateScheduler(
+                limits=_load_limits(),
+                completion_estimate=int(os.getenv("CHEFBOT_COMPLETION_ESTIMATE", "512")),
+                max_retries=int(os.getenv("CHEFBOT_RATE_RETRIES", "3")),
+            )
+        return _scheduler
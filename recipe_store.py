@@ -0,0 +1,335 @@
+import csv
+import heapq
+import json
+import mmap
+import os
+import threading
+from array import array
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from text_matcher import normalize_text
+
+# Magasin de recettes pour get_recipe
+# Le corpus (JSONL ou CSV, une recette par ligne) est chargé paresseusement au premier
+# appel : on ne garde en mémoire que les noms et les positions (offset, longueur) des
+# lignes ; les corps de recettes sont relus à la demande depuis un mmap du fichier.
+# La recherche floue combine un index inversé de mots et un index de trigrammes de
+# caractères sur les noms, puis reclasse les meilleurs candidats par similarité exacte.
+
+# Un mot ou trigramme présent dans plus de cette fraction du corpus ne sert pas à générer des candidats
+_COMMON_RATIO = 0.005
+_MIN_POSTINGS_LIMIT = 50
+_FUZZY_TRIGRAMS = 4
+_RERANK_CANDIDATES = 64
+
+
+def _trigrams(normalized: str) -> List[str]:
+    padded = f"  {normalized} "
+    return list({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+
+def _first_bits(mask: int, n: int) -> List[int]:
+    bits = bin(mask)[:1:-1]        # bit de poids faible en premier
+    found, pos = [], bits.find("1")
+    while pos != -1 and len(found) < n:
+        found.append(pos)
+        pos = bits.find("1", pos + 1)
+    return found
+
+
+def _record_text(record: Dict[str, Any]) -> str:
+    """Texte de recette lisible à partir d'un enregistrement JSONL/CSV"""
+    if record.get("text"):
+        return record["text"]
+    lines = [record.get("name") or record.get("title") or ""]
+    ingredients = record.get("ingredients")
+    if ingredients:
+        if isinstance(ingredients, str):
+            ingredients = [i.strip() for i in ingredients.replace("|", ";").split(";") if i.strip()]
+        lines += ["", "Ingrédients:"] + [f"- {i}" for i in ingredients]
+    instructions = record.get("instructions")
+    if instructions:
+        if isinstance(instructions, str):
+            instructions = [i.strip() for i in instructions.replace("|", "\n").split("\n") if i.strip()]
+        lines += ["", "Instructions:"] + [f"{n}. {step}" for n, step in enumerate(instructions, 1)]
+    return "\n".join(lines)
+
+
+class RecipeStore:
+    """Index de recherche sur un corpus de recettes (fichier mmap ou liste en mémoire)"""
+
+    def __init__(self, path: Optional[str] = None, records: Optional[List[Dict[str, Any]]] = None):
+        if (path is None) == (records is None):
+            raise ValueError("RecipeStore attend soit path, soit records")
+        self.path = path
+        self._records = records
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._mmap: Optional[mmap.mmap] = None
+        self._file = None
+        self._csv_header: Optional[List[str]] = None
+
+        self._names: List[str] = []
+        self._padded: List[str] = []          # " nom normalisé " : tests de sous-chaînes au classement
+        self._trigram_counts = array("H")
+        self._spans = array("Q")            # offset, longueur de chaque ligne (mode fichier)
+        self._by_name: Dict[str, int] = {}
+        self._token_index: Dict[str, array] = {}
+        self._trigram_index: Dict[str, array] = {}
+        self._mask_cache: Dict[str, int] = {}
+        self._trigram_mask_cache: Dict[str, int] = {}
+
+    # Chargement paresseux
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if self._records is not None:
+                for record in self._records:
+                    self._add_name(record.get("name") or record.get("title") or "", record.get("aliases", []))
+            else:
+                self._load_file()
+            self._loaded = True
+
+    def _load_file(self) -> None:
+        self._file = open(self.path, "rb")
+        if os.fstat(self._file.fileno()).st_size == 0:
+            return
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        is_csv = self.path.lower().endswith(".csv")
+        offset = 0
+        size = self._mmap.size()
+        while offset < size:
+            end = self._mmap.find(b"\n", offset)
+            if end == -1:
+                end = size
+            line = self._mmap[offset:end]
+            if line.strip():
+                if is_csv and self._csv_header is None:
+                    self._csv_header = next(csv.reader([line.decode("utf-8-sig")]))
+                else:
+                    record = self._parse_line(line)
+                    if record is not None:
+                        self._spans.append(offset)
+                        self._spans.append(end - offset)
+                        self._add_name(record.get("name") or record.get("title") or "", record.get("aliases", []))
+            offset = end + 1
+
+    def _parse_line(self, line: bytes) -> Optional[Dict[str, Any]]:
+        try:
+            text = line.decode("utf-8")
+            if self._csv_header is not None:
+                return dict(zip(self._csv_header, next(csv.reader([text]))))
+            return json.loads(text)
+        except (ValueError, StopIteration):
+            return None
+
+    def _add_name(self, name: str, aliases: List[str]) -> None:
+        idx = len(self._names)
+        normalized = normalize_text(" ".join([name] + list(aliases or [])))
+        trigrams = _trigrams(normalized)
+        self._names.append(name)
+        self._padded.append(f"  {normalized} ")
+        self._trigram_counts.append(min(len(trigrams), 65535))
+        self._by_name.setdefault(normalize_text(name), idx)
+        for tok in set(normalized.split()):
+            self._token_index.setdefault(tok, array("I")).append(idx)
+        for tri in trigrams:
+            self._trigram_index.setdefault(tri, array("I")).append(idx)
+
+    def _bitset(self, postings: array) -> int:
+        bits = bytearray((len(self._names) + 7) // 8)
+        for idx in postings:
+            bits[idx >> 3] |= 1 << (idx & 7)
+        return int.from_bytes(bits, "little")
+
+    def _token_mask(self, token: str) -> int:
+        """Bitset des noms contenant un mot fréquent (construit à la demande puis gardé)"""
+        mask = self._mask_cache.get(token)
+        if mask is None:
+            mask = self._mask_cache[token] = self._bitset(self._token_index[token])
+        return mask
+
+    def _trigram_mask(self, trigram: str) -> int:
+        """Bitset des noms contenant un trigramme fréquent (construit à la demande puis gardé)"""
+        mask = self._trigram_mask_cache.get(trigram)
+        if mask is None:
+            mask = self._trigram_mask_cache[trigram] = self._bitset(self._trigram_index[trigram])
+        return mask
+
+    # Accès
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._names)
+
+    def name(self, idx: int) -> str:
+        self._ensure_loaded()
+        return self._names[idx]
+
+    def get_record(self, idx: int) -> Dict[str, Any]:
+        self._ensure_loaded()
+        if self._records is not None:
+            return self._records[idx]
+        offset, length = self._spans[2 * idx], self._spans[2 * idx + 1]
+        return self._parse_line(self._mmap[offset:offset + length]) or {}
+
+    def get_text(self, idx: int) -> str:
+        return _record_text(self.get_record(idx))
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[float, int]]:
+        """Top-k (score entre 0 et 1, indice) pour un nom de plat, même partiel ou mal orthographié"""
+        self._ensure_loaded()
+        normalized = normalize_text(query)
+        if not normalized or not self._names:
+            return []
+
+        query_tokens = set(normalized.split())
+        query_trigrams = _trigrams(normalized)
+        limit = max(_MIN_POSTINGS_LIMIT, int(len(self._names) * _COMMON_RATIO))
+
+        # Candidats : liste du mot le plus rare de la requête (les mots trop fréquents,
+        # ex. "de", "au", sont ignorés), complétée par les trigrammes rares si un mot
+        # est inconnu (faute de frappe) ou si le mot seul donne trop peu de résultats
+        candidates = set()
+        mask = None
+        known = sorted((t for t in query_tokens if t in self._token_index), key=lambda t: len(self._token_index[t]))
+        if known:
+            rarest = self._token_index[known[0]]
+            others = [f" {t} " for t in known[1:]]
+            if len(rarest) <= limit:
+                candidates.update(rarest)
+                # On ne classe que les noms contenant tous les mots connus s'il y en a assez
+                complete = {idx for idx in candidates if all(o in self._padded[idx] for o in others)}
+                if len(complete) >= k:
+                    candidates = complete
+            else:
+                # Tous les mots sont fréquents : intersection des bitsets, premiers noms retenus
+                mask = self._token_mask(known[0])
+                for tok in known[1:]:
+                    narrowed = mask & self._token_mask(tok)
+                    if narrowed:
+                        mask = narrowed
+                candidates.update(_first_bits(mask, _RERANK_CANDIDATES))
+        votes: Counter = Counter()
+        if len(known) < len(query_tokens) or len(candidates) < k:
+            by_size = sorted(
+                (t for t in query_trigrams if t in self._trigram_index), key=lambda t: len(self._trigram_index[t])
+            )
+            rare = [t for t in by_size if len(self._trigram_index[t]) <= limit][:_FUZZY_TRIGRAMS]
+            for tri in rare:
+                votes.update(self._trigram_index[tri])
+            candidates.update(idx for idx, _ in votes.most_common(_RERANK_CANDIDATES))
+            if len(rare) < _FUZZY_TRIGRAMS:
+                # Faute de frappe dans un mot courant ("gratni", "saumn") : ses trigrammes sont
+                # presque tous fréquents. Intersection des bitsets des plus rares trigrammes des
+                # mots inconnus (restreinte aux mots fréquents connus), comme pour les mots ;
+                # chaque trigramme retenu compte comme un vote au classement
+                unknown = [f" {t} " for t in query_tokens if t not in self._token_index]
+                word_trigrams = {w[i:i + 3] for w in unknown for i in range(len(w) - 2)}
+                fuzzy_mask, used = mask, 0
+                frequent = [t for t in by_size if len(self._trigram_index[t]) > limit and (not unknown or t in word_trigrams)]
+                for tri in frequent[:_FUZZY_TRIGRAMS]:
+                    tri_mask = self._trigram_mask(tri)
+                    narrowed = tri_mask if fuzzy_mask is None else fuzzy_mask & tri_mask
+                    if narrowed:
+                        fuzzy_mask, used = narrowed, used + 1
+                if used:
+                    for idx in _first_bits(fuzzy_mask, _RERANK_CANDIDATES):
+                        candidates.add(idx)
+                        votes[idx] += used
+        exact = self._by_name.get(normalized)
+        if exact is not None:
+            candidates.add(exact)
+
+        # Classement en deux temps : recouvrement des mots (peu coûteux, départagé par les votes
+        # des trigrammes) sur tous les candidats, puis Dice sur les trigrammes pour les meilleurs
+        padded_tokens = [f" {t} " for t in query_tokens]
+        overlaps = [
+            (sum(1 for t in padded_tokens if t in self._padded[idx]), votes[idx], idx) for idx in candidates
+        ]
+        if len(overlaps) > _RERANK_CANDIDATES:
+            overlaps = heapq.nlargest(_RERANK_CANDIDATES, overlaps)
+        n_query_tri = len(query_trigrams)
+        scored = []
+        for n_tokens, _, idx in overlaps:
+            padded = self._padded[idx]
+            shared = sum(1 for t in query_trigrams if t in padded)
+            dice = 2 * shared / (n_query_tri + self._trigram_counts[idx])
+            score = 1.0 if idx == exact else round(0.6 * dice + 0.4 * n_tokens / len(query_tokens), 4)
+            scored.append((score, idx))
+        return heapq.nsmallest(k, scored, key=lambda s: (-s[0], s[1]))
+
+    def search_names(self, query: str, k: int = 5) -> List[Dict[str, Any]]:
+        return [{"name": self.name(idx), "score": score} for score, idx in self.search(query, k)]
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+_store: Optional[RecipeStore] = None
+_store_lock = threading.Lock()
+
+
+def get_recipe_store(default_records: Optional[List[Dict[str, Any]]] = None) -> RecipeStore:
+    """Magasin partagé : corpus CHEFBOT_RECIPES_PATH s'il est défini, sinon default_records"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            path = os.getenv("CHEFBOT_RECIPES_PATH")
+            if path:
+                _store = RecipeStore(path=path)
+            else:
+                _store = RecipeStore(records=list(default_records or []))
+        return _store
+
+
+def _check(size: int = 100_000) -> None:
+    """Vérification à l'échelle : corpus synthétique où les noms de plats sont des mots très
+    fréquents, fautes de frappe dans ces mots"""
+    import random
+    import time
+
+    rng = random.Random(0)
+    dishes = ["gratin", "saumon", "poulet", "risotto", "tarte", "soupe", "velouté", "quiche", "curry", "tajine"]
+    ingredients = ["courgettes", "carottes", "champignons", "poireaux", "tomates", "épinards", "potiron", "lentilles",
+                   "asperges", "citron", "chèvre", "lardons", "noix", "pommes", "riz", "crevettes", "thon", "boeuf"]
+    styles = ["maison", "de grand-mère", "express", "facile", "léger", "provençal", "au four", "d'été", "aux herbes"]
+    store = RecipeStore(records=[
+        {"name": f"{rng.choice(dishes).capitalize()} {rng.choice(['aux', 'de', 'au'])} {rng.choice(ingredients)} "
+                 f"{rng.choice(styles)} n°{i}"}
+        for i in range(size)
+    ])
+    start = time.perf_counter()
+    len(store)
+    print(f"{size} recettes indexées en {time.perf_counter() - start:.2f} s")
+    cases = {"gratni": "gratin", "saumn": "saumon", "pouler": "poulet", "risoto": "risotto", "curri": "curry",
+             "gratni de courgettes": "gratin courgettes", "velouter potiron": "veloute", "tajine": "tajine"}
+    failures = 0
+    for query, expected in cases.items():
+        start = time.perf_counter()
+        names = [r["name"] for r in store.search_names(query, 3)]
+        elapsed = (time.perf_counter() - start) * 1000
+        # Chaque résultat doit contenir les mots attendus
+        ok = bool(names) and all(set(normalize_text(expected).split()) <= set(normalize_text(n).split()) for n in names)
+        failures += not ok
+        print(f"{'ok ' if ok else 'KO '} {query!r:24} {elapsed:6.1f} ms  {names[:1]}")
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Vérifie la recherche floue du magasin de recettes à l'échelle")
+    parser.add_argument("--size", type=int, default=100_000)
+    _check(parser.parse_args().size)
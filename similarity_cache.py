@@ -0,0 +1,323 @@
+import atexit
+import functools
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import zlib
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from text_matcher import normalize_text
+
+# Cache par similarité de texte
+# Les textes (contraintes, questions) sont normalisés (accents, casse, pluriels, et
+# optionnellement les nombres remplacés par 0) puis projetés par hachage dans un vecteur
+# de mots et de trigrammes de caractères. La recherche est une similarité cosinus en
+# force brute NumPy, éventuellement pondérée par l'IDF des dimensions, restreinte à une
+# partition (ex: modèle, saison). Un texte identique après normalisation est un hit exact.
+# Un garde optionnel (guard) restreint les hits par similarité aux entrées dont la
+# signature est identique (ex: mêmes nombres, mêmes négations et régimes).
+# Éviction LRU, persistance JSON (les vecteurs sont recalculés au chargement).
+
+_NUMBER_RE = re.compile(r"\d+")
+
+# Mots outils ignorés (déjà normalisés : sans accents ni pluriel)
+STOP_WORDS = frozenset(
+    "a au aux avec ce ces comment d de du dans des en est et il je l la le les ma me mon "
+    "ou par pour quel quelle que qui se son sur ta te ton un une vo votre vou".split()
+)
+
+
+class HashedNgramVectorizer:
+    """Vecteurs creux de mots + trigrammes de caractères, projetés sur dim dimensions"""
+
+    def __init__(self, dim: int = 2048, mask_numbers: bool = False):
+        self.dim = dim
+        self.mask_numbers = mask_numbers
+
+    def normalize(self, text: str) -> str:
+        normalized = normalize_text(text)
+        if self.mask_numbers:
+            normalized = _NUMBER_RE.sub("0", normalized)
+        return normalized
+
+    def features(self, normalized: str) -> Counter:
+        feats: Counter = Counter()
+        words = [w for w in normalized.split() if w not in STOP_WORDS] or normalized.split()
+        for word in words:
+            feats["w:" + word] += 1
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                feats["c:" + padded[i:i + 3]] += 1
+        return feats
+
+    def transform(self, normalized: str) -> np.ndarray:
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for feat, count in self.features(normalized).items():
+            h = zlib.crc32(feat.encode("utf-8"))
+            sign = 1.0 if h & 0x80000000 else -1.0
+            vec[h % self.dim] += sign * (1.0 + math.log(count))
+        return vec
+
+
+class SimilarityCache:
+    """Cache LRU de valeurs indexées par texte, avec recherche du plus proche voisin"""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        threshold: float = 0.85,
+        capacity: int = 1000,
+        dim: int = 2048,
+        mask_numbers: bool = False,
+        use_idf: bool = False,
+        save_every: int = 20,
+        guard: Optional[Callable[[str], Any]] = None,
+    ):
+        self.path = path
+        self.guard = guard
+        self.threshold = threshold
+        self.capacity = capacity
+        self.use_idf = use_idf
+        self.save_every = save_every
+        self.vectorizer = HashedNgramVectorizer(dim=dim, mask_numbers=mask_numbers)
+
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._unit = np.zeros((capacity, dim), dtype=np.float32)   # vecteurs normalisés (sans IDF)
+        self._df = np.zeros(dim, dtype=np.float32)                  # fréquence documentaire par dimension
+        self._last_used = np.zeros(capacity, dtype=np.int64)
+        self._rows: List[Optional[Dict[str, Any]]] = [None] * capacity
+        self._by_key: Dict[Tuple[str, str], int] = {}
+        self._clock = 0
+        self._dirty = 0
+        self.stats = {"lookups": 0, "exact_hits": 0, "similar_hits": 0, "guard_rejects": 0, "misses": 0,
+                      "stores": 0, "evictions": 0}
+
+        if path and os.path.exists(path):
+            self._load()
+
+    # Index
+
+    def _free_row(self) -> int:
+        for i, row in enumerate(self._rows):
+            if row is None:
+                return i
+        # Plein : on évince la ligne la moins récemment utilisée
+        victim = int(np.argmin(self._last_used))
+        self._remove_row(victim)
+        self.stats["evictions"] += 1
+        return victim
+
+    def _remove_row(self, i: int) -> None:
+        row = self._rows[i]
+        self._by_key.pop((row["partition"], row["normalized"]), None)
+        self._df -= self._vectors[i] != 0
+        self._vectors[i] = 0
+        self._unit[i] = 0
+        self._last_used[i] = 0
+        self._rows[i] = None
+
+    def _insert(self, normalized: str, partition: str, value: Any, text: str) -> None:
+        key = (partition, normalized)
+        i = self._by_key.get(key)
+        if i is not None:
+            self._remove_row(i)
+        i = self._free_row()
+        vec = self.vectorizer.transform(normalized)
+        norm = float(np.linalg.norm(vec)) or 1.0
+        self._vectors[i] = vec
+        self._unit[i] = vec / norm
+        self._df += vec != 0
+        self._clock += 1
+        self._last_used[i] = self._clock
+        self._rows[i] = {"partition": partition, "normalized": normalized, "text": text, "value": value,
+                         "guard": self.guard(text) if self.guard else None}
+        self._by_key[key] = i
+
+    def _similarities(self, vec: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+        if not self.use_idf:
+            norm = float(np.linalg.norm(vec)) or 1.0
+            return self._unit[candidates] @ (vec / norm)
+        n_docs = len(self._by_key)
+        idf = np.log((1.0 + n_docs) / (1.0 + self._df)) + 1.0
+        q = vec * idf
+        docs = self._vectors[candidates] * idf
+        denom = (np.linalg.norm(docs, axis=1) * (np.linalg.norm(q) or 1.0))
+        denom[denom == 0] = 1.0
+        return (docs @ q) / denom
+
+    # API
+
+    def lookup(self, text: str, partition: str = "") -> Tuple[Optional[Any], float, Optional[str]]:
+        """(valeur, similarité, "exact" | "similar") ou (None, meilleure similarité, None)"""
+        normalized = self.vectorizer.normalize(text)
+        with self._lock:
+            self.stats["lookups"] += 1
+            self._clock += 1
+            i = self._by_key.get((partition, normalized))
+            if i is not None:
+                self._last_used[i] = self._clock
+                self.stats["exact_hits"] += 1
+                return self._rows[i]["value"], 1.0, "exact"
+
+            candidates = np.array(
+                [j for j, row in enumerate(self._rows) if row is not None and row["partition"] == partition],
+                dtype=np.intp,
+            )
+            if len(candidates):
+                sims = self._similarities(self.vectorizer.transform(normalized), candidates)
+                if self.guard is not None:
+                    # Proche mais de signature différente (« sans X », autre nombre) : pas un hit
+                    signature = self.guard(text)
+                    allowed = np.array([self._rows[j]["guard"] == signature for j in candidates])
+                    if float(sims.max()) >= self.threshold and not (sims[allowed] >= self.threshold).any():
+                        self.stats["guard_rejects"] += 1
+                    sims = np.where(allowed, sims, -1.0)
+                best = int(np.argmax(sims))
+                similarity = float(sims[best])
+                if similarity >= self.threshold:
+                    j = int(candidates[best])
+                    self._last_used[j] = self._clock
+                    self.stats["similar_hits"] += 1
+                    return self._rows[j]["value"], similarity, "similar"
+            else:
+                similarity = 0.0
+            self.stats["misses"] += 1
+            return None, similarity, None
+
+    def store(self, text: str, value: Any, partition: str = "") -> None:
+        normalized = self.vectorizer.normalize(text)
+        with self._lock:
+            self._insert(normalized, partition, value, text)
+            self.stats["stores"] += 1
+            self._dirty += 1
+            should_save = self.path and self._dirty >= self.save_every
+        if should_save:
+            self.save()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._by_key)
+        hits = stats["exact_hits"] + stats["similar_hits"]
+        stats["hit_rate"] = hits / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
+
+    def clear(self) -> None:
+        with self._lock:
+            for i, row in enumerate(self._rows):
+                if row is not None:
+                    self._remove_row(i)
+            self._dirty += 1
+
+    # Persistance
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            order = sorted((self._last_used[i], i) for i, row in enumerate(self._rows) if row is not None)
+            entries = [
+                {k: self._rows[i][k] for k in ("partition", "text", "value")} for _, i in order
+            ]
+            self._dirty = 0
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"version": 1, "entries": entries}, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f).get("entries", [])
+        except (OSError, ValueError):
+            return
+        # Du moins au plus récemment utilisé : l'ordre LRU est conservé
+        for entry in entries[-self.capacity:]:
+            self._insert(self.vectorizer.normalize(entry["text"]), entry["partition"], entry["value"], entry["text"])
+
+    def save_if_dirty(self) -> None:
+        if self._dirty:
+            try:
+                self.save()
+            except Exception:
+                pass
+
+
+def open_cache(prefix: str, default_path: str, **defaults: Any) -> Optional[SimilarityCache]:
+    """Cache configuré par variables d'environnement <prefix> (0 désactive), <prefix>_PATH,
+    <prefix>_THRESHOLD, <prefix>_SIZE ; sauvegardé à la sortie du process"""
+    if os.getenv(prefix, "1").strip().lower() in ("0", "false", "no", "off"):
+        return None
+    cache = SimilarityCache(
+        path=os.getenv(f"{prefix}_PATH", default_path) or None,
+        threshold=float(os.getenv(f"{prefix}_THRESHOLD", str(defaults.pop("threshold", 0.85)))),
+        capacity=int(os.getenv(f"{prefix}_SIZE", str(defaults.pop("capacity", 1000)))),
+        **defaults,
+    )
+    atexit.register(cache.save_if_dirty)
+    return cache
+
+
+_plan_cache: Optional[SimilarityCache] = None
+_plan_cache_lock = threading.Lock()
+
+
+def get_plan_cache() -> Optional[SimilarityCache]:
+    """Cache des plans (décomposition en étapes), indexé par les contraintes normalisées.
+    Les nombres sont masqués : "pour 4 personnes" et "pour 6 personnes" donnent le même plan.
+    Un plan proche n'est servi que si négations, régimes et allergènes sont identiques
+    (constraint_signature sans les nombres) : les instructions des étapes les reprennent.
+    CHEFBOT_PLAN_CACHE=0 le désactive."""
+    global _plan_cache
+    with _plan_cache_lock:
+        if _plan_cache is None:
+            from model_cascade import constraint_signature
+
+            _plan_cache = open_cache(
+                "CHEFBOT_PLAN_CACHE",
+                os.path.join(".chefbot_cache", "plans.json"),
+                threshold=0.82,
+                capacity=500,
+                mask_numbers=True,
+                use_idf=True,
+                guard=functools.partial(constraint_signature, numbers=False),
+            )
+        return _plan_cache
+
+
+_answer_cache: Optional[SimilarityCache] = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> Optional[SimilarityCache]:
+    """Cache sémantique des réponses de ask_chef, indexé par la question normalisée.
+    Une question proche n'est servie que si ses nombres, ses « sans X », ses régimes et
+    allergènes sont identiques à ceux de la question en cache (constraint_signature).
+    CHEFBOT_ANSWER_CACHE=0 le désactive."""
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            from model_cascade import constraint_signature
+
+            _answer_cache = open_cache(
+                "CHEFBOT_ANSWER_CACHE",
+                os.path.join(".chefbot_cache", "answers.json"),
+                threshold=0.9,
+                capacity=2000,
+                guard=constraint_signature,
+            )
+        return _answer_cache
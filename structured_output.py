@@ -0,0 +1,335 @@
+import json
+import os
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from langfuse import get_client
+
+from llm import chat_completion
+
+# Sorties structurées (plan, menu, verdict des juges)
+# Chaque appel JSON passe un schéma à l'API (response_format json_schema, ou json_object
+# pour les modèles qui ne le supportent pas) puis la réponse est lue par un parseur
+# tolérant qui répare localement ce qui peut l'être : balises ```json, bloc <think>,
+# texte autour du JSON, virgules finales, JSON tronqué (chaînes et crochets refermés).
+# Un nouvel appel n'est fait qu'en dernier recours, avec un message correctif (un appel
+# identique serait servi par le cache de complétions). Les taux d'échec de parsing, de
+# réparation et de nouvel essai sont suivis par type de sortie.
+
+_STEP = {
+    "type": "object",
+    "properties": {
+        "step": {"type": "integer"},
+        "title": {"type": "string"},
+        "instruction": {"type": "string"},
+        "depends_on": {"type": "array", "items": {"type": "integer"}},
+    },
+    "required": ["step", "title", "instruction"],
+}
+
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {"steps": {"type": "array", "items": _STEP}},
+    "required": ["steps"],
+}
+
+WEEK_MENU_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "week_menu": {
+            "type": "object",
+            "additionalProperties": {
+                "type": "object",
+                "properties": {"dejeuner": {"type": "string"}, "diner": {"type": "string"}},
+            },
+        },
+        "calories_estimees": {},
+        "notes_pratiques": {},
+    },
+    "required": ["week_menu"],
+}
+
+EVENT_MENU_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "services": {"type": "array", "items": {"type": "string"}},
+        "menu": {"type": "object"},
+    },
+    "required": ["services", "menu"],
+}
+
+
+def judge_schema(criteria: List[str]) -> Dict[str, Any]:
+    """Verdict de juge : une note entre 0 et 1 par critère, plus un commentaire"""
+    properties = {name: {"type": "number", "minimum": 0, "maximum": 1} for name in criteria}
+    properties["comment"] = {"type": "string"}
+    return {"type": "object", "properties": properties, "required": list(criteria) + ["comment"]}
+
+
+# Modèles Groq acceptant response_format de type json_schema ; les autres reçoivent json_object
+JSON_SCHEMA_MODELS = {
+    "openai/gpt-oss-120b",
+    "openai/gpt-oss-20b",
+    "meta-llama/llama-4-scout-17b-16e-instruct",
+    "meta-llama/llama-4-maverick-17b-128e-instruct",
+    "moonshotai/kimi-k2-instruct",
+}
+
+_unsupported: set = set()   # modèles ayant refusé response_format (400), on n'insiste plus
+
+
+def response_format_for(model: str, name: str, schema: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """response_format à passer à l'API selon CHEFBOT_STRUCTURED_OUTPUT (json_schema, json_object, off)"""
+    mode = os.getenv("CHEFBOT_STRUCTURED_OUTPUT", "json_schema").strip().lower()
+    if mode in ("0", "off", "false", "no") or model in _unsupported:
+        return None
+    if mode == "json_schema" and model in JSON_SCHEMA_MODELS:
+        return {"type": "json_schema", "json_schema": {"name": name, "schema": schema}}
+    return {"type": "json_object"}
+
+
+# Parseur tolérant
+
+class JSONRepairError(ValueError):
+    """Réponse sans JSON exploitable ; text garde la dernière réponse brute du modèle"""
+
+    def __init__(self, message: str, text: Optional[str] = None):
+        super().__init__(message)
+        self.text = text
+
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.S)
+_THINK_RE = re.compile(r"<think>.*?(?:</think>|$)", re.S)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def _scan(text: str, start: int) -> Tuple[Optional[int], List[str], bool, List[Tuple[int, List[str]]]]:
+    """Parcourt le JSON commençant à start : (fin du document ou None si tronqué, pile des
+    ouvrants restants, chaîne ouverte, positions des virgules avec la pile à ce moment)"""
+    stack: List[str] = []
+    in_string = escaped = False
+    commas: List[Tuple[int, List[str]]] = []
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(ch)
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return i + 1, [], False, commas
+        elif ch == ",":
+            commas.append((i, list(stack)))
+    return None, stack, in_string, commas
+
+
+def _loads(candidate: str) -> Any:
+    try:
+        return json.loads(candidate)
+    except json.JSONDecodeError:
+        return json.loads(_TRAILING_COMMA_RE.sub(r"\1", candidate))
+
+
+def _close(stack: List[str]) -> str:
+    return "".join(_CLOSERS[c] for c in reversed(stack))
+
+
+def parse_json(text: str, expect: str = "object") -> Tuple[Any, bool]:
+    """Lit un JSON dans une réponse de modèle. Renvoie (valeur, réparé).
+
+    expect ("object" ou "array") indique quel ouvrant chercher en premier dans le texte.
+    Lève JSONRepairError si rien d'exploitable n'a été trouvé.
+    """
+    if text is None:
+        raise JSONRepairError("réponse vide")
+    try:
+        return json.loads(text), False
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    cleaned = _THINK_RE.sub("", str(text))
+    fenced = _FENCE_RE.search(cleaned)
+    if fenced and fenced.group(1).strip():
+        cleaned = fenced.group(1)
+
+    first, second = ("[", "{") if expect == "array" else ("{", "[")
+    starts = [i for i in (cleaned.find(first), cleaned.find(second)) if i >= 0]
+    if not starts:
+        raise JSONRepairError("aucun JSON dans la réponse")
+
+    last_error: Exception = JSONRepairError("JSON illisible")
+    for start in starts:
+        end, stack, in_string, commas = _scan(cleaned, start)
+        if end is not None:
+            try:
+                return _loads(cleaned[start:end]), True
+            except json.JSONDecodeError as e:
+                last_error = e
+                continue
+        # Tronqué : on referme la chaîne et les crochets, sinon on recule jusqu'à une
+        # virgule (dernier élément incomplet abandonné)
+        candidates = [cleaned[start:] + ('"' if in_string else "") + _close(stack)]
+        candidates += [cleaned[start:pos] + _close(pile) for pos, pile in reversed(commas[-20:])]
+        for candidate in candidates:
+            try:
+                return _loads(candidate), True
+            except json.JSONDecodeError as e:
+                last_error = e
+    raise JSONRepairError(str(last_error))
+
+
+# Validation par type de sortie
+
+def coerce_plan(value: Any) -> List[Dict[str, Any]]:
+    """Accepte une liste d'étapes ou {"steps": [...]}"""
+    if isinstance(value, dict):
+        value = value.get("steps", value.get("plan"))
+    if not isinstance(value, list) or not all(isinstance(s, dict) for s in value):
+        raise JSONRepairError("le plan n'est pas une liste d'étapes")
+    # Une étape sans titre ni instruction est le reste d'une réponse tronquée
+    value = [s for s in value if s.get("title") or s.get("instruction")]
+    if not value:
+        raise JSONRepairError("plan vide")
+    return value
+
+
+def coerce_object(value: Any) -> Dict[str, Any]:
+    if not isinstance(value, dict):
+        raise JSONRepairError("la réponse n'est pas un objet JSON")
+    return value
+
+
+def coerce_scores(criteria: List[str]) -> Callable[[Any], Dict[str, Any]]:
+    """Notes converties en float et bornées à [0, 1] ; un critère absent est une erreur"""
+    def _coerce(value: Any) -> Dict[str, Any]:
+        value = coerce_object(value)
+        missing = [name for name in criteria if name not in value]
+        if missing:
+            raise JSONRepairError(f"critères absents: {', '.join(missing)}")
+        for name in criteria:
+            try:
+                value[name] = min(1.0, max(0.0, float(value[name])))
+            except (TypeError, ValueError):
+                raise JSONRepairError(f"note non numérique pour {name}")
+        return value
+    return _coerce
+
+
+# Statistiques
+
+class ParseStats:
+    """Compteurs par type de sortie (plan, menu, judge...)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kinds: Dict[str, Dict[str, int]] = {}
+
+    def add(self, kind: str, **counts: int) -> None:
+        with self._lock:
+            stats = self._kinds.setdefault(kind, {"calls": 0, "direct": 0, "repaired": 0, "parse_failures": 0, "retries": 0, "failed": 0})
+            for name, n in counts.items():
+                stats[name] += n
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            kinds = {k: dict(v) for k, v in self._kinds.items()}
+        for stats in kinds.values():
+            calls = stats["calls"] or 1
+            stats["parse_failure_rate"] = round(stats["parse_failures"] / calls, 4)
+            stats["retry_rate"] = round(stats["retries"] / calls, 4)
+            stats["repair_rate"] = round(stats["repaired"] / calls, 4)
+        return kinds
+
+    def reset(self) -> None:
+        with self._lock:
+            self._kinds.clear()
+
+
+_stats = ParseStats()
+
+
+def get_parse_stats() -> ParseStats:
+    return _stats
+
+
+def _is_response_format_rejection(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 400 and "response_format" in str(error)
+
+
+def complete_json(
+    groq_client,
+    kind: str,
+    schema: Dict[str, Any],
+    coerce: Callable[[Any], Any],
+    expect: str = "object",
+    max_attempts: int = 2,
+    **params: Any,
+) -> Any:
+    """Appel LLM dont la réponse doit être un JSON conforme à schema.
+
+    La réponse est réparée localement si besoin ; un nouvel appel (avec un message
+    correctif) n'est fait que si la réparation échoue. Lève JSONRepairError après
+    max_attempts appels."""
+    model = params.get("model")
+    messages = list(params.pop("messages"))
+    info = {"kind": kind, "attempts": 0, "repaired": False, "response_format": None}
+    _stats.add(kind, calls=1)
+    try:
+        for attempt in range(max_attempts):
+            info["attempts"] = attempt + 1
+            response_format = response_format_for(model, kind, schema)
+            info["response_format"] = response_format["type"] if response_format else None
+            call = dict(params, messages=messages)
+            if response_format:
+                call["response_format"] = response_format
+            try:
+                resp = chat_completion(groq_client, **call)
+            except Exception as e:
+                if response_format and _is_response_format_rejection(e):
+                    # Modèle sans support : on repasse en mode texte sans compter d'essai
+                    _unsupported.add(model)
+                    resp = chat_completion(groq_client, **dict(params, messages=messages))
+                else:
+                    raise
+            text = resp.choices[0].message.content
+            try:
+                value, repaired = parse_json(text, expect=expect)
+                value = coerce(value)
+            except JSONRepairError as e:
+                _stats.add(kind, parse_failures=1)
+                info["error"] = str(e)
+                if attempt + 1 >= max_attempts:
+                    _stats.add(kind, failed=1)
+                    e.text = text
+                    raise
+                _stats.add(kind, retries=1)
+                messages = messages + [
+                    {"role": "assistant", "content": str(text or "")[:2000]},
+                    {"role": "user", "content": f"Réponse invalide ({e}). Renvoie uniquement le JSON demandé, complet et valide."},
+                ]
+                continue
+            if repaired:
+                _stats.add(kind, repaired=1)
+            else:
+                _stats.add(kind, direct=1)
+            info["repaired"] = repaired
+            info.pop("error", None)
+            return value
+    finally:
+        try:
+            get_client().update_current_observation(
+                metadata={"structured_output": info, "structured_output_stats": _stats.get_stats().get(kind)}
+            )
+        except Exception:
+            pass
@@ -0,0 +1,144 @@
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Sequence, Set, Tuple
+
+# Recherche multi-motifs pour rule_evaluator
+# Les termes et le texte sont normalisés de la même façon (minuscules, accents et
+# ligatures repliés, pluriels simples retirés) puis découpés en mots. Un automate
+# d'Aho-Corasick construit sur les séquences de mots trouve tous les termes en une
+# seule passe sur le texte, en respectant les frontières de mots.
+
+_LIGATURES = {"œ": "oe", "æ": "ae", "ß": "ss"}
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _fold(text: str) -> str:
+    text = text.lower()
+    for src, dst in _LIGATURES.items():
+        text = text.replace(src, dst)
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _singular(token: str) -> str:
+    # Pluriels français courants : légumes -> legume, gâteaux -> gateau, noix -> noi (des deux côtés)
+    if len(token) > 3 and token[-1] in "sx":
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """Découpe un texte en mots normalisés (accents repliés, pluriel retiré)"""
+    return [_singular(t) for t in _TOKEN_RE.findall(_fold(text))]
+
+
+def normalize_text(text: str) -> str:
+    """Forme canonique d'un texte : mots normalisés séparés par un espace"""
+    return " ".join(tokenize(text))
+
+
+class MultiPatternMatcher:
+    """Automate d'Aho-Corasick sur des séquences de mots"""
+
+    def __init__(self, terms: Sequence[str]):
+        self.terms = list(terms)
+        # Noeud 0 = racine ; goto[n] : mot -> noeud suivant
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Set[int]] = [set()]
+        for index, term in enumerate(self.terms):
+            tokens = tokenize(term)
+            if not tokens:
+                continue
+            node = 0
+            for tok in tokens:
+                nxt = self._goto[node].get(tok)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(set())
+                    self._goto[node][tok] = nxt
+                node = nxt
+            self._out[node].add(index)
+        self._build_failure_links()
+
+    def _build_failure_links(self) -> None:
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for tok, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and tok not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(tok, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] |= self._out[self._fail[child]]
+
+    def find_tokens(self, tokens: Iterable[str]) -> Set[int]:
+        """Indices des termes présents dans la séquence de mots"""
+        found: Set[int] = set()
+        node = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for tok in tokens:
+            while node and tok not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(tok, 0)
+            if out[node]:
+                found |= out[node]
+        return found
+
+    def find(self, text: str) -> Set[int]:
+        return self.find_tokens(tokenize(text))
+
+
+class SpecMatcher:
+    """Évaluateur compilé pour un expected {must_avoid, must_include}"""
+
+    def __init__(self, avoid: Tuple[str, ...], include: Tuple[str, ...]):
+        self.avoid = list(avoid)
+        self.include = list(include)
+        # Un seul automate pour les deux listes : les indices >= len(avoid) sont des must_include
+        self._matcher = MultiPatternMatcher(self.avoid + self.include)
+
+    def score(self, output: str) -> Dict[str, Any]:
+        found = self._matcher.find(output)
+        n_avoid = len(self.avoid)
+        scores: Dict[str, Any] = {}
+
+        if self.avoid:
+            avoid_violations = [a for i, a in enumerate(self.avoid) if i in found]
+            scores["avoid_score"] = 0.0 if avoid_violations else 1.0
+            scores["avoid_violations"] = avoid_violations
+        else:
+            scores["avoid_score"] = 1.0
+
+        if self.include:
+            included = [t for i, t in enumerate(self.include) if i + n_avoid in found]
+            scores["include_ratio"] = len(included) / len(self.include)
+            scores["included_items"] = included
+        else:
+            scores["include_ratio"] = 1.0
+
+        scores["overall"] = (scores["avoid_score"] + scores["include_ratio"]) / 2
+        return scores
+
+    def score_batch(self, outputs: Iterable[str]) -> List[Dict[str, Any]]:
+        return [self.score(o) for o in outputs]
+
+
+@lru_cache(maxsize=256)
+def _compile_spec(avoid: Tuple[str, ...], include: Tuple[str, ...]) -> SpecMatcher:
+    return SpecMatcher(avoid, include)
+
+
+def get_spec_matcher(expected: Dict[str, Any]) -> SpecMatcher:
+    """Retourne le matcher compilé (et mis en cache) pour un expected_output"""
+    expected = expected or {}
+    avoid = tuple(expected.get("must_avoid", []) or [])
+    include = tuple(expected.get("must_include", []) or [])
+    return _compile_spec(avoid, include)
@@ -0,0 +1,210 @@
+import contextlib
+import contextvars
+import copy
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+# Mémoïsation des résultats d'outils
+# Chaque outil déclare s'il est pur (même arguments -> même résultat, pour toujours) ou
+# valable pendant une durée (ttl, ex: contenu du frigo). Les outils non déclarés ne sont
+# jamais mis en cache. Les arguments sont comparés après normalisation des espaces ; la
+# casse n'est ignorée que pour les arguments que l'outil déclare (casefold). Deux niveaux :
+#   - un cache partagé entre les exécutions (LRU borné, expiration par ttl) ;
+#   - une mémoire par exécution (run_scope) qui numérote les appels et permet de répondre
+#     à un appel répété par une référence "identique à l'appel #n" plutôt que de renvoyer
+#     tout le résultat au modèle.
+
+_policies: Dict[str, Dict[str, Any]] = {}
+
+
+def declare_tool(name: str, pure: bool = False, ttl: Optional[float] = None, casefold: Sequence[str] = ()) -> None:
+    """Déclare un outil comme pur ou valable ttl secondes (sinon : jamais mis en cache).
+    casefold : arguments dont la casse est ignorée dans la clé (ex: nom de plat)"""
+    if pure or ttl is not None:
+        _policies[name] = {"pure": pure, "ttl": None if pure else float(ttl), "casefold": frozenset(casefold)}
+    else:
+        _policies.pop(name, None)
+
+
+def get_policy(name: str) -> Optional[Dict[str, Any]]:
+    return _policies.get(name)
+
+
+def _canonical_value(value: Any, fold: bool = False) -> Any:
+    if isinstance(value, str):
+        value = " ".join(value.split())
+        return value.casefold() if fold else value
+    if isinstance(value, dict):
+        return {str(k): _canonical_value(v, fold) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical_value(v, fold) for v in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def canonical_args(arguments: Dict[str, Any], name: Optional[str] = None) -> str:
+    """Clé stable : clés triées, espaces des chaînes normalisés, 2.0 == 2 ; casse ignorée
+    pour les arguments déclarés casefold par l'outil name"""
+    policy = get_policy(name) if name is not None else None
+    folded = policy["casefold"] if policy is not None else ()
+    canonical = {str(k): _canonical_value(v, k in folded) for k, v in (arguments or {}).items()}
+    return json.dumps(canonical, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _copy(value: Any) -> Any:
+    # Chaque appelant reçoit sa propre copie : muter un résultat ne modifie pas le cache
+    if isinstance(value, (str, bytes, int, float, bool, type(None))):
+        return value
+    return copy.deepcopy(value)
+
+
+class ToolResultCache:
+    """Cache LRU borné des résultats d'outils déclarés, partagé entre les exécutions"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Any, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+    def lookup(self, name: str, key: str) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get((name, key))
+            if entry is None:
+                self.stats["misses"] += 1
+                return False, None
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._entries[(name, key)]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return False, None
+            self._entries.move_to_end((name, key))
+            self.stats["hits"] += 1
+        return True, _copy(value)
+
+    def store(self, name: str, key: str, value: Any) -> None:
+        policy = get_policy(name)
+        if policy is None:
+            return
+        expires_at = None if policy["ttl"] is None else time.monotonic() + policy["ttl"]
+        value = _copy(value)
+        with self._lock:
+            self._entries[(name, key)] = (value, expires_at)
+            self._entries.move_to_end((name, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        return stats
+
+
+class RunMemo:
+    """Numérotation des appels d'outils d'une exécution (boucle manuelle)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._first_call: Dict[Tuple[str, str], Tuple[int, Optional[float]]] = {}
+        self.calls = 0
+        self.duplicates = 0
+
+    def claim(self, name: str, key: str) -> Tuple[int, Optional[int]]:
+        """Numéro de cet appel, et numéro du premier appel identique encore valable (ou None)"""
+        policy = get_policy(name)
+        now = time.monotonic()
+        with self._lock:
+            self.calls += 1
+            number = self.calls
+            if policy is None:
+                return number, None
+            previous = self._first_call.get((name, key))
+            if previous is not None and (previous[1] is None or now < previous[1]):
+                self.duplicates += 1
+                return number, previous[0]
+            expires_at = None if policy["ttl"] is None else now + policy["ttl"]
+            self._first_call[(name, key)] = (number, expires_at)
+            return number, None
+
+    def resolve(self, name: str, key: str, number: int, previous: int) -> Optional[int]:
+        """Confirme la référence de l'appel number vers previous une fois previous terminé.
+        Si previous a échoué (oublié), l'appel n'est plus un doublon : il prend sa place et
+        sera réellement exécuté (renvoie None)."""
+        with self._lock:
+            first = self._first_call.get((name, key))
+            if first is not None and first[0] == previous:
+                return previous
+            self.duplicates -= 1
+            if first is None:
+                policy = get_policy(name)
+                ttl = policy["ttl"] if policy is not None else None
+                self._first_call[(name, key)] = (number, None if ttl is None else time.monotonic() + ttl)
+            return None
+
+    def forget(self, name: str, key: str, number: int) -> None:
+        """Retire un appel échoué : un appel identique suivant sera réellement exécuté"""
+        with self._lock:
+            if self._first_call.get((name, key), (None,))[0] == number:
+                del self._first_call[(name, key)]
+
+    def clear_references(self) -> None:
+        """Après compaction du contexte, les anciens résultats ne sont plus lisibles en entier :
+        les appels suivants sont de nouveau exécutés (ou servis par le cache partagé)"""
+        with self._lock:
+            self._first_call.clear()
+
+
+_current_run: contextvars.ContextVar = contextvars.ContextVar("tool_memo_run", default=None)
+
+
+@contextlib.contextmanager
+def run_scope() -> Iterator[RunMemo]:
+    """Délimite une exécution : les appels répétés à l'intérieur deviennent des références"""
+    memo = RunMemo()
+    token = _current_run.set(memo)
+    try:
+        yield memo
+    finally:
+        _current_run.reset(token)
+
+
+def current_run() -> Optional[RunMemo]:
+    return _current_run.get()
+
+
+_cache: Optional[ToolResultCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_tool_cache() -> ToolResultCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ToolResultCache(max_entries=int(os.getenv("CHEFBOT_TOOL_CACHE_SIZE", "1024")))
+        return _cache
+
+
+def call_memoized(name: str, fn: Callable[..., Any], **arguments: Any) -> Any:
+    """Appelle fn(**arguments) en passant par le cache partagé si l'outil est déclaré"""
+    if get_policy(name) is None:
+        return fn(**arguments)
+    cache = get_tool_cache()
+    key = canonical_args(arguments, name)
+    hit, value = cache.lookup(name, key)
+    if hit:
+        return value
+    value = fn(**arguments)
+    cache.store(name, key, value)
+    return value
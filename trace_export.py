@@ -0,0 +1,163 @@
+import atexit
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+from langfuse import get_client
+
+# Export des traces Langfuse hors du chemin critique
+# Les points d'entrée n'appellent plus client.flush() : ils demandent un flush (les
+# demandes sont fusionnées en un seul drapeau) ou déposent un job d'export (ex: envoi de
+# scores, liens dataset-run). La file de jobs est bornée : si Langfuse ne répond plus,
+# les jobs les plus anciens sont abandonnés (et comptés) plutôt que de faire grossir la
+# mémoire sans limite. Un thread de fond regroupe les jobs par taille ou par délai et
+# fait un seul flush par lot.
+# Un flush final est fait à l'arrêt du process (atexit).
+
+
+class TraceExporter:
+    """File de jobs + demandes de flush fusionnées, thread d'export par lots"""
+
+    def __init__(self, max_queue: int = 1000, batch_size: int = 50, max_interval: float = 2.0):
+        self.batch_size = batch_size
+        self.max_interval = max_interval
+        self._jobs: deque = deque(maxlen=max(1, max_queue))
+        self._flush_requested = False
+        self._cond = threading.Condition()
+        self._oldest_pending: Optional[float] = None
+        self._closed = False
+        self.stats = {"submitted": 0, "dropped": 0, "flush_requests": 0, "coalesced": 0, "batches": 0,
+                      "jobs_run": 0, "job_errors": 0, "flush_errors": 0}
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def _mark_pending(self) -> None:
+        if self._oldest_pending is None:
+            self._oldest_pending = time.monotonic()
+            # Le thread d'export dort sans délai quand rien n'est en attente : on le réveille
+            # pour qu'il arme le délai max_interval
+            self._cond.notify()
+
+    def request_flush(self) -> None:
+        """Demande un flush ; plusieurs demandes avant le prochain lot n'en font qu'un"""
+        with self._cond:
+            if self._closed:
+                return
+            self.stats["flush_requests"] += 1
+            if self._flush_requested:
+                self.stats["coalesced"] += 1
+                return
+            self._flush_requested = True
+            self._mark_pending()
+
+    def submit(self, job: Optional[Callable[[], None]] = None) -> None:
+        """Dépose un job d'export (None = simple demande de flush). Ne bloque jamais : file
+        pleine, le job le plus ancien est abandonné."""
+        if job is None:
+            self.request_flush()
+            return
+        with self._cond:
+            closed = self._closed
+            if not closed:
+                if len(self._jobs) == self._jobs.maxlen:
+                    # deque(maxlen) retire l'élément le plus ancien à l'ajout
+                    self.stats["dropped"] += 1
+                self._jobs.append(job)
+                self.stats["submitted"] += 1
+                self._mark_pending()
+                if len(self._jobs) >= self.batch_size:
+                    self._cond.notify()
+        if closed:
+            # Après l'arrêt : exécuté tout de suite plutôt que perdu
+            self._export([job])
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                if self._jobs or self._flush_requested:
+                    waited = time.monotonic() - self._oldest_pending
+                    if self._closed or len(self._jobs) >= self.batch_size or waited >= self.max_interval:
+                        break
+                    self._cond.wait(self.max_interval - waited)
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+            batch = [self._jobs.popleft() for _ in range(min(self.batch_size, len(self._jobs)))]
+            self._flush_requested = False
+            self._oldest_pending = time.monotonic() if self._jobs else None
+            return batch
+
+    def _export(self, batch) -> None:
+        for job in batch:
+            try:
+                job()
+                self.stats["jobs_run"] += 1
+            except Exception:
+                self.stats["job_errors"] += 1
+        try:
+            get_client().flush()
+        except Exception:
+            self.stats["flush_errors"] += 1
+        self.stats["batches"] += 1
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            self._export(batch)
+
+    def shutdown(self, timeout: float = 10.0) -> None:
+        """Vide la file et fait le flush final"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        try:
+            get_client().flush()
+        except Exception:
+            pass
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._cond:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._jobs)
+            stats["flush_pending"] = self._flush_requested
+        return stats
+
+
+_exporter: Optional[TraceExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> TraceExporter:
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = TraceExporter(
+                max_queue=int(os.getenv("CHEFBOT_TRACE_QUEUE", "1000")),
+                batch_size=int(os.getenv("CHEFBOT_TRACE_BATCH", "50")),
+                max_interval=float(os.getenv("CHEFBOT_TRACE_INTERVAL", "2.0")),
+            )
+            atexit.register(_exporter.shutdown)
+        return _exporter
+
+
+def schedule_flush() -> None:
+    """Remplace client.flush() : le flush sera fait en arrière-plan avec le prochain lot"""
+    get_exporter().request_flush()
+
+
+def submit_export(job: Callable[[], None]) -> None:
+    """Exécute job (ex: create_score) sur le thread d'export"""
+    get_exporter().submit(job)
+
+
+def shutdown() -> None:
+    if _exporter is not None:
+        _exporter.shutdown()